@@ -0,0 +1,65 @@
+import os
+import sys
+import numpy as np
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from pipeline.duration_control import write_wav_f32
+from utils.ffmpeg_utils import ensure_parent_dir, require_cmd, run
+
+
+def speech_like(secs, sr=16000, seed=0):
+    """Deterministic stand-in for speech: voiced bursts of 0.8-3.5 s between 0.3-1.2 s pauses.
+
+    Bursts are a harmonic stack on a wandering 110-220 Hz pitch, amplitude
+    modulated at a syllable-like 4-6 Hz, over a low noise floor, so VAD,
+    splitting on energy and duration fitting all have something to do.
+    """
+    rng = np.random.default_rng(seed)
+    n = int(secs * sr)
+    y = (rng.standard_normal(n) * 0.001).astype(np.float32)
+    t = 0.0
+    while t < secs:
+        t += float(rng.uniform(0.3, 1.2))
+        d = float(rng.uniform(0.8, 3.5))
+        s0 = int(t * sr)
+        s1 = min(int((t + d) * sr), n)
+        if s1 <= s0:
+            break
+        k = np.arange(s1 - s0, dtype=np.float32) / sr
+        f0 = float(rng.uniform(110, 220)) * (1.0 + 0.05 * np.sin(2 * np.pi * 0.7 * k))
+        ph = 2 * np.pi * np.cumsum(f0) / sr
+        v = sum(np.sin(h * ph) / h for h in range(1, 6))
+        env = 0.5 * (1.0 + np.sin(2 * np.pi * float(rng.uniform(4, 6)) * k)) * np.minimum(1.0, np.minimum(k, k[-1] - k) / 0.05)
+        y[s0:s1] += (0.2 * v * env + rng.standard_normal(s1 - s0) * 0.02).astype(np.float32)
+        t += d
+    return y
+
+
+def make_speech_wav(path, secs, sr=16000, seed=0):
+    write_wav_f32(path, speech_like(secs, sr, seed), sr)
+    return path
+
+
+def make_video(path, secs, wav, cut_every=4.0, size="640x360", fps=25):
+    """lavfi test pattern with a hard cut (luma inversion) every cut_every seconds, muxed with wav."""
+    require_cmd("ffmpeg")
+    ensure_parent_dir(path)
+    run([
+        "ffmpeg", "-y", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", "testsrc2=size=" + size + ":rate=" + str(fps) + ":duration=" + str(secs),
+        "-i", wav,
+        "-vf", "negate=enable='mod(floor(t/" + str(cut_every) + "),2)'",
+        "-c:v", "libx264", "-preset", "ultrafast", "-pix_fmt", "yuv420p",
+        "-c:a", "aac", "-b:a", "128k",
+        "-shortest",
+        path,
+    ])
+    return path
+
+
+def make_fixture(d, secs, seed=0, cut_every=4.0):
+    """Synthetic source video of secs seconds under d; returns its path."""
+    wav = make_speech_wav(os.path.join(d, "speech.wav"), secs, 16000, seed)
+    return make_video(os.path.join(d, "src.mp4"), secs, wav, cut_every)
@@ -0,0 +1,188 @@
+"""
+Time each pipeline stage on synthetic media with stub models.
+
+Usage:
+  python bench/run_bench.py --lengths 30,120,600 --out data/bench/results.json
+  python bench/run_bench.py --lengths 30,120 --save_baseline
+  python bench/run_bench.py --lengths 30,120          # compare to bench/baseline.json
+
+Fixtures come from bench/fixtures.py (lavfi test video with hard cuts and
+speech-like audio), so runs are deterministic. ASR is bench/stub_whisper.py
+(bench/stub_whisper_server.py with --asr_mode pool), translation and TTS use their --engine stub paths, and VAD the "energy"
+stand-in unless --vad_model is given; each stub's latency is a flag. A
+stage regresses when it is more than --tol slower than the baseline and
+at least --min_secs slower in absolute terms; any regression exits 1.
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Ensure project root is on sys.path when running this file directly
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+from bench.fixtures import make_fixture
+from pipeline import translation, tts_engine
+from pipeline.alignment import transcribe_segments
+from pipeline.clip_extract import extract_clip
+from pipeline.scene_detect import detect_scenes
+from pipeline.segmentation import make_segments
+from utils.cache_utils import close_cache, open_cache
+from utils.gpu_utils import cpu_cores
+
+STAGES = ["fixture", "extract_clip", "detect_scenes", "make_segments", "transcribe_segments", "translation", "tts", "merge"]
+
+
+def write_json(path, d):
+    f = open(path, "w", encoding="utf-8")
+    json.dump(d, f, indent=2, ensure_ascii=False)
+    f.close()
+
+
+def load_json(path):
+    f = open(path, "r", encoding="utf-8")
+    d = json.load(f)
+    f.close()
+    return d
+
+
+def bench_length(secs, a):
+    """Run every stage once on a secs long fixture in a fresh directory; returns stage -> seconds."""
+    d = tempfile.mkdtemp(prefix="dub_bench_" + str(secs) + "_", dir=a.work_dir or None)
+    cwd = os.getcwd()
+    # the stages write data/interim/... relative to the working directory
+    os.chdir(d)
+    res = {}
+    t0 = time.time()
+    try:
+        src = make_fixture(d, secs, a.seed, a.cut_every)
+        res["fixture"] = time.time() - t0
+
+        t0 = time.time()
+        extract_clip(src, "00:00:00", secs, "clip.mp4", "clip.wav")
+        res["extract_clip"] = time.time() - t0
+
+        t0 = time.time()
+        scenes = detect_scenes("clip.mp4", "scenes.json", 0.30, 0.80, "fast", 160, 1, "")
+        res["detect_scenes"] = time.time() - t0
+
+        t0 = time.time()
+        segs = make_segments("clip.wav", "scenes.json", "segments.json", 0.5, 250, 100, 30, 1.0, 4.0, 0.35, a.vad_model or "energy", 8, 64, "")
+        res["make_segments"] = time.time() - t0
+
+        os.environ["STUB_ASR_DELAY"] = str(a.asr_delay)
+        os.environ["STUB_ASR_RTF"] = str(a.asr_rtf)
+        model = os.path.join(d, "stub_model.bin")
+        open(model, "wb").close()
+        t0 = time.time()
+        asr = transcribe_segments("clip.wav", "segments.json", "asr.json", os.path.join(ROOT, "bench", "stub_whisper.py"), model, "en", "transcribe", True, "", True, a.asr_mode, a.asr_window, a.asr_workers, 0, os.path.join(ROOT, "bench", "stub_whisper_server.py") if a.asr_mode == "pool" else "auto")
+        res["transcribe_segments"] = time.time() - t0
+
+        at = translation.apply_config(translation.build_parser().parse_args(["--inp", "asr.json", "--out", "tr.json", "--model", "stub", "--engine", "stub", "--stub_delay", str(a.mt_delay), "--batch", str(a.mt_batch), "--cache", os.path.join(d, "tr.sqlite"), "--config", os.path.join(d, "none.yaml")]))
+        t0 = time.time()
+        mt = translation.load_mt(at)
+        cc = open_cache(at.cache, at.cache_mb * 1024 * 1024)
+        hs = translation.translate_cached(mt, cc, at, [(s.get("text") or "").strip() for s in asr])
+        close_cache(cc)
+        write_json("tr.json", [translation.tr_row(s, hs) for s in asr])
+        res["translation"] = time.time() - t0
+
+        ats = tts_engine.build_parser().parse_args(["--inp", "tr.json", "--out", "tts.json", "--ref", "none", "--engine", "stub", "--stub_delay", str(a.tts_delay), "--sr", "16000", "--workers", str(a.tts_workers), "--redo"])
+        t0 = time.time()
+        write_json("tts.json", tts_engine.synthesize(load_json("tr.json"), ats))
+        res["tts"] = time.time() - t0
+
+        t0 = time.time()
+        p = subprocess.run([sys.executable, os.path.join(ROOT, "pipeline", "merge.py"), "--tts", "tts.json", "--clip", "clip.mp4", "--out", "dubbed.mp4", "--sr", "16000"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        if p.returncode != 0:
+            raise RuntimeError("merge.py failed:\n" + p.stdout.decode("utf-8", errors="replace"))
+        res["merge"] = time.time() - t0
+        print("  scenes", len(scenes), "segments", len(segs))
+    finally:
+        os.chdir(cwd)
+        if not a.keep:
+            shutil.rmtree(d, ignore_errors=True)
+    return {k: round(v, 4) for k, v in res.items()}
+
+
+def compare(cur, base, tol, min_secs):
+    """Rows of (length, stage, base, now, ratio, regressed) for stages in both runs."""
+    rows = []
+    for ln, st in cur["lengths"].items():
+        b = base.get("lengths", {}).get(ln, {})
+        for k in STAGES:
+            if k not in st or k not in b:
+                continue
+            r = st[k] / max(b[k], 1e-9)
+            bad = st[k] > b[k] * (1.0 + tol) and st[k] - b[k] >= min_secs
+            rows.append((ln, k, b[k], st[k], r, bad))
+    return rows
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--lengths", default="30,120", help="comma list of fixture lengths in seconds")
+    p.add_argument("--out", default="data/bench/results.json")
+    p.add_argument("--baseline", default=os.path.join(ROOT, "bench", "baseline.json"))
+    p.add_argument("--save_baseline", action="store_true", help="write this run as the baseline instead of comparing")
+    p.add_argument("--tol", type=float, default=0.25, help="allowed slowdown as a fraction of the baseline")
+    p.add_argument("--min_secs", type=float, default=0.2, help="ignore slowdowns smaller than this")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--cut_every", type=float, default=4.0)
+    p.add_argument("--vad_model", default="", help="local Silero .jit/.onnx (default: energy stand-in)")
+    p.add_argument("--asr_mode", default="segment", choices=["segment", "clip", "pool"], help="pool runs bench/stub_whisper_server.py as whisper-server")
+    p.add_argument("--asr_window", type=float, default=30.0)
+    p.add_argument("--asr_workers", type=int, default=0)
+    p.add_argument("--asr_delay", type=float, default=0.0, help="stub whisper: seconds per call")
+    p.add_argument("--asr_rtf", type=float, default=0.0, help="stub whisper: seconds per second of audio")
+    p.add_argument("--mt_delay", type=float, default=0.0, help="stub MT: seconds per batch")
+    p.add_argument("--mt_batch", type=int, default=16)
+    p.add_argument("--tts_delay", type=float, default=0.0, help="stub TTS: seconds per line")
+    p.add_argument("--tts_workers", type=int, default=1)
+    p.add_argument("--work_dir", default="", help="where fixtures are built (default: system temp)")
+    p.add_argument("--keep", action="store_true", help="keep the fixture directories")
+    a = p.parse_args()
+
+    lengths = [int(x) for x in a.lengths.split(",") if x.strip()]
+    out = {"meta": {"python": platform.python_version(), "machine": platform.machine(), "cores": cpu_cores(), "args": vars(a)}, "lengths": {}}
+    for ln in lengths:
+        print("Length", ln, "s")
+        r = bench_length(ln, a)
+        for k in STAGES:
+            if k in r:
+                print("  %-20s %8.3fs  %6.1fx realtime" % (k, r[k], ln / max(r[k], 1e-9)))
+        out["lengths"][str(ln)] = r
+
+    od = os.path.dirname(a.out)
+    if od:
+        os.makedirs(od, exist_ok=True)
+    write_json(a.out, out)
+    print("Wrote:", a.out)
+
+    if a.save_baseline:
+        write_json(a.baseline, out)
+        print("Baseline:", a.baseline)
+        return
+    if not os.path.exists(a.baseline):
+        print("No baseline at", a.baseline, "- run with --save_baseline to store one")
+        return
+    rows = compare(out, load_json(a.baseline), a.tol, a.min_secs)
+    bad = 0
+    for ln, k, b, n, r, reg in rows:
+        print("  %5ss %-20s base %8.3fs now %8.3fs x%.2f %s" % (ln, k, b, n, r, "REGRESSION" if reg else ""))
+        bad += 1 if reg else 0
+    if bad:
+        print("Regressions:", bad)
+        sys.exit(1)
+    print("No regressions against", a.baseline)
+
+
+if __name__ == "__main__":
+    main()
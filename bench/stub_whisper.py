@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Stand-in for whisper-cli with controllable latency.
+
+Takes the flags run_whisper passes (-m, -f, -l, -tr, --prompt, -ng, -oj,
+-ml, -sow, -otxt, -of) and writes a .txt or word-level .json of dummy
+words at about 2.5 words per second of audio. Sleeps
+STUB_ASR_DELAY + STUB_ASR_RTF * audio seconds first.
+"""
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.audio_utils import open_wav
+
+
+def main():
+    av = sys.argv[1:]
+    opt = {}
+    flags = set()
+    i = 0
+    while i < len(av):
+        if av[i] in ["-m", "-f", "-l", "--prompt", "-ml", "-of", "-t"]:
+            opt[av[i]] = av[i + 1]
+            i += 2
+        else:
+            flags.add(av[i])
+            i += 1
+    w = open_wav(opt["-f"])
+    secs = w["n"] / float(w["sr"])
+    time.sleep(float(os.environ.get("STUB_ASR_DELAY", "0")) + float(os.environ.get("STUB_ASR_RTF", "0")) * secs)
+    n = int(secs * 2.5)
+    base = opt["-of"]
+    if "-oj" in flags:
+        tr = []
+        for k in range(n):
+            ms = int(k * 400)
+            tr.append({"text": " word" + str(k % 10), "offsets": {"from": ms, "to": ms + 300}})
+        f = open(base + ".json", "w", encoding="utf-8")
+        json.dump({"transcription": tr}, f)
+        f.close()
+    else:
+        f = open(base + ".txt", "w", encoding="utf-8")
+        f.write(" ".join("word" + str(k % 10) for k in range(n)) + "\n")
+        f.close()
+
+
+if __name__ == "__main__":
+    main()
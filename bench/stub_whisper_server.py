@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""Stand-in for whisper-server with controllable latency.
+
+Takes the flags start_whisper_servers passes (-m, -t, -l, --host, --port,
+-ng, -tr) and answers POST /inference with {"text": "dur=<ms> ..."}, where
+<ms> is the length of the uploaded WAV, so callers can tell which segment a
+text belongs to. Sleeps STUB_ASR_DELAY + STUB_ASR_RTF * audio seconds per
+request. With STUB_ASR_LOG set, appends "<port> <ms>" per request in the
+order requests arrive. With STUB_SERVER_FAIL_ONCE set to a path that does
+not exist yet, creates it and exits 1 instead of serving (a lost port race).
+"""
+import io
+import json
+import os
+import sys
+import threading
+import time
+import wave
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+LOCK = threading.Lock()
+
+
+def wav_ms(data):
+    w = wave.open(io.BytesIO(data), "rb")
+    ms = int(round(1000.0 * w.getnframes() / float(w.getframerate())))
+    w.close()
+    return ms
+
+
+def form_file(body, ctype):
+    """Bytes of the multipart part named "file"."""
+    bd = ctype.split("boundary=", 1)[1].strip().strip('"').encode("utf-8")
+    for part in body.split(b"--" + bd):
+        head, _, data = part.partition(b"\r\n\r\n")
+        if b'name="file"' in head:
+            return data[:-2] if data.endswith(b"\r\n") else data
+    return b""
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, fmt, *args):
+        pass
+
+    def reply(self, code, d):
+        b = json.dumps(d).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(b)))
+        self.end_headers()
+        self.wfile.write(b)
+
+    def do_GET(self):
+        self.reply(200, {"status": "ok"})
+
+    def do_POST(self):
+        if self.path != "/inference":
+            self.reply(404, {"error": "not found"})
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", "0")))
+        ms = wav_ms(form_file(body, self.headers.get("Content-Type", "")))
+        log = os.environ.get("STUB_ASR_LOG", "")
+        if log:
+            with LOCK:
+                f = open(log, "a", encoding="utf-8")
+                f.write(str(self.server.server_port) + " " + str(ms) + "\n")
+                f.close()
+        time.sleep(float(os.environ.get("STUB_ASR_DELAY", "0")) + float(os.environ.get("STUB_ASR_RTF", "0")) * ms / 1000.0)
+        self.reply(200, {"text": " dur=" + str(ms) + " " + " ".join("word" + str(k % 10) for k in range(int(ms / 400)))})
+
+
+def main():
+    av = sys.argv[1:]
+    opt = {}
+    i = 0
+    while i < len(av):
+        if av[i] in ["-m", "-t", "-l", "--host", "--port"]:
+            opt[av[i]] = av[i + 1]
+            i += 2
+        else:
+            i += 1
+    fail = os.environ.get("STUB_SERVER_FAIL_ONCE", "")
+    if fail and not os.path.exists(fail):
+        open(fail, "w").close()
+        print("error: couldn't bind to server socket: port " + opt.get("--port", ""))
+        sys.exit(1)
+    HTTPServer((opt.get("--host", "127.0.0.1"), int(opt["--port"])), Handler).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,26 @@
 import argparse
+import copy
+import json
+import os
+import subprocess
+import sys
+import time
+import wave
 import yaml
+from concurrent.futures import ProcessPoolExecutor
 
-from pipeline.clip_extract import extract_clip
+from pipeline.clip_extract import extract_clip, extract_clip_single_pass, extract_clip_smart
+from pipeline.encode import encode_video, print_report
 from pipeline.scene_detect import detect_scenes
 from pipeline.segmentation import make_segments
 from pipeline.alignment import transcribe_segments
+from utils.cache_utils import cache_key, file_fingerprint, load_state, save_state
+from utils.ffmpeg_utils import ensure_parent_dir, run
+from utils.gpu_utils import cpu_cores, split_cores
+from utils.metrics import enable, print_summary, span, to_chrome
+
+STAGE_ORDER = ["clip", "scenes", "segments", "asr", "tr", "tts", "merge", "lipsync", "encode"]
+ROOT = os.path.dirname(os.path.abspath(__file__))
 
 
 def load_config(p):
@@ -14,24 +30,434 @@ def load_config(p):
     return d
 
 
+def run_clip(cfg):
+    if cfg["clip"].get("mode", "separate") == "single":
+        sc = cfg["scene"]
+        # scores are only reusable by the fast scene mode
+        cache = sc.get("cache_dir", "") if sc.get("mode", "ffmpeg") == "fast" else ""
+        extract_clip_single_pass(cfg["paths"]["input_video"], cfg["clip"]["start"], float(cfg["clip"]["duration"]), cfg["paths"]["clip_video"], cfg["paths"]["clip_audio"], int(cfg["audio"]["sample_rate"]), int(cfg["audio"]["channels"]), cache, int(sc.get("width", 160)), int(sc.get("skip", 1)))
+        return
+    if cfg["clip"].get("mode", "separate") == "smart":
+        extract_clip_smart(cfg["paths"]["input_video"], cfg["clip"]["start"], float(cfg["clip"]["duration"]), cfg["paths"]["clip_video"], cfg["paths"]["clip_audio"], int(cfg["audio"]["sample_rate"]), int(cfg["audio"]["channels"]))
+        return
+    extract_clip(cfg["paths"]["input_video"], cfg["clip"]["start"], float(cfg["clip"]["duration"]), cfg["paths"]["clip_video"], cfg["paths"]["clip_audio"], int(cfg["audio"]["sample_rate"]), int(cfg["audio"]["channels"]))
+
+
+def run_scenes(cfg):
+    sc = cfg["scene"]
+    scenes = detect_scenes(cfg["paths"]["clip_video"], cfg["paths"]["scenes_json"], float(sc["threshold"]), float(sc["min_scene_len"]), sc.get("mode", "ffmpeg"), int(sc.get("width", 160)), int(sc.get("skip", 1)), sc.get("cache_dir", ""))
+    print("Scenes:", len(scenes))
+
+
+def run_segments(cfg):
+    segs = make_segments(cfg["paths"]["clip_audio"], cfg["paths"]["scenes_json"], cfg["paths"]["segments_json"], float(cfg["vad"]["threshold"]), int(cfg["vad"]["min_speech_ms"]), int(cfg["vad"]["min_silence_ms"]), int(cfg["vad"]["pad_ms"]), float(cfg["seg"]["min_len"]), float(cfg["seg"]["max_len"]), float(cfg["seg"]["gap"]), cfg["vad"].get("model", ""), int(cfg["vad"].get("lanes", 8)), int(cfg["vad"].get("block", 64)), cfg["vad"].get("cache_dir", ""), int(cfg["vad"].get("warm", 32)))
+    print("Segments:", len(segs))
+
+
+def run_asr(cfg):
+    task = cfg.get("asr", {}).get("task", "transcribe")
+    no_gpu = bool(cfg.get("asr", {}).get("no_gpu", False))
+    prompt = (cfg.get("asr", {}).get("prompt", "") or "").strip()
+    mode = cfg.get("asr", {}).get("mode", "segment")
+    window = float(cfg.get("asr", {}).get("window", 0) or 0)
+    workers = int(cfg.get("asr", {}).get("workers", 0) or 0)
+    threads = int(cfg.get("asr", {}).get("threads", 0) or 0)
+    server_bin = cfg.get("asr", {}).get("server_bin", "auto")
+    # The stage only runs when its inputs changed, so per-segment text caches
+    # keyed by segment id cannot be trusted; always redo.
+    ar = transcribe_segments(cfg["paths"]["clip_audio"], cfg["paths"]["segments_json"], cfg["paths"]["asr_json"], cfg["asr"]["bin"], cfg["asr"]["model"], cfg["asr"]["lang"], task, no_gpu, prompt, True, mode, window, workers, threads, server_bin)
+    print("ASR:", len(ar))
+
+
+def run_tr(cfg, config_path):
+    tr = cfg.get("tr", {})
+    run([sys.executable, os.path.join(ROOT, "pipeline", "translation.py"), "--inp", cfg["paths"]["asr_json"], "--out", cfg["paths"]["tr_json"], "--model", tr["model"], "--beams", str(tr.get("beams", 4)), "--max_len", str(tr.get("max_len", 256)), "--config", config_path])
+
+
+def run_tts(cfg):
+    tts = cfg.get("tts", {})
+    cmd = [sys.executable, os.path.join(ROOT, "pipeline", "tts_engine.py"), "--inp", cfg["paths"]["tr_json"], "--out", cfg["paths"]["tts_json"], "--ref", tts["ref"], "--model", tts["model"], "--lang", tts.get("lang", "hi"), "--sr", str(tts.get("sr", 16000)), "--workers", str(tts.get("workers", 1)), "--threads", str(tts.get("threads", 0)), "--cond_cache", tts.get("cond_cache", "data/cache/xtts"), "--redo"]
+    if tts.get("gpu"):
+        cmd.append("--gpu")
+    run(cmd)
+
+
+def run_merge(cfg):
+    mg = cfg.get("merge", {})
+    run([sys.executable, os.path.join(ROOT, "pipeline", "merge.py"), "--tts", cfg["paths"]["tts_json"], "--clip", cfg["paths"]["clip_video"], "--out", cfg["paths"]["dub_video"], "--sr", str(cfg.get("tts", {}).get("sr", 16000)), "--bg_vol", str(mg.get("bg_vol", 0.08)), "--mixer", mg.get("mixer", "ffmpeg")])
+
+
+def lipsync_cmd(cfg):
+    """lipsync.py and its model/tuning arguments from the lipsync block, without the clip paths."""
+    ls = cfg.get("lipsync", {})
+    cmd = [sys.executable, os.path.join(ROOT, "pipeline", "lipsync.py"), "--w2l", ls.get("w2l", "third_party/Wav2Lip"), "--ckpt", ls.get("ckpt", "assets/models/wav2lip/wav2lip_gan.pth"), "--pads", str(ls.get("pads", "0 10 0 0")), "--rf", str(ls.get("rf", 1)), "--bs", str(ls.get("bs", 0)), "--fbs", str(ls.get("fbs", 0)), "--face_cache", ls.get("face_cache", "data/cache/faces"), "--engine", ls.get("engine", "script"), "--device", ls.get("device", ""), "--margin", str(ls.get("margin", 0.2)), "--min_gap", str(ls.get("min_gap", 1.0))]
+    if ls.get("nosmooth"):
+        cmd.append("--nosmooth")
+    return cmd
+
+
+def run_lipsync(cfg):
+    pt = cfg["paths"]
+    cmd = lipsync_cmd(cfg) + ["--vid", pt["clip_video"], "--aud", pt["dub_video"], "--out", pt["lip_video"]]
+    if cfg.get("lipsync", {}).get("speech_only", False):
+        cmd += ["--tts", pt["tts_json"]]
+    run(cmd)
+
+
+def build_stages(cfg, config_path):
+    """Declare the stage DAG.
+
+    Each stage lists its parent stages, the files it reads and writes, the
+    config it depends on and the source files that implement it, including
+    the pipeline/ and utils/ modules those import (utils/metrics.py only
+    traces and is left out). Anything in that list changing makes the stage,
+    and everything after it, run again.
+    """
+    pt = cfg["paths"]
+    # keys that change how a stage runs but not what it produces
+    asr = dict(cfg.get("asr", {}))
+    for k in ["redo", "workers", "threads", "server_bin"]:
+        asr.pop(k, None)
+    tr = dict(cfg.get("tr", {}))
+    for k in ["batch", "cache", "cache_mb"]:
+        tr.pop(k, None)
+    scene = dict(cfg["scene"])
+    scene.pop("cache_dir", None)
+    # lanes and warm stay: lane boundaries change the probabilities, block does not
+    vad = dict(cfg["vad"])
+    for k in ["block", "cache_dir"]:
+        vad.pop(k, None)
+    tts = dict(cfg.get("tts", {}))
+    for k in ["workers", "threads", "cond_cache"]:
+        tts.pop(k, None)
+    enc = dict(cfg.get("encode", {}))
+    enc.pop("threads", None)
+    lip = dict(cfg.get("lipsync", {}))
+    for k in ["bs", "fbs", "device", "face_cache"]:
+        lip.pop(k, None)
+    return [
+        {"name": "clip", "deps": [], "inputs": [pt["input_video"]], "outputs": [pt["clip_video"], pt["clip_audio"]],
+         "cfg": {"clip": cfg["clip"], "audio": cfg["audio"]}, "code": ["pipeline/clip_extract.py", "pipeline/scene_detect.py", "pipeline/splice.py", "utils/cache_utils.py"], "run": lambda: run_clip(cfg)},
+        {"name": "scenes", "deps": ["clip"], "inputs": [pt["clip_video"]], "outputs": [pt["scenes_json"]],
+         "cfg": scene, "code": ["pipeline/scene_detect.py", "utils/cache_utils.py"], "run": lambda: run_scenes(cfg)},
+        {"name": "segments", "deps": ["clip", "scenes"], "inputs": [pt["clip_audio"], pt["scenes_json"], cfg["vad"].get("model", "")], "outputs": [pt["segments_json"]],
+         "cfg": {"vad": vad, "seg": cfg["seg"]}, "code": ["pipeline/segmentation.py", "pipeline/vad.py", "utils/audio_utils.py", "utils/cache_utils.py"], "run": lambda: run_segments(cfg)},
+        {"name": "asr", "deps": ["clip", "segments"], "inputs": [pt["clip_audio"], pt["segments_json"], asr.get("model", "")], "outputs": [pt["asr_json"]],
+         "cfg": asr, "code": ["pipeline/alignment.py", "pipeline/scheduler.py", "utils/audio_utils.py", "utils/gpu_utils.py"], "run": lambda: run_asr(cfg)},
+        {"name": "tr", "deps": ["asr"], "inputs": [pt["asr_json"]], "outputs": [pt["tr_json"]],
+         "cfg": tr, "code": ["pipeline/translation.py", "pipeline/scheduler.py", "utils/cache_utils.py"], "run": lambda: run_tr(cfg, config_path)},
+        {"name": "tts", "deps": ["tr"], "inputs": [pt["tr_json"], cfg.get("tts", {}).get("ref", "")], "outputs": [pt["tts_json"]],
+         "cfg": tts, "code": ["pipeline/tts_engine.py", "pipeline/duration_control.py", "pipeline/scheduler.py", "utils/cache_utils.py", "utils/gpu_utils.py"], "run": lambda: run_tts(cfg)},
+        {"name": "merge", "deps": ["clip", "tts"], "inputs": [pt["clip_video"], pt["tts_json"]], "outputs": [pt["dub_video"]],
+         "cfg": cfg.get("merge", {}), "code": ["pipeline/merge.py", "pipeline/audio_master.py", "utils/audio_utils.py"], "run": lambda: run_merge(cfg)},
+        {"name": "lipsync", "deps": ["clip", "merge"], "inputs": [pt["clip_video"], pt["dub_video"], pt["tts_json"]], "outputs": [pt["lip_video"]],
+         "cfg": lip, "code": ["pipeline/lipsync.py", "pipeline/w2l_cached.py", "pipeline/w2l_engine.py", "pipeline/scene_detect.py", "pipeline/splice.py", "utils/audio_utils.py", "utils/cache_utils.py", "utils/face_utils.py", "utils/gpu_utils.py"], "run": lambda: run_lipsync(cfg)},
+        {"name": "encode", "deps": ["scenes", enc.get("src", "merge")], "inputs": [encode_src(cfg), pt["scenes_json"]], "outputs": [pt["final_video"]],
+         "cfg": enc, "code": ["pipeline/encode.py", "pipeline/scene_detect.py", "utils/cache_utils.py", "utils/gpu_utils.py"], "run": lambda: run_encode(cfg, encode_src(cfg), pt["scenes_json"], pt["final_video"])},
+    ]
+
+
+def encode_src(cfg):
+    """Video the encode stage starts from: the lipsynced one if encode.src is lipsync, else the dubbed one."""
+    return cfg["paths"]["lip_video"] if cfg.get("encode", {}).get("src", "merge") == "lipsync" else cfg["paths"]["dub_video"]
+
+
+def run_encode(cfg, src, scenes_json, out):
+    en = cfg.get("encode", {})
+    rep = encode_video(src, out, scenes_json, int(en.get("jobs", 0)), en.get("encoder", "libx264"), en.get("preset", "medium"), float(en.get("crf", 18)), int(en.get("threads", 0)), en.get("extra", ""), "", float(en.get("min_secs", 10.0)))
+    print_report(rep)
+
+
+def stage_fingerprint(st, state):
+    """Hash of a stage's inputs, config, code and its parents' fingerprints."""
+    ins = {}
+    for p in st["inputs"]:
+        if p:
+            ins[p] = file_fingerprint(p)
+    code = {}
+    # keyed by repo-relative path, so moving the checkout keeps the fingerprints
+    for p in st["code"] + ["utils/ffmpeg_utils.py"]:
+        code[p] = file_fingerprint(os.path.join(ROOT, p))
+    deps = {}
+    for d in st["deps"]:
+        deps[d] = state.get(d, {}).get("fp")
+    return cache_key(ins, st["cfg"], code, deps)
+
+
+def run_stages(cfg, config_path, until, force):
+    """Run stages up to until, skipping those whose fingerprint is unchanged."""
+    state_path = cfg["paths"].get("state_json", "data/interim/state.json")
+    state = load_state(state_path)
+    stages = build_stages(cfg, config_path)
+    stop = STAGE_ORDER.index(until)
+    # only until and what it depends on, so encode from merge skips lipsync
+    by_name = dict((st["name"], st) for st in stages)
+    need = set()
+    todo = [until]
+    while todo:
+        x = todo.pop()
+        if x not in need:
+            need.add(x)
+            todo += by_name[x]["deps"]
+    # asr, tr and tts overlap per segment when all three are going to run
+    pipe = bool(cfg.get("run", {}).get("pipelined")) and stop >= STAGE_ORDER.index("tts")
+    ran = set()
+    for st in stages:
+        name = st["name"]
+        if STAGE_ORDER.index(name) > stop:
+            break
+        if name in ran or name not in need:
+            continue
+        fp = stage_fingerprint(st, state)
+        have = all(os.path.exists(p) for p in st["outputs"])
+        dirty = name in force or fp != state.get(name, {}).get("fp") or (not have) or any(d in ran for d in st["deps"])
+        if not dirty:
+            print("[skip]", name)
+            continue
+        if pipe and name == "asr":
+            from pipeline.scheduler import run_pipelined
+            print("[run] asr+tr+tts pipelined")
+            t0 = time.time()
+            with span("asr+tr+tts", "stage"):
+                run_pipelined(cfg, config_path)
+            for s2 in stages:
+                if s2["name"] in ["asr", "tr", "tts"]:
+                    state[s2["name"]] = {"fp": stage_fingerprint(s2, state), "secs": round(time.time() - t0, 3), "at": time.strftime("%Y-%m-%d %H:%M:%S"), "pipelined": True}
+                    ran.add(s2["name"])
+            save_state(state_path, state)
+            continue
+        print("[run]", name)
+        t0 = time.time()
+        with span(name, "stage"):
+            st["run"]()
+        state[name] = {"fp": fp, "secs": round(time.time() - t0, 3), "at": time.strftime("%Y-%m-%d %H:%M:%S")}
+        save_state(state_path, state)
+        ran.add(name)
+    return ran
+
+
+# Paths every shard shares. Caches are always made absolute so shards reuse
+# them; the rest only when they exist locally (tr.model may be a hub name).
+SHARED_PATHS = [("paths", "input_video"), ("vad", "model"), ("asr", "model"), ("tr", "model"), ("tts", "ref"), ("lipsync", "w2l"), ("lipsync", "ckpt")]
+SHARED_CACHES = [("scene", "cache_dir"), ("vad", "cache_dir"), ("tr", "cache"), ("tts", "cond_cache"), ("lipsync", "face_cache")]
+
+
+def plan_shards(scenes, total, shard_len):
+    """Cut [0, total] at scene boundaries into shards of at least shard_len seconds.
+
+    A tail shorter than a quarter shard is folded into the previous one.
+    """
+    bounds = [0.0]
+    for sc in scenes[:-1]:
+        if float(sc["end"]) - bounds[-1] >= shard_len:
+            bounds.append(float(sc["end"]))
+    if len(bounds) > 1 and total - bounds[-1] < shard_len / 4.0:
+        bounds.pop()
+    bounds.append(total)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def shard_config(cfg, k, st, en, work_dir, base_dir, cores=0):
+    """Write shard k's config into its own directory and return (dir, config path).
+
+    paths.* stay relative and resolve inside the shard directory, which the
+    shard runs in, so the per-segment scratch dirs of parallel shards never
+    collide. cores is this shard's share of the machine: asr and tts
+    workers x threads are fitted into it instead of each shard sizing
+    itself for every core.
+    """
+    c = copy.deepcopy(cfg)
+    for sec, key in SHARED_PATHS:
+        v = c.get(sec, {}).get(key)
+        if v and os.path.exists(os.path.join(base_dir, v)):
+            c[sec][key] = os.path.abspath(os.path.join(base_dir, v))
+    for sec, key in SHARED_CACHES:
+        v = c.get(sec, {}).get(key)
+        if v:
+            c[sec][key] = os.path.abspath(os.path.join(base_dir, v))
+    if cores > 0:
+        for sec in ["asr", "tts"]:
+            c.setdefault(sec, {})
+            w, t = split_cores(min(int(c[sec].get("workers", 0) or 0), cores), 0, cores)
+            c[sec]["workers"] = w
+            c[sec]["threads"] = t
+    c["clip"]["start"] = "{0:.3f}".format(st)
+    c["clip"]["duration"] = round(en - st, 3)
+    d = os.path.join(work_dir, "shard_" + str(k).zfill(4))
+    os.makedirs(d, exist_ok=True)
+    cp = os.path.join(d, "config.yaml")
+    f = open(cp, "w", encoding="utf-8")
+    yaml.safe_dump(c, f, sort_keys=False, allow_unicode=True)
+    f.close()
+    return d, cp
+
+
+def run_shard(job):
+    """Run one shard's stage DAG in its own directory; returns its dubbed video."""
+    d, cp, until = job
+    os.chdir(d)
+    cfg = load_config(cp)
+    with span("shard", "run", dir=d):
+        run_stages(cfg, cp, until, set())
+    pt = cfg["paths"]
+    return os.path.join(d, pt["lip_video"] if until == "lipsync" else pt["dub_video"])
+
+
+def shard_fingerprint(cfg, config_path, d, name):
+    """Stage name's fingerprint for the shard in d, as run_stages computes it there, and the shard's state path."""
+    cwd = os.getcwd()
+    # stage inputs and the state file are relative to the shard directory
+    os.chdir(d)
+    try:
+        sp = os.path.abspath(cfg["paths"].get("state_json", "data/interim/state.json"))
+        st = [x for x in build_stages(cfg, config_path) if x["name"] == name][0]
+        return stage_fingerprint(st, load_state(sp)), sp
+    finally:
+        os.chdir(cwd)
+
+
+def lipsync_shards(cfg, jobs, work_dir):
+    """Lip-sync every shard's dubbed video in one lipsync.py run, so Wav2Lip loads once.
+
+    Each shard's lipsync fingerprint goes into its own state file, so a rerun
+    only lip-syncs shards whose inputs, config or code changed.
+    """
+    lj = []
+    outs = []
+    todo = []
+    for d, cp, until in jobs:
+        sc = load_config(cp)
+        pt = sc["paths"]
+        j = {"vid": os.path.join(d, pt["clip_video"]), "aud": os.path.join(d, pt["dub_video"]), "out": os.path.join(d, pt["lip_video"]), "root": d}
+        if cfg.get("lipsync", {}).get("speech_only", False):
+            j["tts"] = os.path.join(d, pt["tts_json"])
+        outs.append(j["out"])
+        fp, sp = shard_fingerprint(sc, cp, d, "lipsync")
+        if fp == load_state(sp).get("lipsync", {}).get("fp") and os.path.exists(j["out"]):
+            print("[skip] lipsync", d)
+            continue
+        lj.append(j)
+        todo.append((sp, fp))
+    if not lj:
+        return outs
+    jp = os.path.join(work_dir, "lipsync_jobs.json")
+    f = open(jp, "w", encoding="utf-8")
+    json.dump(lj, f, indent=2)
+    f.close()
+    t0 = time.time()
+    with span("lipsync", "stage", shards=len(lj)):
+        run(lipsync_cmd(cfg) + ["--jobs", jp])
+    for sp, fp in todo:
+        state = load_state(sp)
+        state["lipsync"] = {"fp": fp, "secs": round(time.time() - t0, 3), "at": time.strftime("%Y-%m-%d %H:%M:%S"), "shards": len(lj)}
+        save_state(sp, state)
+    return outs
+
+
+def join_shards(videos, shards, out_video, work_dir, rate=48000, channels=2):
+    """Stream-copy concat the shard videos under one continuous audio track.
+
+    Each shard's audio is decoded and cut/padded to its exact share of the
+    timeline (rounded on the cumulative sample count), so the joined track has
+    no gaps or encoder-priming clicks at shard joins; it is encoded once.
+    """
+    lst = os.path.join(work_dir, "shards.txt")
+    f = open(lst, "w", encoding="utf-8")
+    for v in videos:
+        f.write("file '" + v.replace("'", "'\\''") + "'\n")
+    f.close()
+    aud = os.path.join(work_dir, "audio.wav")
+    w = wave.open(aud, "wb")
+    w.setnchannels(channels)
+    w.setsampwidth(2)
+    w.setframerate(rate)
+    fb = 2 * channels
+    for v, (st, en) in zip(videos, shards):
+        n = int(round(en * rate)) - int(round(st * rate))
+        proc = subprocess.Popen(["ffmpeg", "-v", "error", "-i", v, "-vn", "-f", "s16le", "-ac", str(channels), "-ar", str(rate), "-"], stdout=subprocess.PIPE)
+        data = proc.stdout.read(n * fb)
+        while proc.stdout.read(1 << 20):
+            pass
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise RuntimeError("ffmpeg audio decode failed: " + v)
+        if len(data) < n * fb:
+            data += b"\x00" * (n * fb - len(data))
+        w.writeframes(data)
+    w.close()
+    ensure_parent_dir(out_video)
+    run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", lst, "-i", aud, "-map", "0:v:0", "-map", "1:a:0", "-c:v", "copy", "-c:a", "aac", "-b:a", "192k", "-movflags", "+faststart", out_video])
+
+
+def run_full(cfg, config_path):
+    """Dub the whole input: scene-aligned shards run in parallel, then one join."""
+    fl = cfg.get("full", {})
+    base = os.getcwd()
+    work = os.path.abspath(fl.get("work_dir", "data/interim/shards"))
+    until = fl.get("until", "merge")
+    if STAGE_ORDER.index(until) < STAGE_ORDER.index("merge"):
+        raise RuntimeError("full.until must be merge, lipsync or encode")
+    sc = cfg["scene"]
+    src = os.path.abspath(cfg["paths"]["input_video"])
+    cache = os.path.abspath(sc["cache_dir"]) if sc.get("cache_dir") else ""
+    scenes = detect_scenes(src, os.path.join(work, "scenes.json"), float(sc["threshold"]), float(sc["min_scene_len"]), sc.get("mode", "ffmpeg"), int(sc.get("width", 160)), int(sc.get("skip", 1)), cache)
+    total = float(scenes[-1]["end"])
+    shards = plan_shards(scenes, total, float(fl.get("shard_len", 300)))
+    n = max(1, min(int(fl.get("jobs", 2)), len(shards)))
+    jobs = []
+    for k, (st, en) in enumerate(shards):
+        d, cp = shard_config(cfg, k, st, en, work, base, max(1, cpu_cores() // n))
+        # shards stop at merge; lipsync then runs once over all of them
+        jobs.append((d, cp, "merge"))
+    print("Full video:", round(total, 3), "s in", len(shards), "shards,", n, "at a time")
+    import multiprocessing as mp
+    ex = ProcessPoolExecutor(max_workers=n, mp_context=mp.get_context("spawn"))
+    try:
+        videos = list(ex.map(run_shard, jobs))
+    finally:
+        ex.shutdown(wait=True)
+    if until == "lipsync" or (until == "encode" and cfg.get("encode", {}).get("src", "merge") == "lipsync"):
+        videos = lipsync_shards(cfg, jobs, work)
+    out = os.path.abspath(fl.get("out_video", "data/processed/dubbed_full.mp4"))
+    joined = os.path.join(work, "joined.mp4") if until == "encode" else out
+    with span("join", "stage", shards=len(shards)):
+        join_shards(videos, shards, joined, work)
+    if until == "encode":
+        # the shards were stream-copied from the source; one parallel encode makes the master
+        with span("encode", "stage"):
+            run_encode(cfg, joined, os.path.join(work, "scenes.json"), out)
+    print("Wrote:", out)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", default="configs/default.yaml")
+    parser.add_argument("--until", default="", choices=[""] + STAGE_ORDER, help="last stage to run (default run.until from config)")
+    parser.add_argument("--force", default="", help="comma list of stages to run even if unchanged")
+    parser.add_argument("--full", action="store_true", help="dub the whole input video in parallel scene-aligned shards")
+    parser.add_argument("--trace", default="", help="write spans to this JSON lines file (default run.trace from config)")
     args = parser.parse_args()
     cfg = load_config(args.config)
 
-    extract_clip(cfg["paths"]["input_video"], cfg["clip"]["start"], float(cfg["clip"]["duration"]), cfg["paths"]["clip_video"], cfg["paths"]["clip_audio"], int(cfg["audio"]["sample_rate"]), int(cfg["audio"]["channels"]))
-    scenes = detect_scenes(cfg["paths"]["clip_video"], cfg["paths"]["scenes_json"], float(cfg["scene"]["threshold"]), float(cfg["scene"]["min_scene_len"]))
-    segs = make_segments(cfg["paths"]["clip_audio"], cfg["paths"]["scenes_json"], cfg["paths"]["segments_json"], float(cfg["vad"]["threshold"]), int(cfg["vad"]["min_speech_ms"]), int(cfg["vad"]["min_silence_ms"]), int(cfg["vad"]["pad_ms"]), float(cfg["seg"]["min_len"]), float(cfg["seg"]["max_len"]), float(cfg["seg"]["gap"]))
-    task = cfg.get("asr", {}).get("task", "transcribe")
-    no_gpu = bool(cfg.get("asr", {}).get("no_gpu", False))
-    prompt = (cfg.get("asr", {}).get("prompt", "") or "").strip()
-    redo = bool(cfg.get("asr", {}).get("redo", False))
-    ar = transcribe_segments(cfg["paths"]["clip_audio"], cfg["paths"]["segments_json"], cfg["paths"]["asr_json"], cfg["asr"]["bin"], cfg["asr"]["model"], cfg["asr"]["lang"], task, no_gpu, prompt, redo)
-    print("Scenes:", len(scenes))
-    print("Segments:", len(segs))
-    print("ASR:", len(ar))
-    print("Wrote:", cfg["paths"]["asr_json"])
+    trace = args.trace or cfg.get("run", {}).get("trace", "")
+    if trace:
+        trace = enable(trace)
+
+    if args.full:
+        with span("full", "run"):
+            run_full(cfg, args.config)
+    else:
+        until = args.until or cfg.get("run", {}).get("until", "asr")
+        force = set([x.strip() for x in args.force.split(",") if x.strip()])
+        if cfg.get("asr", {}).get("redo"):
+            force.add("asr")
+        with span("run", "run", until=until):
+            ran = run_stages(cfg, args.config, until, force)
+        print("Ran:", json.dumps(sorted(ran, key=STAGE_ORDER.index)))
+
+    if trace:
+        print_summary(trace)
+        print("Chrome trace:", to_chrome(trace, os.path.splitext(trace)[0] + ".chrome.json"))
 
 if __name__ == "__main__":
     main()
@@ -1,16 +1,27 @@
 import argparse
+import bisect
+import io
 import json
 import os
+import queue
 import re
+import socket
 import subprocess
 import sys
+import time
+import urllib.error
+import urllib.request
 import wave
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 # Ensure project root is on sys.path when running this file directly
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 
+from utils.audio_utils import open_wav, wav_slice
 from utils.ffmpeg_utils import ensure_parent_dir, require_cmd
+from utils.gpu_utils import split_cores
+from utils.metrics import span
 
 def load_json(p):
     if not os.path.exists(p):
@@ -20,22 +31,15 @@ def load_json(p):
     f.close()
     return d
 
-def read_wav_i16(p):
-    w = wave.open(p, "rb")
-    ch = w.getnchannels()
-    sr = w.getframerate()
-    sw = w.getsampwidth()
-    n = w.getnframes()
-    raw = w.readframes(n)
-    w.close()
-    if sw != 2:
-        raise RuntimeError("Expected 16-bit wav, got sampwidth=" + str(sw))
-    a = np.frombuffer(raw, dtype=np.int16)
-    if ch == 2:
-        a = a.reshape(-1, 2).mean(axis=1).astype(np.int16)
-    elif ch != 1:
-        raise RuntimeError("Expected 1 or 2 channels, got " + str(ch))
-    return a, sr
+def open_clip_audio(p):
+    """Open clip audio as a memory-mapped reader; slice it with seg_i16."""
+    w = open_wav(p)
+    if w["ch"] not in [1, 2]:
+        raise RuntimeError("Expected 1 or 2 channels, got " + str(w["ch"]))
+    return w, w["sr"]
+
+def seg_i16(w, s0, s1):
+    return np.ascontiguousarray(wav_slice(w, s0, s1))
 
 def write_wav_i16(p, a, sr):
     ensure_parent_dir(p)
@@ -76,7 +80,7 @@ def clean_txt(s):
     out = re.sub(r"\s+", " ", out).strip()
     return out
 
-def run_whisper(bin_name, model, lang, task, wav, out_base, no_gpu, prompt):
+def run_whisper(bin_name, model, lang, task, wav, out_base, no_gpu, prompt, words=False):
     if not os.path.exists(model):
         raise RuntimeError("Missing model file: " + model)
     ensure_parent_dir(out_base)
@@ -88,8 +92,13 @@ def run_whisper(bin_name, model, lang, task, wav, out_base, no_gpu, prompt):
         cmd.append("-tr")
     if prompt:
         cmd += ["--prompt", prompt]
-    cmd += ["-otxt", "-of", out_base]
-    p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if words:
+        # one JSON entry per word with millisecond offsets
+        cmd += ["-oj", "-ml", "1", "-sow", "-of", out_base]
+    else:
+        cmd += ["-otxt", "-of", out_base]
+    with span("whisper", "proc", wav=wav):
+        p = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     if p.returncode != 0:
         raise RuntimeError("Whisper failed:\n" + p.stderr.decode("utf-8", errors="replace"))
 
@@ -107,28 +116,322 @@ def read_txt(out_base):
         return s
     return ""
 
-def transcribe_segments(wav_path, seg_json, out_json, bin_name, model, lang, task, no_gpu, prompt, redo):
-    segs = load_json(seg_json)
-    a, sr = read_wav_i16(wav_path)
-    b = pick_bin(bin_name)
-    out = []
+def read_words(out_base, offset):
+    """Read whisper -oj word entries as (start, end, text) in clip seconds."""
+    p = out_base + ".json"
+    if not os.path.exists(p):
+        return []
+    f = open(p, "r", encoding="utf-8", errors="ignore")
+    d = json.load(f)
+    f.close()
+    words = []
+    for it in d.get("transcription", []):
+        t = it.get("text", "")
+        if not t.strip() or re.match(r"^\s*\[[^\]]*\]\s*$", t):
+            continue
+        o = it.get("offsets", {})
+        st = offset + float(o.get("from", 0)) / 1000.0
+        en = offset + float(o.get("to", 0)) / 1000.0
+        words.append((st, max(en, st), t))
+    return words
+
+def plan_windows(segs, window):
+    """Group consecutive segments into ASR windows of about window seconds.
+
+    A window closes before a segment that would push it past window seconds,
+    or at a scene change once it is at least half full. window <= 0 means one
+    window for the whole clip.
+    """
+    if window <= 0:
+        return [segs] if segs else []
+    wins = []
+    cur = []
     for seg in segs:
-        i = int(seg["id"])
-        st = float(seg["start"])
-        en = float(seg["end"])
-        s0 = int(st * sr)
-        s1 = int(en * sr)
-        if s1 <= s0:
-            out.append({"id": i, "scene": int(seg["scene"]), "start": st, "end": en, "text": ""})
+        if cur:
+            w0 = float(cur[0]["start"])
+            full = float(seg["end"]) - w0 > window
+            cut = int(seg["scene"]) != int(cur[-1]["scene"]) and float(cur[-1]["end"]) - w0 >= window / 2.0
+            if full or cut:
+                wins.append(cur)
+                cur = []
+        cur.append(seg)
+    if cur:
+        wins.append(cur)
+    return wins
+
+def assign_words(words, segs, slack=0.3):
+    """Map words to segment ids by largest time overlap.
+
+    Words that overlap no segment go to the nearest one if it is within slack
+    seconds, otherwise they are dropped (VAD said nobody was talking).
+    """
+    order = sorted(segs, key=lambda x: float(x["start"]))
+    starts = [float(s["start"]) for s in order]
+    texts = {}
+    for st, en, t in words:
+        k = bisect.bisect_right(starts, (st + en) / 2.0) - 1
+        # segments do not overlap, so only the neighbours of k can win
+        best = None
+        best_ov = 0.0
+        for j in (k - 1, k, k + 1):
+            if 0 <= j < len(order):
+                ov = min(en, float(order[j]["end"])) - max(st, float(order[j]["start"]))
+                if ov > best_ov:
+                    best_ov = ov
+                    best = order[j]
+        if best is None:
+            best_gap = slack
+            for j in (k, k + 1):
+                if 0 <= j < len(order):
+                    gap = max(float(order[j]["start"]) - en, st - float(order[j]["end"]))
+                    if gap <= best_gap:
+                        best_gap = gap
+                        best = order[j]
+        if best is None:
             continue
-        wseg = a[s0:s1]
-        seg_wav = "data/interim/asr/wav/seg_" + str(i).zfill(4) + ".wav"
-        out_base = "data/interim/asr/txt/seg_" + str(i).zfill(4)
-        write_wav_i16(seg_wav, wseg, sr)
+        i = int(best["id"])
+        texts[i] = texts.get(i, "") + t
+    return texts
+
+def transcribe_window(win, wav_path, a, sr, b, model, lang, task, no_gpu, prompt, redo, window):
+    """Run whisper on one window (the whole clip when window <= 0) and return its words."""
+    if window <= 0:
+        w0 = 0.0
+        wav = wav_path
+        out_base = "data/interim/asr/json/clip"
+    else:
+        w0 = float(win[0]["start"])
+        w1 = float(win[-1]["end"])
+        s0 = int(w0 * sr)
+        s1 = int(w1 * sr)
+        if s1 <= s0:
+            return []
+        tag = str(int(round(w0 * 1000))).zfill(8) + "_" + str(int(round(w1 * 1000))).zfill(8)
+        wav = "data/interim/asr/wav/win_" + tag + ".wav"
+        out_base = "data/interim/asr/json/win_" + tag
+        write_wav_i16(wav, seg_i16(a, s0, s1), sr)
+    if redo or (not os.path.exists(out_base + ".json")):
+        with span("asr_window", "seg", start=w0, segs=len(win)):
+            run_whisper(b, model, lang, task, wav, out_base, no_gpu, prompt, words=True)
+    return read_words(out_base, w0)
+
+def transcribe_windows(wav_path, segs, a, sr, b, model, lang, task, no_gpu, prompt, redo, window):
+    """Run whisper once per window (or once per clip) and return id -> text."""
+    words = []
+    for win in plan_windows(segs, window):
+        words += transcribe_window(win, wav_path, a, sr, b, model, lang, task, no_gpu, prompt, redo, window)
+    return assign_words(words, segs)
+
+def pick_server_bin(name):
+    if name and name != "auto":
+        require_cmd(name)
+        return name
+    if shutil_which("whisper-server"):
+        return "whisper-server"
+    raise RuntimeError("Missing whisper-server binary. Install with: brew install whisper-cpp")
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wav_bytes(a, sr):
+    b = io.BytesIO()
+    w = wave.open(b, "wb")
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(sr)
+    w.writeframes(a.tobytes())
+    w.close()
+    return b.getvalue()
+
+def launch_server(bin_name, model, lang, task, threads, no_gpu, log):
+    """Start one whisper-server on a free port; it may still be loading the model."""
+    port = free_port()
+    cmd = [bin_name]
+    if no_gpu:
+        cmd.append("-ng")
+    cmd += ["-m", model, "-t", str(threads), "-l", lang, "--host", "127.0.0.1", "--port", str(port)]
+    if task == "translate":
+        cmd.append("-tr")
+    ensure_parent_dir(log)
+    lf = open(log, "wb")
+    proc = subprocess.Popen(cmd, stdout=lf, stderr=subprocess.STDOUT)
+    lf.close()
+    return {"proc": proc, "url": "http://127.0.0.1:" + str(port), "log": log}
+
+def start_whisper_servers(bin_name, model, lang, task, n, threads, no_gpu, log_dir="data/interim/asr/log", timeout=120.0, tries=3):
+    """Start n whisper-server processes with the model loaded, each on its own port.
+
+    free_port releases the port before the server binds it, so another
+    process can take it in between; a server that exits while starting is
+    started again on a new port, up to tries times.
+    """
+    if not os.path.exists(model):
+        raise RuntimeError("Missing model file: " + model)
+    servers = []
+    for k in range(n):
+        servers.append(launch_server(bin_name, model, lang, task, threads, no_gpu, os.path.join(log_dir, "server_" + str(k) + ".log")))
+    try:
+        with span("whisper_server_start", "model", n=n):
+            for k in range(n):
+                for t in range(tries):
+                    try:
+                        wait_server(servers[k], timeout)
+                        break
+                    except RuntimeError:
+                        # only an exit is retried; a server that hangs is not
+                        if t == tries - 1 or servers[k]["proc"].poll() is None:
+                            raise
+                        print("whisper-server", k, "exited while starting, retrying on a new port")
+                        servers[k] = launch_server(bin_name, model, lang, task, threads, no_gpu, servers[k]["log"])
+    except Exception:
+        stop_whisper_servers(servers)
+        raise
+    return servers
+
+def wait_server(sv, timeout):
+    t0 = time.time()
+    while True:
+        if sv["proc"].poll() is not None:
+            f = open(sv["log"], "r", encoding="utf-8", errors="replace")
+            s = f.read()
+            f.close()
+            raise RuntimeError("whisper-server exited:\n" + s[-2000:])
+        try:
+            urllib.request.urlopen(sv["url"] + "/", timeout=2).close()
+            return
+        except urllib.error.HTTPError:
+            return
+        except (urllib.error.URLError, OSError):
+            pass
+        if time.time() - t0 > timeout:
+            raise RuntimeError("whisper-server did not come up: " + sv["url"])
+        time.sleep(0.2)
+
+def stop_whisper_servers(servers):
+    for sv in servers:
+        if sv["proc"].poll() is None:
+            sv["proc"].terminate()
+    for sv in servers:
+        try:
+            sv["proc"].wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            sv["proc"].kill()
+            sv["proc"].wait()
+
+def post_inference(url, data, lang, task, prompt, timeout=600.0):
+    """POST one WAV to a whisper-server /inference endpoint and return its text."""
+    bd = "----asr" + str(time.time_ns())
+    fields = {"response_format": "json", "language": lang, "translate": "true" if task == "translate" else "false"}
+    if prompt:
+        fields["prompt"] = prompt
+    body = b""
+    for k, v in fields.items():
+        body += ("--" + bd + "\r\nContent-Disposition: form-data; name=\"" + k + "\"\r\n\r\n" + v + "\r\n").encode("utf-8")
+    body += ("--" + bd + "\r\nContent-Disposition: form-data; name=\"file\"; filename=\"seg.wav\"\r\nContent-Type: audio/wav\r\n\r\n").encode("utf-8")
+    body += data + ("\r\n--" + bd + "--\r\n").encode("utf-8")
+    req = urllib.request.Request(url + "/inference", data=body, headers={"Content-Type": "multipart/form-data; boundary=" + bd})
+    with span("whisper_server", "model", url=url, bytes=len(data)):
+        r = urllib.request.urlopen(req, timeout=timeout)
+        d = json.loads(r.read().decode("utf-8", errors="replace"))
+        r.close()
+    if "error" in d:
+        raise RuntimeError("whisper-server error: " + str(d["error"]))
+    return d.get("text", "")
+
+def pool_one(seg, a, sr, free, lang, task, prompt, redo):
+    """Transcribe one segment on a server checked out of the free queue; returns (id, text)."""
+    i = int(seg["id"])
+    out_base = "data/interim/asr/txt/seg_" + str(i).zfill(4)
+    if redo or (not os.path.exists(out_base + ".txt")):
+        s0 = int(float(seg["start"]) * sr)
+        s1 = int(float(seg["end"]) * sr)
+        with span("asr_seg", "seg", id=i, dur=round((s1 - s0) / float(sr), 3)):
+            sv = free.get()
+            try:
+                txt = post_inference(sv["url"], wav_bytes(seg_i16(a, s0, s1), sr), lang, task, prompt)
+            finally:
+                free.put(sv)
+        ensure_parent_dir(out_base + ".txt")
+        f = open(out_base + ".txt", "w", encoding="utf-8")
+        f.write(txt)
+        f.close()
+    return i, clean_txt(read_txt(out_base))
+
+def server_queue(servers):
+    free = queue.Queue()
+    for sv in servers:
+        free.put(sv)
+    return free
+
+def transcribe_pool(segs, a, sr, servers, lang, task, prompt, redo):
+    """Transcribe segments on resident whisper-server workers, longest first.
+
+    Each worker thread checks out a free server, so at most one request is in
+    flight per server. Texts are cached like the per-segment path.
+    """
+    free = server_queue(servers)
+    todo = [seg for seg in segs if int(float(seg["end"]) * sr) > int(float(seg["start"]) * sr)]
+    todo.sort(key=lambda x: float(x["end"]) - float(x["start"]), reverse=True)
+    texts = {}
+    ex = ThreadPoolExecutor(max_workers=len(servers))
+    try:
+        for i, txt in ex.map(lambda seg: pool_one(seg, a, sr, free, lang, task, prompt, redo), todo):
+            texts[i] = txt
+    finally:
+        ex.shutdown(wait=True)
+    return texts
+
+def asr_row(seg, txt):
+    """asr.json entry for one segment."""
+    return {"id": int(seg["id"]), "scene": int(seg["scene"]), "start": float(seg["start"]), "end": float(seg["end"]), "text": txt}
+
+def transcribe_one(seg, a, sr, b, model, lang, task, no_gpu, prompt, redo):
+    """Per-segment mode: cut the segment to its own wav and run whisper on it."""
+    i = int(seg["id"])
+    s0 = int(float(seg["start"]) * sr)
+    s1 = int(float(seg["end"]) * sr)
+    if s1 <= s0:
+        return asr_row(seg, "")
+    seg_wav = "data/interim/asr/wav/seg_" + str(i).zfill(4) + ".wav"
+    out_base = "data/interim/asr/txt/seg_" + str(i).zfill(4)
+    with span("asr_seg", "seg", id=i, dur=round((s1 - s0) / float(sr), 3)):
+        write_wav_i16(seg_wav, seg_i16(a, s0, s1), sr)
         if redo or (not os.path.exists(out_base + ".txt")):
             run_whisper(b, model, lang, task, seg_wav, out_base, no_gpu, prompt)
-        txt = clean_txt(read_txt(out_base))
-        out.append({"id": i, "scene": int(seg["scene"]), "start": st, "end": en, "text": txt})
+    return asr_row(seg, clean_txt(read_txt(out_base)))
+
+def transcribe_segments(wav_path, seg_json, out_json, bin_name, model, lang, task, no_gpu, prompt, redo, mode="segment", window=0.0, workers=0, threads=0, server_bin="auto"):
+    segs = load_json(seg_json)
+    a, sr = open_clip_audio(wav_path)
+    out = []
+    if mode in ["clip", "pool"]:
+        if mode == "clip":
+            b = pick_bin(bin_name)
+            texts = transcribe_windows(wav_path, segs, a, sr, b, model, lang, task, no_gpu, prompt, redo, window)
+        else:
+            n, t = split_cores(workers, threads)
+            print("ASR pool:", n, "workers x", t, "threads")
+            servers = start_whisper_servers(pick_server_bin(server_bin), model, lang, task, n, t, no_gpu)
+            try:
+                texts = transcribe_pool(segs, a, sr, servers, lang, task, prompt, redo)
+            finally:
+                stop_whisper_servers(servers)
+        for seg in segs:
+            out.append(asr_row(seg, re.sub(r"\s+", " ", texts.get(int(seg["id"]), "")).strip()))
+        ensure_parent_dir(out_json)
+        f = open(out_json, "w", encoding="utf-8")
+        json.dump(out, f, indent=2)
+        f.close()
+        return out
+    if mode != "segment":
+        raise RuntimeError("Bad asr mode: " + str(mode))
+    b = pick_bin(bin_name)
+    for seg in segs:
+        out.append(transcribe_one(seg, a, sr, b, model, lang, task, no_gpu, prompt, redo))
     ensure_parent_dir(out_json)
     f = open(out_json, "w", encoding="utf-8")
     json.dump(out, f, indent=2)
@@ -147,10 +450,15 @@ def main():
     p.add_argument("--no_gpu", action="store_true")
     p.add_argument("--prompt", default="")
     p.add_argument("--redo", action="store_true")
+    p.add_argument("--mode", default="segment", choices=["segment", "clip", "pool"])
+    p.add_argument("--window", type=float, default=0.0)
+    p.add_argument("--workers", type=int, default=0)
+    p.add_argument("--threads", type=int, default=0)
+    p.add_argument("--server_bin", default="auto")
     a = p.parse_args()
     if a.task not in ["transcribe", "translate"]:
         raise RuntimeError("Bad --task: " + a.task)
-    r = transcribe_segments(a.wav, a.segs, a.out, a.bin, a.model, a.lang, a.task, bool(a.no_gpu), a.prompt.strip(), bool(a.redo))
+    r = transcribe_segments(a.wav, a.segs, a.out, a.bin, a.model, a.lang, a.task, bool(a.no_gpu), a.prompt.strip(), bool(a.redo), a.mode, a.window, a.workers, a.threads, a.server_bin)
     print("ASR items:", len(r))
     print("Output:", a.out)
 
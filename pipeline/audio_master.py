@@ -0,0 +1,95 @@
+import numpy as np
+
+from utils.audio_utils import iter_chunks, open_wav
+from utils.metrics import span
+
+
+def open_seg(path, sr):
+    """open_wav reader for a 16-bit TTS segment WAV, checked against the mix rate."""
+    w = open_wav(path)
+    if w["sr"] != sr:
+        raise RuntimeError("Expected " + str(sr) + " Hz wav, got " + str(w["sr"]) + ": " + path)
+    if w["ch"] not in [1, 2]:
+        raise RuntimeError("Expected 1 or 2 channels, got " + str(w["ch"]) + ": " + path)
+    return w
+
+
+def limit_peaks(x, limit=0.95, frame=160, prev_gain=1.0):
+    """Peak limiter on a float32 block.
+
+    Gain is computed per frame (10ms at 16k) as limit / peak, interpolated
+    between frames so it does not zipper, and carried across blocks through
+    prev_gain. Returns the limited block and the gain of its last frame.
+    """
+    n = len(x)
+    if n == 0:
+        return x, prev_gain
+    nf = (n + frame - 1) // frame
+    pad = nf * frame - n
+    ax = np.abs(x)
+    if pad:
+        ax = np.concatenate([ax, np.zeros(pad, dtype=ax.dtype)])
+    peak = ax.reshape(nf, frame).max(axis=1)
+    gains = np.minimum(1.0, limit / np.maximum(peak, 1e-9)).astype(np.float32)
+    # anchor each frame gain at its centre, starting from the previous block's gain
+    xp = np.concatenate([[-frame / 2.0], np.arange(nf) * frame + frame / 2.0])
+    fp = np.concatenate([[prev_gain], gains])
+    g = np.interp(np.arange(n), xp, fp).astype(np.float32)
+    # interpolation can rise above a loud frame's gain; never exceed it
+    g = np.minimum(g, np.repeat(gains, frame)[:n])
+    y = np.clip(x * g, -limit, limit)
+    return y, float(gains[-1])
+
+
+def iter_timeline(segs, total_n, sr, chunk_n):
+    """Yield float32 chunks of the dubbed track with each segment overlaid at its start.
+
+    Each segment is read through iter_chunks, lined up with the timeline
+    chunks, from the chunk it starts in until it ends, so memory tracks the
+    chunk size times the active segments.
+    """
+    items = []
+    for seg in segs:
+        s0 = int(round(float(seg["start"]) * sr))
+        if s0 < total_n:
+            items.append((max(s0, 0), seg["wav"]))
+    items.sort(key=lambda x: x[0])
+    k = 0
+    active = []
+    c0 = 0
+    while c0 < total_n:
+        c1 = min(c0 + chunk_n, total_n)
+        buf = np.zeros(c1 - c0, dtype=np.float32)
+        while k < len(items) and items[k][0] < c1:
+            s0, path = items[k]
+            w = open_seg(path, sr)
+            if w["n"]:
+                # zero-padded up to s0, so its chunks start on c0 like the timeline's
+                active.append(iter_chunks(w, chunk_n, "float32", c0 - s0, w["n"], pad=True))
+            k += 1
+        keep = []
+        for it in active:
+            x = next(it, None)
+            if x is None:
+                continue
+            m = min(len(x[1]), len(buf))
+            buf[:m] += x[1][:m]
+            keep.append(it)
+        active = keep
+        yield buf
+        c0 = c1
+
+
+def mix_to_stream(segs, total_s, sr, stream, limit=0.95, chunk_s=10.0):
+    """Mix segments into a total_s long s16le mono stream. Returns samples written."""
+    total_n = int(total_s * sr)
+    chunk_n = max(int(chunk_s * sr), 1)
+    frame = max(sr // 100, 1)
+    g = 1.0
+    written = 0
+    with span("mix", "dsp", segs=len(segs)):
+        for buf in iter_timeline(segs, total_n, sr, chunk_n):
+            y, g = limit_peaks(buf, limit, frame, g)
+            stream.write((y * 32767.0).astype("<i2").tobytes())
+            written += len(y)
+    return written
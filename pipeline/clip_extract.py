@@ -1,4 +1,11 @@
+import os
+import shutil
+import subprocess
+import tempfile
+from pipeline.scene_detect import get_duration_seconds, kept_times, probe_video, read_score_pipe, save_score_series, scaled_size, score_series_path
+from pipeline.splice import frame_at, open_source, pass_through, plan_pieces, splice
 from utils.ffmpeg_utils import ensure_parent_dir, require_cmd, run
+from utils.metrics import span
 def extract_clip(input_video, start, duration, out_video, out_wav, sample_rate=16000, channels=1):
     require_cmd("ffmpeg")
     ensure_parent_dir(out_video)
@@ -31,4 +38,133 @@ def extract_clip(input_video, start, duration, out_video, out_wav, sample_rate=1
         out_wav
     ]
 
-    run(audio_cmd)
\ No newline at end of file
+    run(audio_cmd)
+
+
+def extract_clip_single_pass(input_video, start, duration, out_video, out_wav, sample_rate=16000, channels=1, scene_cache="", width=160, skip=1):
+    """One demux/decode of the source for clip.mp4, clip.wav and the scene scores.
+
+    The decoded video is split: one branch is encoded to out_video, the other
+    is scaled to a small gray stream and piped back here for scoring. The
+    series is stored in scene_cache under out_video's fingerprint, so
+    detect_scenes(mode="fast") on the clip is answered without decoding it.
+    With scene_cache empty the score branch is dropped.
+    """
+    require_cmd("ffmpeg")
+    ensure_parent_dir(out_video)
+    ensure_parent_dir(out_wav)
+    cmd = [
+        "ffmpeg",
+        "-y",
+        "-hide_banner",
+        "-loglevel", "error",
+        "-ss", start,
+        "-t", str(duration),
+        "-i", input_video,
+    ]
+    if scene_cache:
+        w, h, fps = probe_video(input_video)
+        sw, sh = scaled_size(w, h, width)
+        sel = ""
+        if skip > 1:
+            sel = "select='not(mod(n,{0}))',".format(int(skip))
+        cmd += ["-filter_complex", "[0:v]split=2[v][s];[s]{0}scale={1}:{2}:flags=area,format=gray[g]".format(sel, sw, sh)]
+        vmap = "[v]"
+    else:
+        vmap = "0:v:0"
+    cmd += [
+        "-map", vmap,
+        "-map", "0:a:0?",
+        "-c:v", "libx264",
+        "-crf", "18",
+        "-preset", "medium",
+        "-c:a", "aac",
+        "-movflags", "+faststart",
+        out_video,
+        "-map", "0:a:0",
+        "-vn",
+        "-ac", str(channels),
+        "-ar", str(sample_rate),
+        "-c:a", "pcm_s16le",
+        out_wav,
+    ]
+    if not scene_cache:
+        run(cmd)
+        return
+    cmd += ["-map", "[g]", "-fps_mode", "passthrough", "-f", "rawvideo", "-pix_fmt", "gray", "pipe:1"]
+    # stderr to a file: ffmpeg must never block on it while we drain stdout
+    with tempfile.TemporaryFile() as ef, span("ffmpeg", "proc", what="clip + scene scores"):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=ef)
+        scores = read_score_pipe(proc.stdout, sw, sh)
+        proc.stdout.close()
+        rc = proc.wait()
+        ef.seek(0)
+        err = ef.read().decode("utf-8", errors="replace")
+    if rc != 0:
+        raise RuntimeError("ffmpeg single-pass clip extract failed:\n" + err)
+    # the clip keeps the source's frame timing, so its pts place the scores
+    times = kept_times(out_video, len(scores), skip, fps)
+    path = score_series_path(out_video, "fast", width, skip, scene_cache)
+    save_score_series(path, get_duration_seconds(out_video), times, scores)
+
+
+def parse_time(t):
+    """Seconds from 'HH:MM:SS(.ms)', 'MM:SS' or a plain number."""
+    s = str(t).strip()
+    parts = s.split(":")
+    v = 0.0
+    for p in parts:
+        v = v * 60.0 + float(p)
+    return v
+
+
+def extract_clip_smart(input_video, start, duration, out_video, out_wav, sample_rate=16000, channels=1, min_copy=2.0):
+    """Clip by stream-copying whole closed GOPs and re-encoding only the partial GOPs at the ends.
+
+    Frames shown in [start, start + duration) are taken by index from the
+    source's packet pts (pipeline/splice.py). The span between the first and
+    last closed-GOP keyframe inside is copied, and the ends are encoded with
+    libx264 matching the source's SPS. Audio is encoded for the whole window
+    (cheap) and muxed on. Falls back to extract_clip when the source is not
+    H.264, the window holds less than min_copy seconds of closed GOPs, an
+    encoded end does not match the source's SPS, the joined clip does not
+    decode to the expected frame count, or ffmpeg fails on a piece.
+    """
+    require_cmd("ffmpeg")
+    s = parse_time(start)
+    e = s + float(duration)
+    sv = open_source(input_video, s, e)
+    f0 = frame_at(sv, s)
+    f1 = frame_at(sv, e)
+    w, h, fps = probe_video(input_video)
+    mc = int(min_copy * fps)
+    copied = sum(b - a for a, b, c in plan_pieces(sv, f0, f1, mc) if c)
+    why = "no closed GOPs to copy"
+    ensure_parent_dir(out_video)
+    ensure_parent_dir(out_wav)
+    tmp = tempfile.mkdtemp(prefix="smartcut_", dir=os.path.dirname(os.path.abspath(out_video)))
+    try:
+        if copied:
+            parts = pass_through(sv, f0, f1, tmp, "part", mc)
+            why = splice(sv, parts, out_video, ["-ss", start, "-t", str(duration), "-i", input_video], f1 - f0, tmp)
+    except subprocess.CalledProcessError as ex:
+        # odd sources can make a piece cut or the concat fail outright; re-encode those too
+        why = os.path.basename(ex.cmd[0]) + " failed (exit " + str(ex.returncode) + ")"
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    if why:
+        print("Smart cut not possible (" + why + "), re-encoding clip")
+        extract_clip(input_video, start, duration, out_video, out_wav, sample_rate, channels)
+        return
+    run([
+        "ffmpeg", "-y",
+        "-ss", start,
+        "-i", input_video,
+        "-t", str(duration),
+        "-vn",
+        "-ac", str(channels),
+        "-ar", str(sample_rate),
+        "-c:a", "pcm_s16le",
+        out_wav,
+    ])
+    print("Smart cut: copied", copied, "of", f1 - f0, "frames")
@@ -0,0 +1,133 @@
+import wave
+import numpy as np
+
+from utils.ffmpeg_utils import ensure_parent_dir
+from utils.metrics import span
+
+MIN_RATIO = 0.5
+MAX_RATIO = 1.8  # Cap to preserve intelligibility
+
+
+def trim_silence(x, sr, th_db=-50.0, keep=0.05, frame_ms=10):
+    """Trim leading/trailing audio whose frame RMS is below th_db, keeping keep seconds.
+
+    Same idea as ffmpeg silenceremove with start_threshold=-50dB and
+    start_silence=0.05 on both ends; internal pauses are left alone.
+    """
+    if len(x) == 0:
+        return x
+    fr = max(int(sr * frame_ms / 1000), 1)
+    nf = len(x) // fr
+    if nf == 0:
+        return x
+    e = x[:nf * fr].astype(np.float32).reshape(nf, fr)
+    rms = np.sqrt(np.mean(e * e, axis=1))
+    loud = np.nonzero(rms > 10.0 ** (th_db / 20.0))[0]
+    if len(loud) == 0:
+        return x[:0]
+    k = int(keep * sr)
+    s0 = max(int(loud[0]) * fr - k, 0)
+    s1 = min((int(loud[-1]) + 1) * fr + k, len(x))
+    return x[s0:s1]
+
+
+def clamp_ratio(ratio):
+    """Clamp a tempo ratio to the range build_atempo_chain used to allow."""
+    return min(max(ratio, MIN_RATIO), MAX_RATIO)
+
+
+def time_stretch(x, rate, sr, frame_ms=30, tol_ms=10):
+    """WSOLA time stretch: rate > 1 is faster/shorter, pitch is kept.
+
+    Frames of frame_ms are overlap-added at half-frame hops. Each analysis
+    frame is taken near its nominal position (k * hop * rate), shifted by up
+    to tol_ms to best match the natural continuation of the previous frame.
+    """
+    x = np.asarray(x, dtype=np.float32)
+    if len(x) == 0 or abs(rate - 1.0) < 1e-3:
+        return x.copy()
+    n = max(int(sr * frame_ms / 1000) // 2 * 2, 4)
+    hs = n // 2
+    tol = int(sr * tol_ms / 1000)
+    win = np.hanning(n + 1)[:n].astype(np.float32)
+    n_out = int(round(len(x) / rate))
+    nf = n_out // hs + 1
+    # pad so every candidate slice, shifted by up to tol either way, is in range
+    xp = np.concatenate([np.zeros(tol, dtype=np.float32), x, np.zeros(n + 2 * tol + hs, dtype=np.float32)])
+    y = np.zeros(nf * hs + n, dtype=np.float32)
+    ws = np.zeros(nf * hs + n, dtype=np.float32)
+    prev = 0
+    for k in range(nf):
+        nom = int(k * hs * rate)
+        if nom >= len(x):
+            break
+        if k == 0:
+            pos = nom
+        else:
+            want = xp[prev + hs + tol:prev + hs + tol + n]
+            cand = xp[nom:nom + n + 2 * tol]
+            c = np.correlate(cand, want, mode="valid")
+            pos = nom - tol + int(np.argmax(c))
+            pos = max(pos, -tol)
+        y[k * hs:k * hs + n] += xp[pos + tol:pos + tol + n] * win
+        ws[k * hs:k * hs + n] += win
+        prev = pos
+    ws[ws < 1e-3] = 1.0
+    return (y / ws)[:n_out]
+
+
+def fit_length(x, n):
+    """Zero-pad or cut to exactly n samples."""
+    if len(x) >= n:
+        return x[:n]
+    return np.concatenate([x, np.zeros(n - len(x), dtype=x.dtype)])
+
+
+def resample(x, sr_in, sr_out):
+    """Resample with torchaudio when available, else linear interpolation."""
+    x = np.asarray(x, dtype=np.float32)
+    if sr_in == sr_out or len(x) == 0:
+        return x
+    try:
+        import torch
+        import torchaudio.functional as taf
+        return taf.resample(torch.from_numpy(x), sr_in, sr_out).numpy()
+    except ImportError:
+        n = int(round(len(x) * sr_out / sr_in))
+        return np.interp(np.arange(n) * (sr_in / sr_out), np.arange(len(x)), x).astype(np.float32)
+
+
+def fit_to_duration(x, sr, target, tol=0.05):
+    """Trim silence, stretch toward target seconds if off by more than tol, then pad/cut.
+
+    Returns (audio, generated duration after trim, applied ratio).
+    """
+    with span("fit_duration", "dsp") as sa:
+        x = trim_silence(np.asarray(x, dtype=np.float32), sr)
+        gd = len(x) / float(sr)
+        rt = 1.0
+        if target > 0.01 and gd > 0.01 and abs(gd - target) > tol:
+            rt = clamp_ratio(gd / target)
+            x = time_stretch(x, rt, sr)
+        sa["ratio"] = round(rt, 3)
+    return fit_length(x, int(round(target * sr))), gd, rt
+
+
+def write_wav_f32(path, x, sr):
+    """Write float audio in [-1, 1] as mono 16-bit PCM."""
+    ensure_parent_dir(path)
+    a = (np.clip(x, -1.0, 1.0) * 32767.0).astype("<i2")
+    w = wave.open(path, "wb")
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(sr)
+    w.writeframes(a.tobytes())
+    w.close()
+
+
+def wav_duration(path):
+    """Duration in seconds from the WAV header's frame count."""
+    w = wave.open(path, "rb")
+    d = w.getnframes() / float(w.getframerate())
+    w.close()
+    return d
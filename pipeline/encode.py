@@ -0,0 +1,203 @@
+"""
+Final encode: split the video into chunks at scene cuts, encode them in
+parallel and join them without re-encoding under the video's audio.
+
+Usage:
+  python pipeline/encode.py --src data/processed/dubbed.mp4 --out data/processed/final.mp4 \
+    --scenes data/interim/scenes/scenes.json --jobs 8 --encoder libx264 --preset slow --crf 18
+
+One x264 process stops scaling long before 64 cores; N processes with
+cores/N threads each keep them busy. Chunks start on scene cuts where one
+is near the even split point, so the forced keyframe at each chunk start
+lands where the encoder would have put one anyway. Chunks are written as
+MPEG-TS and joined with the concat demuxer, copying the bitstream.
+Frames are addressed through the source's packet pts, so variable frame
+rate sources are split on the right frames.
+"""
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import numpy as np
+
+from pipeline.scene_detect import count_frames, frame_times, probe_video
+from utils.ffmpeg_utils import ensure_parent_dir, require_cmd, run
+from utils.gpu_utils import cpu_cores
+from utils.metrics import span
+
+# Bitstream filters that make each chunk's parameter sets travel with it.
+ANNEXB = {"h264": "h264_mp4toannexb", "hevc": "hevc_mp4toannexb"}
+
+
+def codec_family(encoder):
+    e = encoder.lower()
+    if "264" in e or e.startswith("h264"):
+        return "h264"
+    if "265" in e or "hevc" in e:
+        return "hevc"
+    return ""
+
+
+def scene_cuts(scenes_json, times):
+    """Frame numbers where scenes start (excluding 0), from a scenes.json; times are the video's frame times."""
+    if not scenes_json or not os.path.exists(scenes_json):
+        return []
+    f = open(scenes_json, "r", encoding="utf-8")
+    scenes = json.load(f)
+    f.close()
+    st = [float(s["start"]) for s in scenes if float(s["start"]) > 0]
+    # first frame shown at or after each start, so variable frame rates place cuts right
+    return sorted(set(int(i) for i in np.searchsorted(times, np.array(st) - 1e-6) if 0 < i < len(times)))
+
+
+def video_times(src, fps):
+    """Presentation time of every frame of src from packet pts, or index / fps when the packets carry none."""
+    t = frame_times(src)
+    if len(t):
+        return t
+    n = count_frames(src)
+    print("Encode: no packet pts in", src, "- assuming a constant frame rate")
+    return np.arange(n, dtype=np.float64) / fps
+
+
+def seek_time(times, f0):
+    """Half a frame before frame f0, so the seek lands on it whatever the frame spacing."""
+    if f0 <= 0:
+        return 0.0
+    return max(0.0, float(times[f0] + times[f0 - 1]) / 2.0)
+
+
+def plan_chunks(n, jobs, cuts, min_frames, snap=0.25):
+    """Split frames [0, n) into about jobs chunks of at least min_frames.
+
+    Each split point moves to the nearest scene cut within snap of a chunk
+    length, and stays at the even point otherwise. Returns [(f0, f1), ...].
+    """
+    k = max(1, min(int(jobs), n // max(int(min_frames), 1)))
+    size = n / float(k)
+    bounds = [0]
+    for i in range(1, k):
+        t = int(round(i * size))
+        best = t
+        near = [c for c in cuts if abs(c - t) <= snap * size]
+        if near:
+            best = min(near, key=lambda c: abs(c - t))
+        if best - bounds[-1] >= min_frames and n - best >= min_frames:
+            bounds.append(best)
+    bounds.append(n)
+    return [(bounds[i], bounds[i + 1]) for i in range(len(bounds) - 1)]
+
+
+def encode_chunk(src, f0, f1, ss, out, encoder, preset, crf, threads, extra):
+    """Encode frames [f0, f1) of src, seeking to ss (see seek_time), to out; returns (frames, seconds)."""
+    fam = codec_family(encoder)
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-ss", "{0:.6f}".format(ss), "-i", src, "-map", "0:v:0", "-an", "-frames:v", str(f1 - f0), "-c:v", encoder]
+    if preset:
+        cmd += ["-preset", preset]
+    if crf >= 0:
+        cmd += ["-crf", str(crf)]
+    if threads > 0:
+        cmd += ["-threads", str(threads)]
+    cmd += extra
+    if fam in ANNEXB:
+        cmd += ["-bsf:v", ANNEXB[fam]]
+    t0 = time.time()
+    with span("encode_chunk", "seg", f0=f0, frames=f1 - f0):
+        run(cmd + ["-f", "mpegts", out])
+    return f1 - f0, time.time() - t0
+
+
+def encode_video(src, out, scenes_json="", jobs=0, encoder="libx264", preset="medium", crf=18, threads=0, extra="", audio_src="", min_secs=10.0, work_dir=""):
+    """Re-encode src's video into out in parallel chunks, with audio copied from audio_src (default src).
+
+    jobs 0 means one chunk per 8 cores; threads 0 splits the cores evenly
+    between the chunks. Returns a report dict with frames/sec overall and
+    per chunk.
+    """
+    require_cmd("ffmpeg")
+    require_cmd("ffprobe")
+    if not os.path.exists(src):
+        raise RuntimeError("Missing video: " + src)
+    cores = cpu_cores()
+    w, h, fps = probe_video(src)
+    times = video_times(src, fps)
+    n = len(times)
+    if jobs <= 0:
+        jobs = max(1, cores // 8)
+    chunks = plan_chunks(n, jobs, scene_cuts(scenes_json, times), int(min_secs * fps))
+    if threads <= 0:
+        threads = max(1, cores // len(chunks))
+    print("Encode:", n, "frames", str(w) + "x" + str(h), "@", round(fps, 3), "in", len(chunks), "chunks x", threads, "threads,", encoder, preset, "crf", crf)
+    ensure_parent_dir(out)
+    tmp = tempfile.mkdtemp(prefix="encode_", dir=work_dir or os.path.dirname(os.path.abspath(out)))
+    t0 = time.time()
+    try:
+        parts = [os.path.join(tmp, "chunk_" + str(i).zfill(4) + ".ts") for i in range(len(chunks))]
+        ex = ThreadPoolExecutor(max_workers=len(chunks))
+        try:
+            futs = [ex.submit(encode_chunk, src, f0, f1, seek_time(times, f0), parts[i], encoder, preset, crf, threads, shlex.split(extra)) for i, (f0, f1) in enumerate(chunks)]
+            res = [f.result() for f in futs]
+        finally:
+            ex.shutdown(wait=True)
+        t_enc = time.time() - t0
+        lst = os.path.join(tmp, "chunks.txt")
+        f = open(lst, "w", encoding="utf-8")
+        for p in parts:
+            f.write("file '" + p.replace("'", "'\\''") + "'\n")
+        f.close()
+        with span("ffmpeg", "proc", what="concat"):
+            run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", lst, "-i", audio_src or src, "-map", "0:v:0", "-map", "1:a:0?", "-c", "copy", "-movflags", "+faststart", out])
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    secs = time.time() - t0
+    rep = {"frames": n, "fps_video": fps, "chunks": len(chunks), "threads": threads, "encode_secs": round(t_enc, 3), "total_secs": round(secs, 3),
+           "fps": round(n / max(secs, 1e-9), 2), "per_chunk": [{"f0": c[0], "f1": c[1], "secs": round(r[1], 3), "fps": round(r[0] / max(r[1], 1e-9), 2)} for c, r in zip(chunks, res)]}
+    # how much faster than running the same chunks back to back
+    rep["speedup"] = round(sum(r[1] for r in res) / max(t_enc, 1e-9), 2)
+    return rep
+
+
+def print_report(rep):
+    for i, c in enumerate(rep["per_chunk"]):
+        print("  chunk", str(i).zfill(3), "frames", c["f0"], "-", c["f1"], "secs", c["secs"], "fps", c["fps"])
+    print("Encoded:", rep["frames"], "frames in", rep["total_secs"], "s,", rep["fps"], "frames/s,", round(rep["fps"] / max(rep["fps_video"], 1e-9), 2), "x realtime, parallel speedup", rep["speedup"])
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--src", required=True, help="video to encode (dubbed or lipsynced)")
+    p.add_argument("--out", required=True)
+    p.add_argument("--scenes", default="", help="scenes.json of src; chunks start at scene cuts near the split points")
+    p.add_argument("--audio", default="", help="take the audio from this file instead of --src")
+    p.add_argument("--jobs", type=int, default=0, help="parallel chunks (0 = cores / 8)")
+    p.add_argument("--threads", type=int, default=0, help="encoder threads per chunk (0 = cores / jobs)")
+    p.add_argument("--encoder", default="libx264")
+    p.add_argument("--preset", default="medium")
+    p.add_argument("--crf", type=float, default=18, help="-1 to leave rate control to --extra")
+    p.add_argument("--extra", default="", help="more encoder arguments, e.g. '-pix_fmt yuv420p -tune film'")
+    p.add_argument("--min_secs", type=float, default=10.0, help="shortest chunk")
+    p.add_argument("--report", default="", help="write the throughput report as JSON here")
+    a = p.parse_args()
+
+    rep = encode_video(a.src, a.out, a.scenes, a.jobs, a.encoder, a.preset, a.crf, a.threads, a.extra, a.audio, a.min_secs)
+    print_report(rep)
+    if a.report:
+        ensure_parent_dir(a.report)
+        f = open(a.report, "w", encoding="utf-8")
+        json.dump(rep, f, indent=2)
+        f.close()
+    print("Wrote:", a.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,56 +1,234 @@
 import argparse
+import json
 import os
+import shutil
 import subprocess
 import sys
+import tempfile
 
-p=argparse.ArgumentParser()
-p.add_argument("--vid",required=True)
-p.add_argument("--aud",required=True)
-p.add_argument("--out",required=True)
-p.add_argument("--w2l",default="third_party/Wav2Lip")
-p.add_argument("--ckpt",default="assets/models/wav2lip/wav2lip_gan.pth")
-p.add_argument("--pads",default="0 10 0 0")
-p.add_argument("--rf",type=int,default=1)
-p.add_argument("--bs",type=int,default=1)
-p.add_argument("--fbs",type=int,default=1)
-p.add_argument("--nosmooth",action="store_true")
-a=p.parse_args()
-
-if not os.path.exists(a.vid):
-    print("Missing video:",a.vid)
-    sys.exit(1)
-if not os.path.exists(a.aud):
-    print("Missing audio:",a.aud)
-    sys.exit(1)
-if not os.path.exists(a.w2l):
-    print("Missing Wav2Lip folder:",a.w2l)
-    print("Fix: git clone the Wav2Lip repo into that path")
-    sys.exit(1)
-
-inf=os.path.join(a.w2l,"inference.py")
-if not os.path.exists(inf):
-    print("Missing:",inf)
-    sys.exit(1)
-if not os.path.exists(a.ckpt):
-    print("Missing checkpoint:",a.ckpt)
-    sys.exit(1)
-
-od=os.path.dirname(a.out)
-if od and (not os.path.exists(od)):
-    os.makedirs(od,exist_ok=True)
-
-ps=a.pads.strip().split()
-if len(ps)!=4:
-    print("Bad --pads. Need 4 ints like: '0 10 0 0'")
-    sys.exit(1)
-
-cmd=[sys.executable,"inference.py","--checkpoint_path",a.ckpt,"--face",a.vid,"--audio",a.aud,"--outfile",a.out,"--pads",ps[0],ps[1],ps[2],ps[3],"--resize_factor",str(a.rf),"--wav2lip_batch_size",str(a.bs),"--face_det_batch_size",str(a.fbs)]
-if a.nosmooth:
-    cmd.append("--nosmooth")
-
-print("Running Wav2Lip...")
-r=subprocess.run(cmd,cwd=a.w2l)
-if r.returncode!=0:
-    print("Wav2Lip failed")
-    sys.exit(r.returncode)
-print("Wrote:",a.out)
+import numpy as np
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0,os.path.abspath(os.path.join(os.path.dirname(__file__),"..")))
+
+from pipeline.scene_detect import probe_video
+from pipeline.splice import cut_frames, encode_head, end_time, encode_joined, frame_at, open_source, pass_through, plan_pieces, sar_filter, splice
+from utils.audio_utils import open_wav, wav_slice
+from utils.ffmpeg_utils import run
+from utils.gpu_utils import lipsync_batches
+from utils.metrics import span
+
+ap=os.path.abspath
+
+def build_parser():
+    p=argparse.ArgumentParser()
+    p.add_argument("--vid",default="")
+    p.add_argument("--aud",default="")
+    p.add_argument("--out",default="")
+    p.add_argument("--jobs",default="",help="JSON list of {vid, aud, out[, tts, root]}: lipsync every clip with one loaded model")
+    p.add_argument("--w2l",default="third_party/Wav2Lip")
+    p.add_argument("--ckpt",default="assets/models/wav2lip/wav2lip_gan.pth")
+    p.add_argument("--pads",default="0 10 0 0")
+    p.add_argument("--rf",type=int,default=1)
+    p.add_argument("--bs",type=int,default=0,help="Wav2Lip batch (0 = from free memory and cores)")
+    p.add_argument("--fbs",type=int,default=0,help="face detector batch (0 = from free memory and cores)")
+    p.add_argument("--nosmooth",action="store_true")
+    p.add_argument("--face_cache",default="data/cache/faces",help="face track cache dir (empty = detect every run)")
+    p.add_argument("--tts",default="",help="TTS manifest: only run Wav2Lip on frames with dubbed speech, pass the rest through")
+    p.add_argument("--margin",type=float,default=0.2,help="seconds of video added on each side of a speech range")
+    p.add_argument("--min_gap",type=float,default=1.0,help="join speech ranges separated by less than this many seconds")
+    p.add_argument("--engine",default="script",choices=["inproc","script"],help="inproc: model loaded once in this process; script: one inference.py run per range")
+    p.add_argument("--device",default="",help="inproc engine device (default cuda if available)")
+    return p
+
+def w2l_script(a,vid,aud,out,src,start=0):
+    """Run the Wav2Lip repo's inference.py on vid/aud; start is the frame of src where vid begins (for the face track)."""
+    ps=a.pads.strip().split()
+    bs,fbs=a.bs,a.fbs
+    if not (bs and fbs):
+        # same sizing as the inproc engine; inference.py picks cuda when it can
+        dev=a.device
+        if not dev:
+            try:
+                import torch
+                dev="cuda" if torch.cuda.is_available() else "cpu"
+            except ImportError:
+                dev="cpu"
+        W,H,fps=probe_video(vid)
+        w,h=(W//a.rf,H//a.rf) if a.rf>1 else (W,H)
+        dbs,dfbs=lipsync_batches(dev,w,h)
+        bs,fbs=bs or dbs,fbs or dfbs
+    # inference.py runs inside the Wav2Lip folder
+    cmd=[sys.executable,"inference.py"]
+    if a.face_cache:
+        cmd=[sys.executable,ap(os.path.join(os.path.dirname(__file__),"w2l_cached.py")),"--cache_dir",ap(a.face_cache),"--track_src",ap(src),"--track_start",str(start)]
+    cmd+=["--checkpoint_path",ap(a.ckpt),"--face",ap(vid),"--audio",ap(aud),"--outfile",ap(out),"--pads",ps[0],ps[1],ps[2],ps[3],"--resize_factor",str(a.rf),"--wav2lip_batch_size",str(bs),"--face_det_batch_size",str(fbs)]
+    if a.nosmooth:
+        cmd.append("--nosmooth")
+    with span("wav2lip","proc",start=start):
+        r=subprocess.run(cmd,cwd=a.w2l)
+    if r.returncode!=0:
+        raise RuntimeError("Wav2Lip failed on "+vid)
+
+def voiced(path,thr=64):
+    """(first, last+1) sample above thr of a 16-bit TTS wav in seconds, or None if it is silent."""
+    w=open_wav(path)
+    if w["n"]==0:
+        return None
+    x=np.abs(np.asarray(w["pcm"][:,0],dtype=np.int32))
+    ix=np.nonzero(x>thr)[0]
+    if len(ix)==0:
+        return None
+    return int(ix[0])/float(w["sr"]),(int(ix[-1])+1)/float(w["sr"])
+
+def speech_ranges(items,sv,margin,min_gap,root=""):
+    """Frame ranges [f0, f1) of the splice source sv holding dubbed speech, widened by margin and joined across gaps under min_gap.
+
+    Relative wav paths in items are resolved against root.
+    """
+    tm=sv["times"]
+    n=len(tm)
+    rs=[]
+    for s in items:
+        v=voiced(os.path.join(root,s["wav"]))
+        if v is None:
+            continue
+        st=float(s.get("start",0.0))
+        f0=max(0,frame_at(sv,st+v[0]-margin)-1)
+        f1=min(n,frame_at(sv,st+v[1]+margin))
+        if f1>f0:
+            rs.append([f0,f1])
+    rs.sort()
+    out=[]
+    for r in rs:
+        if out and tm[min(r[0],n-1)]-tm[min(out[-1][1],n-1)]<min_gap:
+            out[-1][1]=max(out[-1][1],r[1])
+        else:
+            out.append(r)
+    return out
+
+def lip_piece(a,eng,sv,aud,tmp,k,f0,f1,fps,size,w16):
+    """Frames [f0, f1) of the splice source sv lip-synced to the same stretch of aud, as an Annex B .ts piece.
+
+    Encoded once with sv's matching encoder args. The script engine gets a
+    lossless input cut and writes an .avi, which inference.py's final mux
+    (-q:v 1) makes mpeg4 at top quality; its internal XVID result.avi is the
+    one lossy step we do not control.
+    """
+    vid=sv["path"]
+    ts=os.path.join(tmp,"lip_"+str(k)+".ts")
+    sar=sar_filter(sv["sps"])
+    t0=sv["times"][f0]
+    # stretch of aud under the range, from the frame times so VFR clips line up
+    du=end_time(sv,f1)-t0
+    print("Running Wav2Lip on frames",f0,"-",f1)
+    if eng is not None:
+        from pipeline.w2l_engine import lip_range
+        wav=wav_slice(w16,int(round(t0*16000)),int(round(t0*16000))+int(round(du*16000)),"float32",pad=True)
+        lip_range(eng,vid,wav,f0,f1,fps,sv["times"],size,ts,sv["enc"],a.pads.strip().split(),a.rf,a.nosmooth,a.face_cache,sar)
+        return ts
+    pv=os.path.join(tmp,"in_"+str(k)+".mp4")
+    pa=os.path.join(tmp,"in_"+str(k)+".wav")
+    lo=os.path.join(tmp,"lip_"+str(k)+".avi")
+    cut_frames(sv,f0,f1,["-c:v","libx264","-qp","0","-preset","ultrafast"],pv)
+    run(["ffmpeg","-y","-hide_banner","-loglevel","error","-ss","{0:.6f}".format(t0),"-t","{0:.6f}".format(du),"-i",aud,"-vn","-ac","1","-ar","16000","-c:a","pcm_s16le",pa])
+    w2l_script(a,pv,pa,lo,vid,f0)
+    # Wav2Lip emits one frame per mel chunk, so clone the last frame for as long
+    # as needed and let -frames:v trim back to the range length
+    vf="scale="+str(size[0])+":"+str(size[1])+",tpad=stop=-1:stop_mode=clone"
+    encode_head(lo,f1-f0,sv["enc"],ts,",".join(x for x in [vf,sar] if x))
+    return ts
+
+def lipsync_clip(a,eng,vid,aud,out,tts="",root=""):
+    """Lip-sync vid to aud into out; with tts only the speech ranges go through Wav2Lip.
+
+    eng is a loaded w2l_engine (None runs inference.py per range). The other
+    frames are passed through and everything is joined by pipeline/splice.py
+    under aud's audio; when the splice does not verify, the pieces are
+    re-encoded in one pass instead.
+    """
+    for pth,what in [(vid,"video"),(aud,"audio"),(tts,"TTS manifest")]:
+        if pth and not os.path.exists(pth):
+            raise RuntimeError("Missing "+what+": "+pth)
+    od=os.path.dirname(out)
+    if od and (not os.path.exists(od)):
+        os.makedirs(od,exist_ok=True)
+    W,H,fps=probe_video(vid)
+    sv=open_source(vid)
+    n=len(sv["times"])
+    if tts:
+        f=open(tts,"r",encoding="utf-8")
+        items=json.load(f)
+        f.close()
+        rs=speech_ranges(items,sv,a.margin,a.min_gap,root)
+    else:
+        rs=[[0,n]]
+    sp=sum(r[1]-r[0] for r in rs)
+    print("Lipsync ranges:",len(rs),"frames",sp,"of",n,"("+str(round(100.0*sp/max(n,1),1))+"%)")
+
+    tmp=tempfile.mkdtemp(prefix="lipsync_",dir=od or None)
+    try:
+        w16=None
+        if eng is not None and rs:
+            # the whole dubbed track once at Wav2Lip's rate; ranges are sliced from it
+            aw=os.path.join(tmp,"aud16k.wav")
+            run(["ffmpeg","-y","-hide_banner","-loglevel","error","-i",aud,"-vn","-ac","1","-ar","16000","-c:a","pcm_s16le",aw])
+            w16=open_wav(aw)
+        parts=[]
+        pos=0
+        copied=0
+        mc=int(2*fps)
+        for k,(f0,f1) in enumerate(rs+[[n,n]]):
+            if f0>pos:
+                parts+=pass_through(sv,pos,f0,tmp,"pass_"+str(k),mc)
+                copied+=sum(g1-g0 for g0,g1,cp in plan_pieces(sv,pos,f0,mc) if cp)
+            if f1<=f0:
+                break
+            parts.append((lip_piece(a,eng,sv,aud,tmp,k,f0,f1,fps,(W,H),w16),False))
+            pos=f1
+        why=splice(sv,parts,out,["-i",aud],n,tmp)
+        if why:
+            print("Splice not possible ("+why+"), re-encoding the joined pieces")
+            encode_joined(sv,parts,out,["-i",aud],tmp)
+            copied=0
+    finally:
+        shutil.rmtree(tmp,ignore_errors=True)
+    print("Passthrough:",n-sp,"frames,",copied,"stream-copied")
+    print("Wrote:",out)
+
+def load_jobs(a):
+    if not a.jobs:
+        if not (a.vid and a.aud and a.out):
+            raise RuntimeError("Need --vid, --aud and --out, or --jobs")
+        return [{"vid":a.vid,"aud":a.aud,"out":a.out,"tts":a.tts}]
+    f=open(a.jobs,"r",encoding="utf-8")
+    jobs=json.load(f)
+    f.close()
+    return jobs
+
+def main():
+    a=build_parser().parse_args()
+    if not os.path.exists(a.w2l):
+        print("Missing Wav2Lip folder:",a.w2l)
+        print("Fix: git clone the Wav2Lip repo into that path")
+        sys.exit(1)
+    if a.engine=="script" and not os.path.exists(os.path.join(a.w2l,"inference.py")):
+        print("Missing:",os.path.join(a.w2l,"inference.py"))
+        sys.exit(1)
+    if not os.path.exists(a.ckpt):
+        print("Missing checkpoint:",a.ckpt)
+        sys.exit(1)
+    if len(a.pads.strip().split())!=4:
+        print("Bad --pads. Need 4 ints like: '0 10 0 0'")
+        sys.exit(1)
+    jobs=load_jobs(a)
+    eng=None
+    if a.engine=="inproc":
+        from pipeline.w2l_engine import load_engine
+        eng=load_engine(a.w2l,a.ckpt,a.device,a.bs,a.fbs)
+    for j in jobs:
+        with span("lipsync_clip","stage",vid=j["vid"]):
+            lipsync_clip(a,eng,j["vid"],j["aud"],j["out"],j.get("tts",""),j.get("root",""))
+
+if __name__=="__main__":
+    main()
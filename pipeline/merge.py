@@ -7,6 +7,10 @@ Usage:
     --clip data/interim/clip/clip.mp4 \
     --out  data/processed/dubbed.mp4 \
     --sr   16000
+
+--mixer ffmpeg (default) keeps the original single amix graph with one
+input per segment. --mixer numpy overlays the segments in-process and pipes
+the mixed track straight into the final mux.
 """
 
 import argparse
@@ -15,6 +19,13 @@ import os
 import subprocess
 import sys
 import struct
+import tempfile
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from pipeline.audio_master import mix_to_stream
+from utils.metrics import span
 
 p = argparse.ArgumentParser()
 p.add_argument("--tts", required=True, help="TTS manifest JSON")
@@ -23,14 +34,17 @@ p.add_argument("--out", required=True, help="Output dubbed video")
 p.add_argument("--sr", type=int, default=16000, help="Audio sample rate")
 p.add_argument("--bg_vol", type=float, default=0.08,
                help="Volume of original audio kept as background (0=mute, 1=full)")
+p.add_argument("--mixer", default="ffmpeg", choices=["numpy", "ffmpeg"],
+               help="numpy: in-process timeline mix piped to the mux; ffmpeg: amix graph")
 args = p.parse_args()
 
 
 def get_duration(path):
-    r = subprocess.run(
-        ["ffprobe", "-v", "error", "-show_entries", "format=duration",
-         "-of", "default=nw=1:nk=1", path],
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    with span("ffprobe", "proc"):
+        r = subprocess.run(
+            ["ffprobe", "-v", "error", "-show_entries", "format=duration",
+             "-of", "default=nw=1:nk=1", path],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     return float(r.stdout.decode().strip())
 
 
@@ -57,84 +71,88 @@ clip_dur = get_duration(args.clip)
 print(f"Clip duration: {clip_dur:.3f}s  |  TTS segments: {len(segs)}")
 
 # ── Build a full-length dubbed audio track ──────────────────────────────
-# Strategy: create silence WAV of clip length, then overlay each TTS
+# numpy: overlay each segment into a chunked float32 timeline at its start
+# sample (pipeline/audio_master.py), limit in place, pipe s16le to the mux.
+# ffmpeg: create silence WAV of clip length, then overlay each TTS
 # segment at its start time using ffmpeg amix / adelay.
 
-tmp_dir = "data/interim/merge_tmp"
-os.makedirs(tmp_dir, exist_ok=True)
 
-# Create base silence track
-base_wav = os.path.join(tmp_dir, "base_silence.wav")
-make_silence_wav(base_wav, clip_dur, args.sr)
+def mix_with_ffmpeg():
+    """Original path: silence base plus one adelay/apad input per segment."""
+    tmp_dir = "data/interim/merge_tmp"
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    # Create base silence track
+    base_wav = os.path.join(tmp_dir, "base_silence.wav")
+    make_silence_wav(base_wav, clip_dur, args.sr)
 
-# Build ffmpeg filter to overlay all segments
-inputs = ["-i", base_wav]  # input 0 = silence base
-filter_parts = []
+    # Build ffmpeg filter to overlay all segments
+    inputs = ["-i", base_wav]  # input 0 = silence base
+    filter_parts = []
 
-for idx, seg in enumerate(segs):
-    wav_path = seg["wav"]
-    start_ms = int(seg["start"] * 1000)
-    inp_idx = idx + 1
-    inputs.extend(["-i", wav_path])
-    # Delay each segment to its start time, pad to fill rest
+    for idx, seg in enumerate(segs):
+        wav_path = seg["wav"]
+        start_ms = int(seg["start"] * 1000)
+        inp_idx = idx + 1
+        inputs.extend(["-i", wav_path])
+        # Delay each segment to its start time, pad to fill rest
+        filter_parts.append(
+            f"[{inp_idx}]adelay={start_ms}|{start_ms},apad=whole_dur={clip_dur}[d{idx}]"
+        )
+
+    # Mix all delayed segments with the base
+    mix_inputs = "[0]" + "".join(f"[d{i}]" for i in range(len(segs)))
     filter_parts.append(
-        f"[{inp_idx}]adelay={start_ms}|{start_ms},apad=whole_dur={clip_dur}[d{idx}]"
+        f"{mix_inputs}amix=inputs={len(segs) + 1}:duration=first:normalize=0,volume=1.00,alimiter=limit=0.95[out]"
     )
 
-# Mix all delayed segments with the base
-mix_inputs = "[0]" + "".join(f"[d{i}]" for i in range(len(segs)))
-filter_parts.append(
-    f"{mix_inputs}amix=inputs={len(segs) + 1}:duration=first:normalize=0,volume=1.00,alimiter=limit=0.95[out]"
-)
-
-filter_str = ";\n".join(filter_parts)
-
-dubbed_audio = os.path.join(tmp_dir, "dubbed_audio.wav")
-cmd = ["ffmpeg", "-y"] + inputs + [
-    "-filter_complex", filter_str,
-    "-map", "[out]",
-    "-ac", "1", "-ar", str(args.sr),
-    dubbed_audio
-]
-
-print("Mixing TTS segments...")
-r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-if r.returncode != 0:
-    print("ffmpeg mix failed:")
-    print(r.stderr.decode("utf-8", errors="ignore"))
-    sys.exit(1)
-print(f"  Mixed audio: {dubbed_audio} ({get_duration(dubbed_audio):.3f}s)")
+    filter_str = ";\n".join(filter_parts)
 
-# ── Combine with video ──────────────────────────────────────────────────
-out_dir = os.path.dirname(args.out)
-if out_dir:
-    os.makedirs(out_dir, exist_ok=True)
-
-if args.bg_vol > 0:
-    # Keep original audio at low volume as background
-    print(f"Merging with original audio (bg_vol={args.bg_vol})...")
-    cmd = [
-        "ffmpeg", "-y",
-        "-i", args.clip,         # input 0: original video+audio
-        "-i", dubbed_audio,      # input 1: dubbed TTS audio
-        "-filter_complex",
-        f"[0:a]volume={args.bg_vol},aresample={args.sr}[bg];"
-        f"[1:a]aresample={args.sr}[fg];"
-        f"[bg][fg]amix=inputs=2:duration=first:normalize=0,alimiter=limit=0.95[aout]",
-        "-map", "0:v",
-        "-map", "[aout]",
-        "-c:v", "copy",
-        "-ac", "2", "-ar", "48000",
-        "-shortest",
-        args.out
+    dubbed_audio = os.path.join(tmp_dir, "dubbed_audio.wav")
+    cmd = ["ffmpeg", "-y"] + inputs + [
+        "-filter_complex", filter_str,
+        "-map", "[out]",
+        "-ac", "1", "-ar", str(args.sr),
+        dubbed_audio
     ]
-else:
+
+    print("Mixing TTS segments...")
+    with span("ffmpeg", "proc", what="amix"):
+        r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if r.returncode != 0:
+        print("ffmpeg mix failed:")
+        print(r.stderr.decode("utf-8", errors="ignore"))
+        sys.exit(1)
+    print(f"  Mixed audio: {dubbed_audio} ({get_duration(dubbed_audio):.3f}s)")
+    return dubbed_audio
+
+
+def mux_cmd(audio_in):
+    """ffmpeg command that maps the clip video with the dubbed audio input."""
+    if args.bg_vol > 0:
+        # Keep original audio at low volume as background
+        print(f"Merging with original audio (bg_vol={args.bg_vol})...")
+        return [
+            "ffmpeg", "-y",
+            "-i", args.clip,         # input 0: original video+audio
+        ] + audio_in + [             # input 1: dubbed TTS audio
+            "-filter_complex",
+            f"[0:a]volume={args.bg_vol},aresample={args.sr}[bg];"
+            f"[1:a]aresample={args.sr}[fg];"
+            f"[bg][fg]amix=inputs=2:duration=first:normalize=0,alimiter=limit=0.95[aout]",
+            "-map", "0:v",
+            "-map", "[aout]",
+            "-c:v", "copy",
+            "-ac", "2", "-ar", "48000",
+            "-shortest",
+            args.out
+        ]
     # Replace audio entirely
     print("Replacing audio track...")
-    cmd = [
+    return [
         "ffmpeg", "-y",
         "-i", args.clip,
-        "-i", dubbed_audio,
+    ] + audio_in + [
         "-map", "0:v",
         "-map", "1:a",
         "-c:v", "copy",
@@ -143,10 +161,40 @@ else:
         args.out
     ]
 
-r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-if r.returncode != 0:
+
+# ── Combine with video ──────────────────────────────────────────────────
+out_dir = os.path.dirname(args.out)
+if out_dir:
+    os.makedirs(out_dir, exist_ok=True)
+
+if args.mixer == "ffmpeg":
+    dubbed_audio = mix_with_ffmpeg()
+    cmd = mux_cmd(["-i", dubbed_audio])
+    with span("ffmpeg", "proc", what="mux"):
+        r = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    rc = r.returncode
+    err = r.stderr
+else:
+    # Mix in-process and stream raw PCM into the mux; no intermediate WAV.
+    # stderr goes to a file so a chatty ffmpeg can never block the pipe.
+    print("Mixing TTS segments (numpy) into mux...")
+    cmd = mux_cmd(["-f", "s16le", "-ar", str(args.sr), "-ac", "1", "-i", "pipe:0"])
+    with tempfile.TemporaryFile() as ef, span("ffmpeg", "proc", what="mix + mux"):
+        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=ef)
+        try:
+            n = mix_to_stream(segs, clip_dur, args.sr, proc.stdin)
+            proc.stdin.close()
+        except BrokenPipeError:
+            n = 0
+        rc = proc.wait()
+        ef.seek(0)
+        err = ef.read()
+    if rc == 0:
+        print(f"  Mixed audio: {n / args.sr:.3f}s streamed")
+
+if rc != 0:
     print("ffmpeg merge failed:")
-    print(r.stderr.decode("utf-8", errors="ignore"))
+    print(err.decode("utf-8", errors="ignore"))
     sys.exit(1)
 
 final_dur = get_duration(args.out)
@@ -1,7 +1,21 @@
 import argparse
 import json
+import os
 import re
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.cache_utils import cache_key, file_fingerprint
 from utils.ffmpeg_utils import ensure_parent_dir, require_cmd, run_capture
+from utils.metrics import span
+
+# Bump when scoring changes so persisted series are recomputed.
+SCORE_VERSION = 2
 def get_duration_seconds(video_path):
     require_cmd("ffprobe")
     cmd = [
@@ -56,6 +70,253 @@ def find_raw_cut_times(video_path, threshold):
     return times
 
 
+def probe_video(video_path):
+    """Return (width, height, fps) of the first video stream."""
+    require_cmd("ffprobe")
+    cmd = [
+        "ffprobe",
+        "-v",
+        "error",
+        "-select_streams",
+        "v:0",
+        "-show_entries",
+        "stream=width,height,avg_frame_rate,r_frame_rate",
+        "-of",
+        "json",
+        video_path,
+    ]
+    out, err = run_capture(cmd)
+    streams = json.loads(out).get("streams", [])
+    if not streams:
+        raise RuntimeError("No video stream in: " + video_path)
+    st = streams[0]
+    fps = 0.0
+    for k in ["avg_frame_rate", "r_frame_rate"]:
+        num, _, den = str(st.get(k, "0/0")).partition("/")
+        if float(den or 1) > 0 and float(num or 0) > 0:
+            fps = float(num) / float(den or 1)
+            break
+    if fps <= 0:
+        raise RuntimeError("ffprobe did not return a frame rate")
+    return int(st["width"]), int(st["height"]), fps
+
+
+def count_frames(video_path):
+    """Frames in the first video stream, from its packet count (nothing is decoded)."""
+    require_cmd("ffprobe")
+    out, err = run_capture(["ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets", "-show_entries", "stream=nb_read_packets", "-of", "csv=p=0", video_path])
+    return int(out.strip().split(",")[0])
+
+
+def frame_times(video_path):
+    """Presentation time of every frame of the first video stream, from packet pts (nothing is decoded).
+
+    Times are relative to the file's start_time, as ffmpeg's filters see
+    them without -copyts; packets an edit list discards are skipped.
+    """
+    require_cmd("ffprobe")
+    out, err = run_capture(["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", video_path])
+    pts = []
+    for line in out.splitlines():
+        t, _, fl = line.strip().partition(",")
+        if t and t != "N/A" and "D" not in fl:
+            pts.append(float(t))
+    out, err = run_capture(["ffprobe", "-v", "error", "-show_entries", "format=start_time", "-of", "default=noprint_wrappers=1:nokey=1", video_path])
+    try:
+        start = float(out.strip())
+    except ValueError:
+        start = 0.0
+    return np.sort(np.array(pts, dtype=np.float64)) - start
+
+
+def kept_times(video_path, n, skip, fps):
+    """Times of the n frames a select='not(mod(n,skip))' score pipe kept.
+
+    Taken from the video's own pts, so variable frame rate sources and
+    non-zero start times line up with ffmpeg mode; falls back to
+    index * skip / fps when the packets do not cover the decoded frames.
+    """
+    skip = max(int(skip), 1)
+    t = frame_times(video_path)[::skip]
+    if len(t) >= n:
+        return t[:n]
+    print("Scene scores: packet pts cover", len(t), "of", n, "kept frames; assuming a constant frame rate")
+    return np.arange(n, dtype=np.float64) * (skip / fps)
+
+
+def score_frames(frames, prev, prev_mafd):
+    """ffmpeg's scene score for a block of gray frames, vectorized.
+
+    mafd is the mean absolute frame difference in percent of full scale and
+    score = clip(min(mafd, |mafd - previous mafd|) / 100, 0, 1), the same
+    formula the select filter's scene variable uses. prev / prev_mafd carry
+    the state from the previous block (None for the first block).
+    """
+    f = frames.astype(np.int16)
+    if prev is None:
+        d = np.abs(f[1:] - f[:-1])
+        mafd = np.concatenate([[0.0], d.reshape(len(d), -1).mean(axis=1) * 100.0 / 256.0])
+        pm = 0.0
+    else:
+        d = np.abs(f - np.concatenate([prev[None].astype(np.int16), f[:-1]]))
+        mafd = d.reshape(len(d), -1).mean(axis=1) * 100.0 / 256.0
+        pm = prev_mafd
+    diff = np.abs(mafd - np.concatenate([[pm], mafd[:-1]]))
+    score = np.clip(np.minimum(mafd, diff) / 100.0, 0.0, 1.0)
+    if prev is None:
+        score[0] = 0.0
+    return score, frames[-1], float(mafd[-1])
+
+
+def scene_scores(video_path, width=160, skip=1, block=256):
+    """Decode a downscaled gray stream over a pipe and score every kept frame.
+
+    Only every skip-th frame is decoded into the pipe. Returns (times, scores)
+    as float64 seconds and float32 scores, one entry per kept frame.
+    """
+    require_cmd("ffmpeg")
+    w, h, fps = probe_video(video_path)
+    sw, sh = scaled_size(w, h, width)
+    vf = ""
+    if skip > 1:
+        vf = "select='not(mod(n,{0}))',".format(int(skip))
+    vf += "scale={0}:{1}:flags=area,format=gray".format(sw, sh)
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-loglevel",
+        "error",
+        "-i",
+        video_path,
+        "-an",
+        "-sn",
+        "-vf",
+        vf,
+        "-fps_mode",
+        "passthrough",
+        "-f",
+        "rawvideo",
+        "-pix_fmt",
+        "gray",
+        "-",
+    ]
+    # stderr to a file: ffmpeg must never block on it while we drain stdout
+    with tempfile.TemporaryFile() as ef, span("ffmpeg", "proc", what="scene scores"):
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=ef)
+        scores = read_score_pipe(proc.stdout, sw, sh, block)
+        proc.stdout.close()
+        rc = proc.wait()
+        ef.seek(0)
+        err = ef.read().decode("utf-8", errors="replace")
+    if rc != 0:
+        raise RuntimeError("ffmpeg scene score decode failed: " + video_path + "\n" + err)
+    return kept_times(video_path, len(scores), skip, fps), scores
+
+
+def scaled_size(w, h, width):
+    """Even-sized (width, height) for a gray score stream keeping the aspect."""
+    sw = max(int(width) // 2 * 2, 2)
+    sh = max(int(round(sw * h / float(w) / 2.0)) * 2, 2)
+    return sw, sh
+
+
+def read_score_pipe(stream, sw, sh, block=256):
+    """Score sw x sh gray rawvideo frames from a stream until EOF."""
+    fsz = sw * sh
+    parts = []
+    prev = None
+    pm = 0.0
+    while True:
+        buf = stream.read(fsz * block)
+        n = len(buf) // fsz
+        if n == 0:
+            break
+        frames = np.frombuffer(buf[:n * fsz], dtype=np.uint8).reshape(n, sh, sw)
+        sc, prev, pm = score_frames(frames, prev, pm)
+        parts.append(sc.astype(np.float32))
+    return np.concatenate(parts) if parts else np.zeros(0, dtype=np.float32)
+
+
+def find_raw_cut_times_fast(video_path, threshold, width=160, skip=1):
+    times, scores = scene_scores(video_path, width, skip)
+    return cut_times_from_series(times, scores, threshold)
+
+
+def ffmpeg_scene_scores(video_path):
+    """Full-resolution scene score of every frame from ffmpeg's select/metadata filters."""
+    require_cmd("ffmpeg")
+    cmd = [
+        "ffmpeg",
+        "-hide_banner",
+        "-i",
+        video_path,
+        "-filter:v",
+        "select='gte(scene,0)',metadata=print",
+        "-an",
+        "-f",
+        "null",
+        "-",
+    ]
+    out, err = run_capture(cmd)
+    times = []
+    scores = []
+    t = None
+    for line in err.splitlines():
+        m = re.search(r"pts_time:([0-9]+(?:\.[0-9]+)?)", line)
+        if m:
+            t = float(m.group(1))
+            continue
+        m = re.search(r"lavfi\.scene_score=([0-9]+(?:\.[0-9]+)?)", line)
+        if m and t is not None:
+            times.append(t)
+            scores.append(float(m.group(1)))
+            t = None
+    return np.array(times, dtype=np.float64), np.array(scores, dtype=np.float32)
+
+
+def cut_times_from_series(times, scores, threshold):
+    keep = (scores > threshold) & (times > 0.01)
+    return [round(float(t), 6) for t in times[keep]]
+
+
+def score_series_path(video_path, mode, width, skip, cache_dir):
+    """Where the score series for this video and scoring settings lives."""
+    if mode == "fast":
+        key = cache_key(file_fingerprint(video_path), mode, int(width), int(skip), SCORE_VERSION)
+    else:
+        key = cache_key(file_fingerprint(video_path), mode, SCORE_VERSION)
+    return os.path.join(cache_dir, key + ".npz")
+
+
+def save_score_series(path, duration, times, scores):
+    ensure_parent_dir(path)
+    tmp = path[:-4] + ".tmp.npz"
+    np.savez(tmp, duration=np.float64(duration), times=np.asarray(times, dtype=np.float64), scores=np.asarray(scores, dtype=np.float32))
+    os.replace(tmp, path)
+
+
+def load_score_series(video_path, mode, width, skip, cache_dir):
+    """Per-frame scene scores for a video, computed once and kept on disk.
+
+    The series is keyed by the video's fingerprint and the scoring settings,
+    so any later threshold or min_scene_len is answered without decoding.
+    Returns (duration, times, scores).
+    """
+    path = score_series_path(video_path, mode, width, skip, cache_dir) if cache_dir else ""
+    if path and os.path.exists(path):
+        d = np.load(path)
+        return float(d["duration"]), d["times"], d["scores"]
+    duration = get_duration_seconds(video_path)
+    with span("scene_scores", "model", mode=mode):
+        if mode == "fast":
+            times, scores = scene_scores(video_path, width, skip)
+        else:
+            times, scores = ffmpeg_scene_scores(video_path)
+    if path:
+        save_score_series(path, duration, times, scores)
+    return duration, times, scores
+
+
 def merge_close_times(times, window_seconds):
     merged = []
     for t in times:
@@ -105,9 +366,18 @@ def build_scenes(duration, cut_times, min_scene_len):
 
     return scenes
 
-def detect_scenes(input_video, output_json, threshold, min_scene_len):
-    duration = get_duration_seconds(input_video)
-    raw_times = find_raw_cut_times(input_video, threshold)
+def detect_scenes(input_video, output_json, threshold, min_scene_len, mode="ffmpeg", width=160, skip=1, cache_dir=""):
+    if mode not in ["ffmpeg", "fast"]:
+        raise RuntimeError("Bad scene mode: " + str(mode))
+    if cache_dir:
+        duration, times, scores = load_score_series(input_video, mode, width, skip, cache_dir)
+        raw_times = cut_times_from_series(times, scores, threshold)
+    elif mode == "fast":
+        duration = get_duration_seconds(input_video)
+        raw_times = find_raw_cut_times_fast(input_video, threshold, width, skip)
+    else:
+        duration = get_duration_seconds(input_video)
+        raw_times = find_raw_cut_times(input_video, threshold)
     cut_times = merge_close_times(raw_times, window_seconds=0.30)
     scenes = build_scenes(duration, cut_times, min_scene_len)
     ensure_parent_dir(output_json)
@@ -120,8 +390,12 @@ def main():
     parser.add_argument("--output", required=True)
     parser.add_argument("--threshold", type=float, default=0.30)
     parser.add_argument("--min_scene_len", type=float, default=0.80)
+    parser.add_argument("--mode", default="ffmpeg", choices=["ffmpeg", "fast"])
+    parser.add_argument("--width", type=int, default=160)
+    parser.add_argument("--skip", type=int, default=1)
+    parser.add_argument("--cache_dir", default="data/cache/scenes", help="per-frame score series store ('' to disable)")
     args = parser.parse_args()
-    scenes = detect_scenes(args.input, args.output, args.threshold, args.min_scene_len)
+    scenes = detect_scenes(args.input, args.output, args.threshold, args.min_scene_len, args.mode, args.width, args.skip, args.cache_dir)
     print("Saved scenes:", len(scenes))
     print("Output:", args.output)
 
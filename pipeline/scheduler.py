@@ -0,0 +1,204 @@
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from pipeline import tts_engine, translation
+from pipeline.alignment import (asr_row, assign_words, load_json, open_clip_audio, pick_bin, pick_server_bin, plan_windows, pool_one,
+                                server_queue, start_whisper_servers, stop_whisper_servers, transcribe_one, transcribe_window)
+from utils.ffmpeg_utils import ensure_parent_dir
+from utils.gpu_utils import split_cores
+
+
+def write_json(path, d, ascii=True):
+    ensure_parent_dir(path)
+    f = open(path, "w", encoding="utf-8")
+    json.dump(d, f, indent=2, ensure_ascii=ascii)
+    f.close()
+
+
+async def run_stream(units, asr_fn, asr_n, tr_fn, tr_ex, tr_batch, tts_fn, tts_ex, tts_n, qsize):
+    """Push units through ASR -> translation -> TTS with bounded queues between them.
+
+    asr_n threads take units in order and put their rows on the first queue;
+    one translation worker drains up to tr_batch rows at a time on tr_ex;
+    tts_n workers render on tts_ex. A full queue blocks the stage before it, so
+    no stage runs more than qsize items ahead. Returns the rows of each
+    stage in completion order plus timings.
+    """
+    loop = asyncio.get_running_loop()
+    q1 = asyncio.Queue(qsize)
+    q2 = asyncio.Queue(qsize)
+    asr_ex = ThreadPoolExecutor(max_workers=asr_n)
+    out = {"asr": [], "tr": [], "tts": []}
+    busy = {"asr": 0.0, "tr": 0.0, "tts": 0.0}
+    t0 = time.time()
+    first = []
+    it = iter(units)
+
+    async def timed(stage, ex, fn, x):
+        t = time.time()
+        r = await loop.run_in_executor(ex, fn, x)
+        busy[stage] += time.time() - t
+        return r
+
+    async def asr_worker():
+        for u in it:
+            for r in await timed("asr", asr_ex, asr_fn, u):
+                out["asr"].append(r)
+                await q1.put(r)
+
+    async def asr_stage():
+        await asyncio.gather(*[asr_worker() for _ in range(asr_n)])
+        await q1.put(None)
+
+    async def tr_stage():
+        done = False
+        while not done:
+            x = await q1.get()
+            if x is None:
+                break
+            batch = [x]
+            while len(batch) < tr_batch and not q1.empty():
+                y = q1.get_nowait()
+                if y is None:
+                    done = True
+                    break
+                batch.append(y)
+            for r in await timed("tr", tr_ex, tr_fn, batch):
+                out["tr"].append(r)
+                await q2.put(r)
+        for _ in range(tts_n):
+            await q2.put(None)
+
+    async def tts_worker():
+        while True:
+            x = await q2.get()
+            if x is None:
+                return
+            r = await timed("tts", tts_ex, tts_fn, x)
+            out["tts"].append(r)
+            if not first:
+                first.append(time.time() - t0)
+                print("Pipelined: first dubbed segment after", round(first[0], 2), "s")
+
+    try:
+        await asyncio.gather(asr_stage(), tr_stage(), *[tts_worker() for _ in range(tts_n)])
+    finally:
+        asr_ex.shutdown(wait=True)
+    out["secs"] = time.time() - t0
+    out["first"] = first[0] if first else 0.0
+    out["busy"] = busy
+    return out
+
+
+def asr_units(cfg, a, sr, segs):
+    """Split ASR into independent units and return (units, fn, threads, servers).
+
+    segment and pool modes make one unit per segment. clip mode makes one
+    unit per asr.window; its words are assigned within the window, so words
+    spilling past a window edge are not offered to the next window's segments.
+    """
+    asr = cfg.get("asr", {})
+    mode = asr.get("mode", "segment")
+    lang = asr["lang"]
+    model = asr["model"]
+    task = asr.get("task", "transcribe")
+    no_gpu = bool(asr.get("no_gpu", False))
+    prompt = (asr.get("prompt", "") or "").strip()
+    window = float(asr.get("window", 0) or 0)
+    n, t = split_cores(int(asr.get("workers", 0) or 0), int(asr.get("threads", 0) or 0))
+    wav_path = cfg["paths"]["clip_audio"]
+    if mode == "segment":
+        b = pick_bin(asr["bin"])
+        return [[seg] for seg in segs], lambda u: [transcribe_one(u[0], a, sr, b, model, lang, task, no_gpu, prompt, True)], n, []
+    if mode == "clip":
+        b = pick_bin(asr["bin"])
+        if window <= 0:
+            print("Pipelined: asr.window is 0, so ASR is one unit and translation waits for all of it")
+
+        def clip_fn(win):
+            texts = assign_words(transcribe_window(win, wav_path, a, sr, b, model, lang, task, no_gpu, prompt, True, window), win)
+            return [asr_row(seg, re.sub(r"\s+", " ", texts.get(int(seg["id"]), "")).strip()) for seg in win]
+        return plan_windows(segs, window), clip_fn, (n if window > 0 else 1), []
+    if mode != "pool":
+        raise RuntimeError("Bad asr mode: " + str(mode))
+    print("ASR pool:", n, "workers x", t, "threads")
+    servers = start_whisper_servers(pick_server_bin(asr.get("server_bin", "auto")), model, lang, task, n, t, no_gpu)
+    free = server_queue(servers)
+
+    def pool_fn(u):
+        seg = u[0]
+        if int(float(seg["end"]) * sr) <= int(float(seg["start"]) * sr):
+            return [asr_row(seg, "")]
+        return [asr_row(seg, re.sub(r"\s+", " ", pool_one(seg, a, sr, free, lang, task, prompt, True)[1]).strip())]
+    return [[seg] for seg in segs], pool_fn, len(servers), servers
+
+
+def run_pipelined(cfg, config_path):
+    """Produce asr_json, tr_json and tts_json with the three stages overlapped.
+
+    The stage bodies are the same functions the sequential stages use; only
+    the order work is done in changes. Outputs are written in segment order
+    once everything has finished.
+    """
+    pt = cfg["paths"]
+    segs = load_json(pt["segments_json"])
+    a, sr = open_clip_audio(pt["clip_audio"])
+    tr = cfg.get("tr", {})
+    at = translation.apply_config(translation.build_parser().parse_args(["--inp", pt["asr_json"], "--out", pt["tr_json"], "--model", tr["model"], "--beams", str(tr.get("beams", 4)), "--max_len", str(tr.get("max_len", 256)), "--config", config_path]))
+    tts = cfg.get("tts", {})
+    args = ["--inp", pt["tr_json"], "--out", pt["tts_json"], "--ref", tts["ref"], "--model", tts["model"], "--lang", tts.get("lang", "hi"), "--sr", str(tts.get("sr", 16000)), "--workers", str(tts.get("workers", 1)), "--threads", str(tts.get("threads", 0)), "--cond_cache", tts.get("cond_cache", "data/cache/xtts"), "--redo"]
+    if tts.get("gpu"):
+        args.append("--gpu")
+    ats = tts_engine.build_parser().parse_args(args)
+    # sqlite connections stay on the thread that opened them, so the model
+    # and cache are opened on the translation thread
+    mt = {}
+
+    def tr_open():
+        mt["mt"] = translation.load_mt(at)
+        mt["cc"] = translation.open_cache(at.cache, at.cache_mb * 1024 * 1024)
+
+    def tr_fn(rows):
+        mt["ld"].result()
+        hs = translation.translate_cached(mt["mt"], mt["cc"], at, [(r.get("text") or "").strip() for r in rows])
+        return [translation.tr_row(r, hs) for r in rows]
+
+    def tr_close():
+        if "cc" in mt:
+            translation.print_cache(mt["cc"], at)
+            translation.close_cache(mt["cc"])
+
+    n, t = split_cores(ats.workers, ats.threads)
+    n = min(n, max(len(segs), 1))
+    if n > 1:
+        print("TTS pool:", n, "workers x", t, "threads")
+    tts_ex = tts_engine.open_pool(ats, n, t if n > 1 else ats.threads)
+    tr_ex = ThreadPoolExecutor(max_workers=1)
+    # start loading the MT and TTS models now so it overlaps the first ASR units
+    mt["ld"] = tr_ex.submit(tr_open)
+    for _ in range(n):
+        tts_ex.submit(os.getpid)
+    qsize = int(cfg.get("run", {}).get("queue", 8) or 8)
+    servers = []
+    try:
+        units, asr_fn, asr_n, servers = asr_units(cfg, a, sr, segs)
+        r = asyncio.run(run_stream(units, asr_fn, asr_n, tr_fn, tr_ex, at.batch, tts_engine.render_item, tts_ex, n, qsize))
+    finally:
+        tr_ex.submit(tr_close).result()
+        tr_ex.shutdown(wait=True)
+        tts_ex.shutdown(wait=True)
+        stop_whisper_servers(servers)
+    write_json(pt["asr_json"], sorted(r["asr"], key=lambda x: x["id"]))
+    write_json(pt["tr_json"], sorted(r["tr"], key=lambda x: x["id"]), False)
+    write_json(pt["tts_json"], sorted(r["tts"], key=lambda x: x["id"]), False)
+    b = r["busy"]
+    print("Pipelined:", len(r["tts"]), "segments in", round(r["secs"], 2), "s, first after", round(r["first"], 2), "s, busy asr", round(b["asr"], 2), "tr", round(b["tr"], 2), "tts", round(b["tts"], 2))
+    return r
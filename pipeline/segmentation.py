@@ -1,30 +1,23 @@
 import argparse
 import json
 import os
-import wave
+import sys
 import numpy as np
-import torch
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from pipeline.vad import load_prob_track, probs_to_timestamps
+from utils.audio_utils import open_wav, wav_slice
 from utils.ffmpeg_utils import ensure_parent_dir
+from utils.metrics import span
 
 def read_wav(path):
-    if not os.path.exists(path):
-        raise RuntimeError("Missing wav: " + path)
-    w = wave.open(path, "rb")
-    ch = w.getnchannels()
-    sr = w.getframerate()
-    sw = w.getsampwidth()
-    n = w.getnframes()
-    raw = w.readframes(n)
-    w.close()
-    if sw != 2:
-        raise RuntimeError("Expected 16-bit PCM wav, got sampwidth=" + str(sw))
-    data = np.frombuffer(raw, dtype=np.int16)
-    if ch == 2:
-        data = data.reshape(-1, 2).mean(axis=1)
-    elif ch != 1:
-        raise RuntimeError("Expected 1 or 2 channels, got " + str(ch))
-    audio = data.astype(np.float32) / 32768.0
-    return audio, sr
+    """Whole file as mono float32; only the torch.hub VAD path needs this."""
+    w = open_wav(path)
+    if w["ch"] not in [1, 2]:
+        raise RuntimeError("Expected 1 or 2 channels, got " + str(w["ch"]))
+    return wav_slice(w, 0, w["n"], "float32"), w["sr"]
 
 def load_json(path):
     if not path or not os.path.exists(path):
@@ -35,6 +28,7 @@ def load_json(path):
     return data
 
 def load_vad():
+    import torch
     try:
         model, utils = torch.hub.load("snakers4/silero-vad", "silero_vad", force_reload=False, trust_repo=True)
     except TypeError:
@@ -44,9 +38,30 @@ def load_vad():
     return model, get_ts
 
 
-def scene_id(t, scenes):
+def scene_index(scenes):
+    """Sorted start/end arrays for searchsorted lookups.
+
+    Returns None unless scenes are ordered and non-overlapping (what
+    scene_detect writes); callers then fall back to the linear scan.
+    """
+    if not scenes:
+        return None
+    st = np.array([float(x["start"]) for x in scenes])
+    en = np.array([float(x["end"]) for x in scenes])
+    if np.any(st[1:] < en[:-1]):
+        return None
+    return {"start": st, "end": en, "cuts": en[:-1]}
+
+
+def scene_id(t, scenes, idx=None):
+    """Index of the scene containing t; the last scene if none does."""
     if not scenes:
         return 0
+    if idx is not None:
+        i = int(np.searchsorted(idx["start"], t, side="right")) - 1
+        if i >= 0 and t < idx["end"][i]:
+            return i
+        return len(scenes) - 1
     i = 0
     while i < len(scenes):
         s = scenes[i]
@@ -56,36 +71,28 @@ def scene_id(t, scenes):
     return len(scenes) - 1
 
 
-def split_on_scenes(segs, scenes):
+def split_on_scenes(segs, scenes, indexed=True):
     if not scenes:
         out = []
         for seg in segs:
             out.append({"start": seg["start"], "end": seg["end"], "scene": 0})
         return out
-    cuts = []
-    i = 0
-    while i < len(scenes) - 1:
-        cuts.append(float(scenes[i]["end"]))
-        i += 1
+    idx = scene_index(scenes) if indexed else None
+    cuts = [float(x["end"]) for x in scenes[:-1]]
     out = []
     for seg in segs:
         st = seg["start"]
         en = seg["end"]
-        pts = []
-        for c in cuts:
-            if c > st and c < en:
-                pts.append(c)
-        if not pts:
-            mid = (st + en) / 2.0
-            out.append({"start": st, "end": en, "scene": scene_id(mid, scenes)})
+        if idx is not None:
+            lo = int(np.searchsorted(idx["cuts"], st, side="right"))
+            hi = int(np.searchsorted(idx["cuts"], en, side="left"))
+            pts = cuts[lo:hi]
         else:
-            cur = st
-            for c in pts:
-                mid = (cur + c) / 2.0
-                out.append({"start": cur, "end": c, "scene": scene_id(mid, scenes)})
-                cur = c
-            mid = (cur + en) / 2.0
-            out.append({"start": cur, "end": en, "scene": scene_id(mid, scenes)})
+            pts = [c for c in cuts if c > st and c < en]
+        cur = st
+        for c in pts + [en]:
+            out.append({"start": cur, "end": c, "scene": scene_id((cur + c) / 2.0, scenes, idx)})
+            cur = c
     return out
 
 
@@ -104,14 +111,43 @@ def merge_by_gap(segs, gap, max_len):
     return out
 
 
-def force_split_long(segs, max_len, wav, sr):
-    """Split any segment longer than max_len at the lowest-energy point."""
+def energy_prefix(w, s0, s1):
+    """Exact int64 running sum of squared samples over [s0, s1), with a leading 0.
+
+    Stereo is summed across channels (2x the mono mix, so energy ordering is
+    unchanged). Any window's energy is then one subtraction.
+    """
+    x = w["pcm"][s0:s1].astype(np.int64).sum(axis=1)
+    c = np.zeros(len(x) + 1, dtype=np.int64)
+    np.cumsum(x * x, out=c[1:])
+    return c
+
+
+def quietest_frame(c, base, search_start, search_end, frame, hop):
+    """Start of the first lowest-energy frame at search_start + k * hop."""
+    i = np.arange(search_start, search_end - frame + 1, hop) - base
+    e = c[i + frame] - c[i]
+    return search_start + int(np.argmin(e)) * hop
+
+
+def force_split_long(segs, max_len, w):
+    """Split any segment longer than max_len at the lowest-energy point.
+
+    w is an open_wav reader. One energy prefix is built per long segment and
+    shared by its recursive splits, so memory tracks the longest segment
+    rather than the file.
+    """
+    sr = w["sr"]
+    frame = int(0.05 * sr)  # 50ms
+    hop = frame // 2  # 25ms
     out = []
     for seg in segs:
         dur = seg["end"] - seg["start"]
         if dur <= max_len:
             out.append(seg)
             continue
+        base = int(seg["start"] * sr)
+        c = energy_prefix(w, base, int(seg["end"] * sr))
         # recursively split at the quietest point
         stack = [seg]
         while stack:
@@ -125,21 +161,11 @@ def force_split_long(segs, max_len, wav, sr):
             s1 = int(s["end"] * sr)
             margin = int((s1 - s0) * 0.10)
             search_start = s0 + margin
-            search_end = s1 - margin
-            frame = int(0.05 * sr)  # 50ms
+            search_end = min(s1 - margin, base + len(c) - 1)
             if search_end - search_start < frame:
                 out.append(s)
                 continue
-            best_e = float("inf")
-            best_i = (search_start + search_end) // 2
-            i = search_start
-            while i + frame <= search_end:
-                chunk = wav[i:i + frame]
-                e = float(np.sum(chunk * chunk))
-                if e < best_e:
-                    best_e = e
-                    best_i = i
-                i += frame // 2  # 25ms hop
+            best_i = quietest_frame(c, base, search_start, search_end, frame, hop)
             split_t = round(best_i / sr, 3)
             left = {"start": s["start"], "end": split_t, "scene": s["scene"]}
             right = {"start": split_t, "end": s["end"], "scene": s["scene"]}
@@ -149,23 +175,41 @@ def force_split_long(segs, max_len, wav, sr):
     return out
 
 
-def make_segments(wav_path, scenes_path, out_json, th, min_sp, min_sil, pad, min_len, max_len, gap):
-    wav, sr = read_wav(wav_path)
+def make_segments(wav_path, scenes_path, out_json, th, min_sp, min_sil, pad, min_len, max_len, gap, vad_model="", lanes=8, block=64, cache_dir="", warm=32):
+    """Speech segments from VAD, split on scene cuts, merged and length-capped.
+
+    With vad_model set, VAD runs offline from that local .jit/.onnx file in
+    streaming batched lanes (pipeline/vad.py), and with cache_dir its
+    probability track is reused so only the thresholds and lengths are
+    re-applied. lanes and warm change the probabilities slightly (each lane
+    starts from a state warmed on warm frames before it); otherwise Silero is loaded through torch.hub and run over
+    the whole array.
+    """
+    w = open_wav(wav_path)
+    sr = w["sr"]
     if sr != 16000:
         raise RuntimeError("Expected 16000 Hz wav, got " + str(sr) + ". Re-extract clip.wav at 16k.")
     scenes = load_json(scenes_path)
-    model, get_ts = load_vad()
-    x = torch.from_numpy(wav)
-    ts = get_ts(x, model, sampling_rate=sr, threshold=th, min_speech_duration_ms=min_sp, min_silence_duration_ms=min_sil, speech_pad_ms=pad)
+    if vad_model:
+        probs, n, sr = load_prob_track(vad_model, wav_path, lanes, block, cache_dir, warm)
+        ts = probs_to_timestamps(probs, n, sr, th, min_sp, min_sil, pad)
+    else:
+        with span("vad", "model", hub=True):
+            wav, sr = read_wav(wav_path)
+            model, get_ts = load_vad()
+            import torch
+            x = torch.from_numpy(wav)
+            ts = get_ts(x, model, sampling_rate=sr, threshold=th, min_speech_duration_ms=min_sp, min_silence_duration_ms=min_sil, speech_pad_ms=pad)
     raw = []
     for t in ts:
         st = float(t["start"]) / float(sr)
         en = float(t["end"]) / float(sr)
         if en > st:
             raw.append({"start": round(st, 3), "end": round(en, 3)})
-    segs = split_on_scenes(raw, scenes)
-    segs = merge_by_gap(segs, gap, max_len)
-    segs = force_split_long(segs, max_len, wav, sr)
+    with span("split", "io", speech=len(raw)):
+        segs = split_on_scenes(raw, scenes)
+        segs = merge_by_gap(segs, gap, max_len)
+        segs = force_split_long(segs, max_len, w)
     final = []
     i = 0
     for seg in segs:
@@ -189,11 +233,67 @@ def make_segments(wav_path, scenes_path, out_json, th, min_sp, min_sil, pad, min
     return final
 
 
+def bench(hours, n_scenes, max_len=4.0, gap=0.35):
+    """Time the scene split and long-segment split on synthetic VAD output.
+
+    Writes hours of modulated noise to a temp 16 kHz wav, draws speech spans
+    and n_scenes contiguous scenes, and checks the indexed scene split
+    against the linear scan.
+    """
+    import tempfile
+    import time
+    import wave
+    sr = 16000
+    total = hours * 3600.0
+    rng = np.random.default_rng(0)
+    cuts = np.sort(rng.uniform(0, total, n_scenes - 1))
+    bounds = [0.0] + [round(float(c), 3) for c in cuts] + [round(total, 3)]
+    scenes = [{"start": bounds[i], "end": bounds[i + 1]} for i in range(n_scenes)]
+    raw = []
+    t = 0.0
+    while t < total:
+        st = t + float(rng.uniform(0.1, 1.5))
+        en = min(st + float(rng.uniform(0.3, 8.0)), total)
+        if en > st:
+            raw.append({"start": round(st, 3), "end": round(en, 3)})
+        t = en
+    tmp = tempfile.mkdtemp()
+    wav_path = os.path.join(tmp, "bench.wav")
+    f = wave.open(wav_path, "wb")
+    f.setnchannels(1)
+    f.setsampwidth(2)
+    f.setframerate(sr)
+    for k in range(int(total // 60) + 1):
+        n = int(min(60.0, total - k * 60.0) * sr)
+        if n <= 0:
+            break
+        env = 0.5 + 0.5 * np.sin(np.arange(n) / sr * 2.3 + k)
+        f.writeframes((rng.standard_normal(n) * 3000 * env).astype("<i2").tobytes())
+    f.close()
+    print("speech spans:", len(raw), "scenes:", n_scenes)
+    t0 = time.time()
+    ref = split_on_scenes(raw, scenes, indexed=False)
+    print("split_on_scenes linear", round(time.time() - t0, 3), "s")
+    t0 = time.time()
+    segs = split_on_scenes(raw, scenes)
+    print("split_on_scenes indexed", round(time.time() - t0, 3), "s")
+    if segs != ref:
+        raise RuntimeError("Indexed scene split differs from the linear scan")
+    segs = merge_by_gap(segs, gap, max_len)
+    w = open_wav(wav_path)
+    t0 = time.time()
+    out = force_split_long(segs, max_len, w)
+    print("force_split_long", round(time.time() - t0, 3), "s", "segments:", len(out))
+    del w
+    os.remove(wav_path)
+    os.rmdir(tmp)
+
+
 def main():
     p = argparse.ArgumentParser()
-    p.add_argument("--wav", required=True)
+    p.add_argument("--wav", default="")
     p.add_argument("--scenes", default="")
-    p.add_argument("--out", required=True)
+    p.add_argument("--out", default="")
     p.add_argument("--th", type=float, default=0.5)
     p.add_argument("--min_sp", type=int, default=250)
     p.add_argument("--min_sil", type=int, default=200)
@@ -201,8 +301,20 @@ def main():
     p.add_argument("--min_len", type=float, default=1.0)
     p.add_argument("--max_len", type=float, default=4.0)
     p.add_argument("--gap", type=float, default=0.35)
+    p.add_argument("--vad_model", default="", help="local Silero .jit/.onnx file (default: torch.hub)")
+    p.add_argument("--lanes", type=int, default=8)
+    p.add_argument("--warm", type=int, default=32, help="frames each lane runs before its part to settle the VAD state")
+    p.add_argument("--block", type=int, default=64)
+    p.add_argument("--cache_dir", default="", help="keep --vad_model probability tracks here")
+    p.add_argument("--bench", type=float, default=0, help="hours of synthetic VAD output: time the split steps and exit")
+    p.add_argument("--bench_scenes", type=int, default=3000)
     a = p.parse_args()
-    segs = make_segments(a.wav, a.scenes, a.out, a.th, a.min_sp, a.min_sil, a.pad, a.min_len, a.max_len, a.gap)
+    if a.bench > 0:
+        bench(a.bench, a.bench_scenes, a.max_len, a.gap)
+        return
+    if not a.wav or not a.out:
+        p.error("--wav and --out are required")
+    segs = make_segments(a.wav, a.scenes, a.out, a.th, a.min_sp, a.min_sil, a.pad, a.min_len, a.max_len, a.gap, a.vad_model, a.lanes, a.block, a.cache_dir, a.warm)
     print("Segments:", len(segs))
     print("Output:", a.out)
 
@@ -0,0 +1,254 @@
+"""
+Frame-exact H.264 splicing: whole closed GOPs are stream-copied, the rest
+is encoded with libx264 set up to match the source's SPS, and the pieces
+are joined as Annex B transport streams under a separate audio input.
+
+Frames are addressed by index into the source's presentation timestamps,
+read from packet headers, so nothing assumes a constant frame rate. Only
+keyframes that start a closed GOP are copy points. A splice is accepted
+only when every encoded piece probes with the source's SPS fields and the
+joined file decodes to the expected number of frames; callers fall back
+to a full re-encode otherwise.
+"""
+
+import json
+import os
+from bisect import bisect_left
+
+from utils.ffmpeg_utils import require_cmd, run, run_capture
+from utils.metrics import span
+
+X264_PROFILES = {"Constrained Baseline": "baseline", "Baseline": "baseline", "Main": "main", "High": "high", "High 10": "high10", "High 4:2:2": "high422", "High 4:4:4 Predictive": "high444"}
+
+# Stream fields that come from the SPS/VUI. A copied GOP and an encoded one
+# decode correctly back to back only when these agree.
+SPS_FIELDS = ["profile", "level", "refs", "pix_fmt", "width", "height", "sample_aspect_ratio", "color_range", "color_space", "color_transfer", "color_primaries", "chroma_location", "field_order"]
+
+# ffprobe field -> ffmpeg output option for the colour fields libx264 writes into the VUI.
+COLOR_OPTS = [("color_range", "-color_range"), ("color_space", "-colorspace"), ("color_transfer", "-color_trc"), ("color_primaries", "-color_primaries"), ("chroma_location", "-chroma_sample_location")]
+
+
+def probe_sps(path):
+    """codec_name and the SPS_FIELDS of the first video stream, as ffprobe reports them."""
+    out, err = run_capture(["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=codec_name," + ",".join(SPS_FIELDS), "-of", "json", path])
+    streams = json.loads(out).get("streams", [])
+    return streams[0] if streams else {}
+
+
+def sps_diff(ref, path):
+    """Names of the SPS_FIELDS where path's first video stream differs from ref (a probe_sps dict)."""
+    st = probe_sps(path)
+    return [k for k in SPS_FIELDS if str(st.get(k, "")) != str(ref.get(k, ""))]
+
+
+def match_args(ref, crf=18, preset="medium"):
+    """libx264 arguments reproducing ref's profile, level, refs, pix_fmt and colour description."""
+    enc = ["-c:v", "libx264", "-crf", str(crf), "-preset", preset]
+    if ref.get("pix_fmt"):
+        enc += ["-pix_fmt", ref["pix_fmt"]]
+    if ref.get("profile") in X264_PROFILES:
+        enc += ["-profile:v", X264_PROFILES[ref["profile"]]]
+    lv = int(ref.get("level", 0) or 0)
+    if lv > 0:
+        enc += ["-level:v", "{0}.{1}".format(lv // 10, lv % 10)]
+    if int(ref.get("refs", 0) or 0) > 0:
+        enc += ["-refs", str(ref["refs"])]
+    for k, opt in COLOR_OPTS:
+        v = ref.get(k)
+        if v and v != "unknown":
+            enc += [opt, v]
+    return enc
+
+
+def sar_filter(ref):
+    """setsar filter for frames that do not carry ref's aspect ratio themselves (raw pipes), or ""."""
+    sar = str(ref.get("sample_aspect_ratio", "") or "")
+    if not sar or sar in ["0:1", "N/A"]:
+        return ""
+    return "setsar=" + sar.replace(":", "/")
+
+
+def probe_packets(path, start=0.0, end=None, margin=20.0):
+    """Video packets as [(pts, key)] in decode order, with pts relative to the file start.
+
+    Reads packet headers only. With end set, only [start - margin, end +
+    margin] is read. Packets an edit list discards are left out.
+    """
+    cmd = ["ffprobe", "-v", "error", "-select_streams", "v:0"]
+    if end is not None:
+        cmd += ["-read_intervals", "{0:.3f}%{1:.3f}".format(max(start - margin, 0.0), end + margin)]
+    out, err = run_capture(cmd + ["-show_entries", "packet=pts_time,flags", "-of", "csv=p=0", path])
+    pk = []
+    for line in out.splitlines():
+        f = line.strip().split(",")
+        if len(f) >= 2 and f[0] not in ["", "N/A"] and "D" not in f[1]:
+            pk.append((float(f[0]), "K" in f[1]))
+    out, err = run_capture(["ffprobe", "-v", "error", "-show_entries", "format=start_time", "-of", "default=noprint_wrappers=1:nokey=1", path])
+    try:
+        t0 = float(out.strip())
+    except ValueError:
+        t0 = 0.0
+    return [(p - t0, k) for p, k in pk]
+
+
+def closed_keys(pk):
+    """pts of the keyframes in pk that start a closed GOP.
+
+    A keyframe qualifies when nothing decoded before it (back to the previous
+    keyframe) is shown after it and nothing decoded after it (up to the next
+    keyframe) is shown before it: no leading pictures reference the previous
+    GOP, so the stream can be cut there in either direction.
+    """
+    ks = [i for i, (p, k) in enumerate(pk) if k]
+    out = []
+    for j, i in enumerate(ks):
+        a = ks[j - 1] if j else 0
+        b = ks[j + 1] if j + 1 < len(ks) else len(pk)
+        p = pk[i][0]
+        if all(q < p for q, _ in pk[a:i]) and all(q > p for q, _ in pk[i + 1:b]):
+            out.append(p)
+    return out
+
+
+def open_source(path, start=0.0, end=None):
+    """Everything the splicer needs about path: SPS fields, frame times, closed keyframe indices and matching encoder args.
+
+    times are the presentation times of the frames read (all of them, or
+    [start - margin, end + margin] with end set); frames are addressed by
+    index into it. keys is empty when the video is not H.264.
+    """
+    require_cmd("ffprobe")
+    sps = probe_sps(path)
+    pk = probe_packets(path, start, end)
+    times = sorted(p for p, _ in pk)
+    keys = []
+    if sps.get("codec_name") == "h264":
+        keys = sorted(bisect_left(times, p) for p in closed_keys(pk))
+    return {"path": path, "sps": sps, "times": times, "keys": keys, "enc": match_args(sps)}
+
+
+def frame_at(sv, t):
+    """Index of the first frame shown at or after t seconds."""
+    return bisect_left(sv["times"], t - 1e-6)
+
+
+def half_gap(times, i, side):
+    """Half the distance from frame i to its neighbour on side (-1 or 1), for seeking between frames."""
+    j = i + side
+    if 0 <= j < len(times):
+        return abs(times[j] - times[i]) / 2.0
+    j = i - side
+    if 0 <= j < len(times):
+        return abs(times[j] - times[i]) / 2.0
+    return 0.01
+
+
+def end_time(sv, f):
+    """Time frame f starts, or for f past the last frame, when the last frame ends (its gap to the previous one)."""
+    times = sv["times"]
+    if f < len(times):
+        return times[f]
+    return times[-1] + 2.0 * half_gap(times, len(times) - 1, -1)
+
+
+def cut_frames(sv, f0, f1, codec, out, vf=""):
+    """Frames [f0, f1) of the source as out (.ts outputs are Annex B, so pieces keep their own SPS/PPS).
+
+    Encodes seek half a frame before frame f0 so the decoder keeps it;
+    copies seek half a frame past it so the demuxer lands on that keyframe
+    and not the one before. -frames:v then takes exactly f1 - f0 frames.
+    """
+    times = sv["times"]
+    copy = codec[:2] == ["-c:v", "copy"]
+    t = times[f0] + half_gap(times, f0, 1) if copy else max(0.0, times[f0] - half_gap(times, f0, -1))
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-ss", "{0:.6f}".format(t), "-i", sv["path"], "-map", "0:v:0", "-an", "-frames:v", str(f1 - f0)]
+    if vf:
+        cmd += ["-vf", vf]
+    cmd += codec
+    if out.endswith(".ts"):
+        cmd += ["-bsf:v", "h264_mp4toannexb", "-f", "mpegts"]
+    run(cmd + [out])
+
+
+def encode_head(path, n, enc, out, vf=""):
+    """The first n frames of path encoded with enc into out, for pieces made outside the splicer (e.g. Wav2Lip output).
+
+    Add a tpad to vf when path may be short; -frames:v only trims.
+    """
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-i", path, "-map", "0:v:0", "-an", "-frames:v", str(n)]
+    if vf:
+        cmd += ["-vf", vf]
+    cmd += enc
+    if out.endswith(".ts"):
+        cmd += ["-bsf:v", "h264_mp4toannexb", "-f", "mpegts"]
+    run(cmd + [out])
+
+
+def plan_pieces(sv, f0, f1, min_copy):
+    """Split frames [f0, f1) into (g0, g1, copy) pieces.
+
+    Frames between the first and last closed keyframe inside the range are
+    copied when that span holds at least min_copy frames; the partial GOPs
+    at either end are encoded.
+    """
+    inner = [k for k in sv["keys"] if f0 <= k <= f1]
+    if len(inner) < 2 or inner[-1] - inner[0] < min_copy:
+        return [(f0, f1, False)]
+    return [x for x in [(f0, inner[0], False), (inner[0], inner[-1], True), (inner[-1], f1, False)] if x[1] > x[0]]
+
+
+def pass_through(sv, f0, f1, tmp, tag, min_copy):
+    """Frames [f0, f1) of the source as .ts pieces in tmp; returns [(path, copied)] in order."""
+    parts = []
+    for k, (g0, g1, cp) in enumerate(plan_pieces(sv, f0, f1, min_copy)):
+        ts = os.path.join(tmp, tag + "_" + str(k) + ".ts")
+        cut_frames(sv, g0, g1, ["-c:v", "copy"] if cp else sv["enc"], ts)
+        parts.append((ts, cp))
+    return parts
+
+
+def decoded_frames(path):
+    """Frames the first video stream of path actually decodes to (ffprobe -count_frames)."""
+    out, err = run_capture(["ffprobe", "-v", "error", "-select_streams", "v:0", "-count_frames", "-show_entries", "stream=nb_read_frames", "-of", "csv=p=0", path])
+    try:
+        return int(out.strip().split(",")[0])
+    except ValueError:
+        return -1
+
+
+def write_list(parts, path):
+    f = open(path, "w", encoding="utf-8")
+    for ts, _ in parts:
+        f.write("file '" + ts.replace("'", "'\\''") + "'\n")
+    f.close()
+    return path
+
+
+def splice(sv, parts, out, audio, n, tmp):
+    """Join parts ([(ts path, copied)]) under the audio input args into out and check the result.
+
+    Accepted only if no part was copied, or every encoded part probes with
+    the source's SPS fields and out decodes to exactly n frames. Returns ""
+    when out is good, else the reason (and out is removed).
+    """
+    if any(cp for _, cp in parts):
+        for ts, cp in parts:
+            if cp:
+                continue
+            diff = sps_diff(sv["sps"], ts)
+            if diff:
+                return "encoded piece differs from the source in " + ", ".join(diff)
+    lst = write_list(parts, os.path.join(tmp, "parts.txt"))
+    run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", lst] + audio + ["-map", "0:v:0", "-map", "1:a:0?", "-c:v", "copy", "-c:a", "aac", "-movflags", "+faststart", out])
+    with span("ffprobe", "proc", what="verify splice"):
+        got = decoded_frames(out)
+    if got != n:
+        os.remove(out)
+        return "joined video decodes to " + str(got) + " frames, expected " + str(n)
+    return ""
+
+
+def encode_joined(sv, parts, out, audio, tmp):
+    """Decode parts in order and encode them in one libx264 pass under the audio input args (the fallback when splice refuses)."""
+    lst = write_list(parts, os.path.join(tmp, "parts.txt"))
+    run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", lst] + audio + ["-map", "0:v:0", "-map", "1:a:0?"] + sv["enc"] + ["-c:a", "aac", "-movflags", "+faststart", out])
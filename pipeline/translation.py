@@ -2,83 +2,204 @@ import argparse
 import json
 import os
 import sys
+import time
 
-from transformers import AutoModelForSeq2SeqLM
-from transformers import AutoTokenizer
-
-p=argparse.ArgumentParser()
-p.add_argument("--inp",required=True)
-p.add_argument("--out",required=True)
-p.add_argument("--model",required=True)
-p.add_argument("--beams",type=int,default=4)
-p.add_argument("--max_len",type=int,default=256)
-p.add_argument("--redo",action="store_true")
-a=p.parse_args()
-
-try:
-    import sentencepiece  # noqa: F401
-except Exception:
-    print("Missing dependency: sentencepiece")
-    print("Fix:")
-    print("  pip install sentencepiece sacremoses")
-    sys.exit(1)
-
-f=open(a.inp,"r",encoding="utf-8")
-it=json.load(f)
-f.close()
-
-tok=None
-try:
-    tok=AutoTokenizer.from_pretrained(a.model)
-except Exception:
+import yaml
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0,os.path.abspath(os.path.join(os.path.dirname(__file__),"..")))
+
+from utils.cache_utils import cache_commit, cache_get, cache_key, cache_put, cache_stats, close_cache, open_cache
+from utils.metrics import span
+
+# Bump whenever post() changes so cached translations are not reused.
+POST_VERSION=1
+# Segments per generate call when neither --batch nor tr.batch sets it.
+BATCH=16
+
+def build_parser():
+    p=argparse.ArgumentParser()
+    p.add_argument("--inp",required=True)
+    p.add_argument("--out",required=True)
+    p.add_argument("--model",required=True)
+    p.add_argument("--beams",type=int,default=4)
+    p.add_argument("--max_len",type=int,default=256)
+    p.add_argument("--redo",action="store_true")
+    p.add_argument("--batch",type=int,default=0,help="segments per generate call (0 = tr.batch from --config)")
+    p.add_argument("--config",default="configs/default.yaml")
+    p.add_argument("--bench",default="",help="comma list of batch sizes: report segments/sec for each and exit")
+    p.add_argument("--cache",default="",help="translation cache file (default tr.cache from --config)")
+    p.add_argument("--cache_mb",type=float,default=0,help="cache size bound in MB (0 = tr.cache_mb from --config)")
+    p.add_argument("--engine",default="marian",choices=["marian","stub"])
+    p.add_argument("--stub_delay",type=float,default=0.0,help="stub engine: seconds per generate call")
+    return p
+
+def apply_config(a):
+    """Fill unset --batch/--cache/--cache_mb from the tr block of --config."""
+    cf={}
+    if os.path.exists(a.config):
+        f=open(a.config,"r",encoding="utf-8")
+        cf=(yaml.safe_load(f) or {}).get("tr") or {}
+        f.close()
+    if a.batch<=0:
+        a.batch=int(cf.get("batch",BATCH) or BATCH)
+    if not a.cache:
+        a.cache=cf.get("cache") or "data/cache/tr.sqlite"
+    if a.cache_mb<=0:
+        a.cache_mb=float(cf.get("cache_mb",256) or 256)
+    return a
+
+def load_mt(a):
+    """Tokenizer and model for a.model as {"kind","tok","md"}.
+
+    --engine stub returns the English text unchanged after --stub_delay
+    seconds per batch, so batching, caching and later stages can be timed
+    without transformers.
+    """
+    if a.engine=="stub":
+        return {"kind":"stub","delay":a.stub_delay}
+    from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
+    name=a.model
+    tok=None
     try:
-        from transformers import MarianTokenizer
-        tok=MarianTokenizer.from_pretrained(a.model)
-    except Exception as e:
-        print("Tokenizer load failed for model:",a.model)
-        print("Try:")
-        print("  pip install sentencepiece sacremoses")
-        raise e
-md=AutoModelForSeq2SeqLM.from_pretrained(a.model)
-md.eval()
-
-out=[]
-td="data/interim/tr/txt"
-if not os.path.exists(td):
-    os.makedirs(td,exist_ok=True)
-
-for s in it:
-    i=int(s.get("id",0))
-    sc=int(s.get("scene",0))
+        tok=AutoTokenizer.from_pretrained(name)
+    except Exception:
+        try:
+            from transformers import MarianTokenizer
+            tok=MarianTokenizer.from_pretrained(name)
+        except Exception as e:
+            print("Tokenizer load failed for model:",name)
+            print("Try:")
+            print("  pip install sentencepiece sacremoses")
+            raise e
+    with span("mt_load","model",model=name):
+        md=AutoModelForSeq2SeqLM.from_pretrained(name)
+        md.eval()
+    return {"kind":"marian","tok":tok,"md":md}
+
+def post(hi):
+    hi=hi.strip()
+    hi=hi.replace("आरक्षण","बुकिंग")
+    hi=hi.replace("booking","बुकिंग")
+    return hi
+
+def translate(mt,a,txs,bs):
+    """Translate txs in length-sorted batches of bs; results keep input order."""
+    if not txs:
+        return []
+    if mt["kind"]=="stub":
+        res=[]
+        for b0 in range(0,len(txs),bs):
+            with span("mt_batch","model",n=len(txs[b0:b0+bs])):
+                time.sleep(mt["delay"])
+            res+=[post(x) for x in txs[b0:b0+bs]]
+        return res
+    import torch
+    tok=mt["tok"]
+    # sort by token count so each batch holds similar lengths and pads little
+    ln=[len(x) for x in tok(txs,truncation=True)["input_ids"]]
+    order=sorted(range(len(txs)),key=lambda k:ln[k])
+    res=[""]*len(txs)
+    for b0 in range(0,len(order),bs):
+        ix=order[b0:b0+bs]
+        enc=tok([txs[k] for k in ix],return_tensors="pt",padding=True,truncation=True)
+        with span("mt_batch","model",n=len(ix)),torch.inference_mode():
+            gen=mt["md"].generate(**enc,num_beams=a.beams,max_length=a.max_len)
+        dec=tok.batch_decode(gen,skip_special_tokens=True)
+        for k,hi in zip(ix,dec):
+            res[k]=post(hi)
+    return res
+
+def key(a,tx):
+    if a.engine=="stub":
+        return cache_key(tx,"stub",POST_VERSION)
+    return cache_key(tx,a.model,a.beams,a.max_len,POST_VERSION)
+
+def translate_cached(mt,cc,a,txs):
+    """tx -> hi for txs, through the cache. Identical lines are looked up and translated once."""
+    hs={}
+    miss=[]
+    for tx in txs:
+        if not tx or tx in hs:
+            continue
+        v=None if a.redo else cache_get(cc,key(a,tx))
+        if v is None:
+            hs[tx]=""
+            miss.append(tx)
+        else:
+            hs[tx]=v.decode("utf-8")
+    # one commit for the lookups and one for the puts, so other shards are not locked out while translating
+    cache_commit(cc)
+    t0=time.time()
+    for tx,hi in zip(miss,translate(mt,a,miss,a.batch)):
+        hs[tx]=hi
+        cache_put(cc,key(a,tx),hi.encode("utf-8"))
+    cache_commit(cc)
+    dt=time.time()-t0
+    if miss:
+        print("Translated:",len(miss),"batch",a.batch,"seg/s",round(len(miss)/max(dt,1e-9),2))
+    return hs
+
+def print_cache(cc,a):
+    cs=cache_stats(cc)
+    print("Cache:",a.cache,"hits",cs["hits"],"misses",cs["misses"],"entries",cs["entries"],"lifetime hits",cs.get("total_hits",0),"misses",cs.get("total_misses",0))
+
+def tr_row(s,hs):
+    """tr.json entry for one ASR item."""
     st=float(s.get("start",0.0))
     en=float(s.get("end",0.0))
-    dr=round(en-st,3)
     tx=(s.get("text") or "").strip()
+    return {"id":int(s.get("id",0)),"scene":int(s.get("scene",0)),"start":st,"end":en,"dur":round(en-st,3),"en":tx,"hi":hs.get(tx,"")}
 
-    hi=""
-    tp=os.path.join(td,"seg_"+str(i).zfill(4)+".txt")
-    if (not a.redo) and os.path.exists(tp):
-        f=open(tp,"r",encoding="utf-8",errors="ignore")
-        hi=f.read().strip()
-        f.close()
-    elif tx:
-        enc=tok(tx,return_tensors="pt",truncation=True)
-        gen=md.generate(**enc,num_beams=a.beams,max_length=a.max_len)
-        hi=tok.batch_decode(gen,skip_special_tokens=True)[0].strip()
-        hi=hi.replace("आरक्षण","बुकिंग")
-        hi=hi.replace("booking","बुकिंग")
-        f=open(tp,"w",encoding="utf-8")
-        f.write(hi)
-        f.close()
+def main():
+    a=apply_config(build_parser().parse_args())
+
+    if a.engine!="stub":
+        try:
+            import sentencepiece  # noqa: F401
+        except Exception:
+            print("Missing dependency: sentencepiece")
+            print("Fix:")
+            print("  pip install sentencepiece sacremoses")
+            sys.exit(1)
+
+    f=open(a.inp,"r",encoding="utf-8")
+    it=json.load(f)
+    f.close()
+
+    mt=load_mt(a)
+
+    if a.bench:
+        txs=[(s.get("text") or "").strip() for s in it]
+        txs=[x for x in txs if x]
+        print("segments:",len(txs))
+        sizes=[int(x) for x in a.bench.split(",") if x.strip()]
+        # untimed warm-up: first generate calls pay for lazy init and allocator growth
+        translate(mt,a,txs[:max(sizes)],max(sizes))
+        for bs in sizes:
+            t0=time.time()
+            translate(mt,a,txs,bs)
+            dt=time.time()-t0
+            print("batch",bs,"time",round(dt,2),"seg/s",round(len(txs)/max(dt,1e-9),2))
+        sys.exit(0)
+
+    cc=open_cache(a.cache,a.cache_mb*1024*1024)
+    with span("translate","stage",items=len(it)):
+        hs=translate_cached(mt,cc,a,[(s.get("text") or "").strip() for s in it])
+    print_cache(cc,a)
+    close_cache(cc)
+
+    out=[tr_row(s,hs) for s in it]
 
-    out.append({"id":i,"scene":sc,"start":st,"end":en,"dur":dr,"en":tx,"hi":hi})
+    od=os.path.dirname(a.out)
+    if od and not os.path.exists(od):
+        os.makedirs(od,exist_ok=True)
 
-od=os.path.dirname(a.out)
-if od and not os.path.exists(od):
-    os.makedirs(od,exist_ok=True)
+    f=open(a.out,"w",encoding="utf-8")
+    json.dump(out,f,indent=2,ensure_ascii=False)
+    f.close()
 
-f=open(a.out,"w",encoding="utf-8")
-json.dump(out,f,indent=2,ensure_ascii=False)
-f.close()
+    print("Wrote:",a.out,"items:",len(out))
 
-print("Wrote:",a.out,"items:",len(out))
+if __name__=="__main__":
+    main()
@@ -1,77 +1,106 @@
 import argparse
 import json
 import os
-import subprocess
 import sys
-
-p=argparse.ArgumentParser()
-p.add_argument("--inp",required=True)
-p.add_argument("--out",required=True)
-p.add_argument("--ref",required=True)
-p.add_argument("--model",default="tts_models/multilingual/multi-dataset/xtts_v2")
-p.add_argument("--lang",default="hi")
-p.add_argument("--sr",type=int,default=16000)
-p.add_argument("--redo",action="store_true")
-p.add_argument("--gpu",action="store_true")
-a=p.parse_args()
-
-try:
-    from TTS.api import TTS
-except Exception:
-    print("Missing dependency: TTS")
-    print("Fix:")
-    print("  pip install TTS soundfile")
-    sys.exit(1)
-
-for c in ["ffmpeg","ffprobe"]:
-    r=subprocess.run([c,"-version"],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    if r.returncode!=0:
-        print("Missing command:",c)
-        sys.exit(1)
-
-if not os.path.exists(a.inp):
-    print("Missing:",a.inp)
-    sys.exit(1)
-if not os.path.exists(a.ref):
-    print("Missing:",a.ref)
-    sys.exit(1)
-
-f=open(a.inp,"r",encoding="utf-8")
-it=json.load(f)
-f.close()
-
-wd="data/interim/tts/wav"
-td="data/interim/tts/tmp"
-if not os.path.exists(wd):
-    os.makedirs(wd,exist_ok=True)
-if not os.path.exists(td):
-    os.makedirs(td,exist_ok=True)
-
-tts=TTS(model_name=a.model,progress_bar=False,gpu=bool(a.gpu))
-
-def build_atempo_chain(ratio):
-    """Build chained atempo filters. Cap at 1.8x to preserve clarity."""
-    if ratio < 0.5:
-        ratio = 0.5
-    if ratio > 1.8:
-        ratio = 1.8  # Cap to preserve intelligibility
-    filters = []
-    r = ratio
-    while r > 2.0:
-        filters.append("atempo=2.0")
-        r /= 2.0
-    while r < 0.5:
-        filters.append("atempo=0.5")
-        r /= 0.5
-    filters.append("atempo=" + str(round(r, 5)))
-    return ",".join(filters)
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0,os.path.abspath(os.path.join(os.path.dirname(__file__),"..")))
+
+from pipeline.duration_control import fit_to_duration, resample, wav_duration, write_wav_f32
+from utils.cache_utils import cache_key, file_fingerprint
+from utils.ffmpeg_utils import ensure_parent_dir
+from utils.gpu_utils import split_cores
+from utils.metrics import span
+
+WD="data/interim/tts/wav"
+
+def load_speaker(eng,ref,model_name,cache_dir):
+    """XTTS conditioning latents for ref, computed once per (ref audio, model, conditioning settings) and kept on disk.
+
+    Returns None for models without get_conditioning_latents; those fall back
+    to passing speaker_wav on every call.
+    """
+    import torch
+    xm=eng["tts"].synthesizer.tts_model
+    if not hasattr(xm,"get_conditioning_latents"):
+        return None
+    dev=next(xm.parameters()).device
+    ck=cond_kwargs(xm)
+    cp=os.path.join(cache_dir,cache_key(file_fingerprint(ref),model_name,ck)+".pt")
+    if os.path.exists(cp):
+        d=torch.load(cp,map_location=dev)
+        print("Speaker latents: cached",cp)
+        return d["gpt_cond_latent"],d["speaker_embedding"]
+    gcl,spk=xm.get_conditioning_latents(audio_path=[ref],**ck)
+    ensure_parent_dir(cp)
+    # pool workers may race on the first run; each writes its own tmp file
+    tmp=cp+"."+str(os.getpid())+".tmp"
+    torch.save({"gpt_cond_latent":gcl.cpu(),"speaker_embedding":spk.cpu(),"ref":ref,"model":model_name},tmp)
+    os.replace(tmp,cp)
+    print("Speaker latents: computed",cp)
+    return gcl,spk
+
+def load_engine(a):
+    """Load the synthesizer once per process.
+
+    --engine stub returns a tone generator with --stub_delay seconds of fake
+    latency per line, so the pool and post-processing can run without TTS.
+    """
+    if a.engine=="stub":
+        return {"kind":"stub","tsr":24000,"spk":None}
+    try:
+        from TTS.api import TTS
+    except Exception:
+        raise RuntimeError("Missing dependency: TTS\nFix:\n  pip install TTS soundfile")
+    with span("tts_load","model",model=a.model):
+        tts=TTS(model_name=a.model,progress_bar=False,gpu=bool(a.gpu))
+    eng={"kind":"tts","tts":tts,"tsr":int(tts.synthesizer.output_sample_rate),"spk":None}
+    eng["spk"]=load_speaker(eng,a.ref,a.model,a.cond_cache)
+    eng["gen"]=gen_kwargs(tts.synthesizer.tts_model)
+    return eng
+
+def cond_kwargs(xm):
+    """Conditioning settings from the model's config, as Xtts.synthesize passes them to get_conditioning_latents."""
+    cf=getattr(xm,"config",None)
+    names=[("gpt_cond_len","gpt_cond_len"),("gpt_cond_chunk_len","gpt_cond_chunk_len"),("max_ref_len","max_ref_length"),("sound_norm_refs","sound_norm_refs")]
+    return {k:getattr(cf,c) for c,k in names if hasattr(cf,c)}
+
+def gen_kwargs(xm):
+    """Sampling settings from the model's config, as Xtts.synthesize passes them to inference."""
+    cf=getattr(xm,"config",None)
+    return {k:getattr(cf,k) for k in ["temperature","length_penalty","repetition_penalty","top_k","top_p"] if hasattr(cf,k)}
+
+def synth(eng,a,tx,spd):
+    """Synthesize tx; float32 at eng["tsr"]."""
+    if eng["kind"]=="stub":
+        if a.stub_delay>0:
+            time.sleep(a.stub_delay)
+        sr=eng["tsr"]
+        n=int(sr*min(0.3+0.06*len(tx)/max(spd,0.1),20.0))
+        t=np.arange(n,dtype=np.float32)/sr
+        y=0.3*np.sin(2*np.pi*(180.0+len(tx)%40)*t).astype(np.float32)
+        sil=np.zeros(int(0.1*sr),dtype=np.float32)
+        return np.concatenate([sil,y,sil])
+    if eng["spk"] is None:
+        return np.asarray(eng["tts"].tts(text=tx,speaker_wav=a.ref,language=a.lang,speed=spd),dtype=np.float32)
+    gcl,spk=eng["spk"]
+    # inference() skips the sentence splitting and config settings tts() applies; ask for both
+    r=eng["tts"].synthesizer.tts_model.inference(tx,a.lang,gcl,spk,speed=spd,enable_text_splitting=True,**eng["gen"])
+    w=r["wav"]
+    if hasattr(w,"cpu"):
+        w=w.cpu().numpy()
+    return np.asarray(w,dtype=np.float32).reshape(-1)
 
 def estimate_speed(text, target_dur):
-    """Return 1.0 for natural-pace speech. Let atempo handle fitting."""
+    """Return 1.0 for natural-pace speech. Let time_stretch handle fitting."""
     return 1.0
 
-out=[]
-for s in it:
+def render(eng,a,s):
+    """Synthesize one manifest item into WD/seg_XXXX.wav and return its tts.json entry."""
     i=int(s.get("id",0))
     st=float(s.get("start",0.0))
     en=float(s.get("end",0.0))
@@ -79,89 +108,140 @@ for s in it:
     tx=(s.get("hi") or "").strip()
 
     fn="seg_"+str(i).zfill(4)+".wav"
-    fp=os.path.join(wd,fn)
-
-    raw=os.path.join(td,"raw_"+str(i).zfill(4)+".wav")
-    rs=os.path.join(td,"rs_"+str(i).zfill(4)+".wav")
-    tr=os.path.join(td,"tr_"+str(i).zfill(4)+".wav")
-    sp=os.path.join(td,"sp_"+str(i).zfill(4)+".wav")
+    fp=os.path.join(WD,fn)
 
     if (not a.redo) and os.path.exists(fp):
-        pass
+        fd=wav_duration(fp)
     else:
-        if not tx:
-            r=subprocess.run(["ffmpeg","-y","-f","lavfi","-i","anullsrc=r="+str(a.sr)+":cl=mono","-t",str(tg),"-ac","1","-ar",str(a.sr),fp],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            if r.returncode!=0:
-                print("ffmpeg failed for silence:",i)
-                print(r.stderr.decode("utf-8",errors="ignore"))
-                sys.exit(1)
-        else:
-            # Estimate speed so TTS output is closer to target duration
-            spd = estimate_speed(tx, tg)
-            print(f"  seg {i}: target={tg}s, speed={spd}")
-            tts.tts_to_file(text=tx,speaker_wav=a.ref,language=a.lang,file_path=raw,speed=spd)
-            # Only trim leading/trailing silence gently (-50dB threshold, keep internal speech intact)
-            r=subprocess.run(["ffmpeg","-y","-i",raw,"-af",
-                "silenceremove=start_periods=1:start_silence=0.05:start_threshold=-50dB,"
-                "areverse,silenceremove=start_periods=1:start_silence=0.05:start_threshold=-50dB,areverse",
-                "-ac","1",tr],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            if r.returncode!=0:
-                print("ffmpeg trim failed:",i)
-                print(r.stderr.decode("utf-8",errors="ignore"))
-                sys.exit(1)
-
-            r=subprocess.run(["ffprobe","-v","error","-show_entries","format=duration","-of","default=nw=1:nk=1",tr],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-            ds=r.stdout.decode("utf-8",errors="ignore").strip()
-            gd=0.0
-            if ds:
-                try:
-                    gd=float(ds)
-                except Exception:
-                    gd=0.0
-
-            rt=0.0
-            if tg>0.01 and gd>0.01:
-                rt=gd/tg
-
-            if tg>0.01 and gd>0.01 and abs(gd-tg)>0.05:
-                af_chain = build_atempo_chain(rt)
-                r=subprocess.run(["ffmpeg","-y","-i",tr,"-af",af_chain,"-ac","1",sp],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-                if r.returncode!=0:
-                    print("ffmpeg atempo failed:",i,"filter:",af_chain)
-                    print(r.stderr.decode("utf-8",errors="ignore"))
-                    sys.exit(1)
-                r=subprocess.run(["ffmpeg","-y","-i",sp,"-af","apad","-t",str(tg),"-ac","1","-ar",str(a.sr),fp],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-                if r.returncode!=0:
-                    print("ffmpeg pad/cut failed:",i)
-                    print(r.stderr.decode("utf-8",errors="ignore"))
-                    sys.exit(1)
+        with span("tts_seg","seg",id=i,chars=len(tx)):
+            if not tx:
+                y=np.zeros(int(round(tg*a.sr)),dtype=np.float32)
             else:
-                r=subprocess.run(["ffmpeg","-y","-i",tr,"-af","apad","-t",str(tg),"-ac","1","-ar",str(a.sr),fp],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-                if r.returncode!=0:
-                    print("ffmpeg pad/cut failed:",i)
-                    print(r.stderr.decode("utf-8",errors="ignore"))
-                    sys.exit(1)
-
-    r=subprocess.run(["ffprobe","-v","error","-show_entries","format=duration","-of","default=nw=1:nk=1",fp],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    ds=r.stdout.decode("utf-8",errors="ignore").strip()
-    fd=0.0
-    if ds:
-        try:
-            fd=float(ds)
-        except Exception:
-            fd=0.0
+                # Estimate speed so TTS output is closer to target duration
+                spd = estimate_speed(tx, tg)
+                print(f"  seg {i}: target={tg}s, speed={spd}")
+                with span("tts_synth","model"):
+                    wav=synth(eng,a,tx,spd)
+                # Gentle -50dB trim of leading/trailing silence, stretch toward the
+                # target (clamped to 0.5-1.8x), then pad/cut, all at the output rate
+                y,gd,rt=fit_to_duration(resample(wav,eng["tsr"],a.sr),a.sr,tg)
+            write_wav_f32(fp,y,a.sr)
+        fd=len(y)/float(a.sr)
 
     err=0.0
     if tg>0.01 and fd>0.01:
         err=round(fd-tg,3)
 
-    out.append({"id":i,"start":st,"end":en,"dur_t":tg,"dur_a":fd,"err":err,"wav":fp})
     print("seg",str(i).zfill(4),"t",tg,"a",round(fd,3),"err",err)
+    return {"id":i,"start":st,"end":en,"dur_t":tg,"dur_a":fd,"err":err,"wav":fp}
+
+def set_threads(n):
+    """Cap intra-op threads so pool workers do not oversubscribe cores."""
+    for k in ["OMP_NUM_THREADS","MKL_NUM_THREADS","OPENBLAS_NUM_THREADS"]:
+        os.environ[k]=str(n)
+    try:
+        import torch
+        torch.set_num_threads(n)
+        torch.set_num_interop_threads(1)
+    except (ImportError,RuntimeError):
+        pass
+
+# Engine of a process serving render_item (see init_worker).
+ENG={}
+
+def init_worker(a,threads):
+    """Executor initializer: cap threads and load this process's engine once."""
+    if threads>0:
+        set_threads(threads)
+    if not os.path.exists(WD):
+        os.makedirs(WD,exist_ok=True)
+    ENG["eng"]=load_engine(a)
+    ENG["a"]=a
+
+def render_item(s):
+    """render() with the engine loaded by init_worker; picklable for process pools."""
+    return render(ENG["eng"],ENG["a"],s)
+
+def open_pool(a,workers,threads):
+    """Executor for render_item: one in-process thread for a single worker, spawned processes otherwise.
+
+    Each worker loads the engine once in init_worker. synthesize and the
+    pipelined scheduler both render through this pool.
+    """
+    if workers<=1:
+        return ThreadPoolExecutor(max_workers=1,initializer=init_worker,initargs=(a,threads))
+    import multiprocessing as mp
+    return ProcessPoolExecutor(max_workers=workers,mp_context=mp.get_context("spawn"),initializer=init_worker,initargs=(a,threads))
+
+def synthesize(it,a):
+    """Render every item on open_pool; results come back in manifest order.
+
+    Longest lines are queued first so one long line does not finish last on
+    an otherwise idle pool.
+    """
+    n,t=split_cores(a.workers,a.threads)
+    n=min(n,max(len(it),1))
+    if n>1:
+        print("TTS pool:",n,"workers x",t,"threads")
+    ex=open_pool(a,n,t if n>1 else a.threads)
+    try:
+        order=sorted(range(len(it)),key=lambda k:len((it[k].get("hi") or "")),reverse=True)
+        futs={}
+        for k in order:
+            futs[k]=ex.submit(render_item,it[k])
+        return [futs[k].result() for k in range(len(it))]
+    finally:
+        ex.shutdown(wait=True,cancel_futures=True)
+
+def build_parser():
+    p=argparse.ArgumentParser()
+    p.add_argument("--inp",required=True)
+    p.add_argument("--out",required=True)
+    p.add_argument("--ref",required=True)
+    p.add_argument("--model",default="tts_models/multilingual/multi-dataset/xtts_v2")
+    p.add_argument("--lang",default="hi")
+    p.add_argument("--sr",type=int,default=16000)
+    p.add_argument("--redo",action="store_true")
+    p.add_argument("--gpu",action="store_true")
+    p.add_argument("--cond_cache",default="data/cache/xtts",help="dir for cached speaker conditioning latents")
+    p.add_argument("--workers",type=int,default=1,help="synthesis processes (0 = auto from core count)")
+    p.add_argument("--threads",type=int,default=0,help="torch threads per worker (0 = cores / workers)")
+    p.add_argument("--engine",default="xtts",choices=["xtts","stub"])
+    p.add_argument("--stub_delay",type=float,default=0.0)
+    return p
+
+def main():
+    a=build_parser().parse_args()
+
+    if a.engine!="stub":
+        try:
+            import TTS  # noqa: F401
+        except Exception:
+            print("Missing dependency: TTS")
+            print("Fix:")
+            print("  pip install TTS soundfile")
+            sys.exit(1)
+
+    if not os.path.exists(a.inp):
+        print("Missing:",a.inp)
+        sys.exit(1)
+    if a.engine!="stub" and not os.path.exists(a.ref):
+        print("Missing:",a.ref)
+        sys.exit(1)
+
+    f=open(a.inp,"r",encoding="utf-8")
+    it=json.load(f)
+    f.close()
+
+    out=synthesize(it,a)
+
+    od=os.path.dirname(a.out)
+    if od and (not os.path.exists(od)):
+        os.makedirs(od,exist_ok=True)
+    f=open(a.out,"w",encoding="utf-8")
+    json.dump(out,f,indent=2,ensure_ascii=False)
+    f.close()
+    print("Wrote:",a.out,"items:",len(out))
 
-od=os.path.dirname(a.out)
-if od and (not os.path.exists(od)):
-    os.makedirs(od,exist_ok=True)
-f=open(a.out,"w",encoding="utf-8")
-json.dump(out,f,indent=2,ensure_ascii=False)
-f.close()
-print("Wrote:",a.out,"items:",len(out))
+if __name__=="__main__":
+    main()
@@ -0,0 +1,192 @@
+import os
+import numpy as np
+
+from utils.audio_utils import iter_chunks, open_wav
+from utils.cache_utils import cache_key, file_fingerprint
+from utils.ffmpeg_utils import ensure_parent_dir
+from utils.metrics import span
+
+WINDOW = 512  # samples per Silero frame at 16 kHz
+CONTEXT = 64  # samples of the previous frame the v5 ONNX graph expects in front
+# Bump when stream_probs changes so persisted tracks are recomputed.
+PROB_VERSION = 1
+
+
+def load_local_vad(path):
+    """Load a Silero VAD from a local .jit (TorchScript) or .onnx file, no network.
+
+    path "energy" gives a frame-RMS stand-in for benchmarks and runs without
+    model files; it is not a speech detector.
+    """
+    if path == "energy":
+        return {"kind": "energy", "path": path}
+    if not path or not os.path.exists(path):
+        raise RuntimeError("Missing VAD model file: " + str(path))
+    if path.endswith(".onnx"):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("Missing dependency: onnxruntime\nFix:\n  pip install onnxruntime")
+        so = ort.SessionOptions()
+        so.inter_op_num_threads = 1
+        sess = ort.InferenceSession(path, sess_options=so, providers=["CPUExecutionProvider"])
+        return {"kind": "onnx", "sess": sess, "path": path}
+    import torch
+    m = torch.jit.load(path, map_location="cpu")
+    m.eval()
+    return {"kind": "jit", "model": m, "path": path}
+
+
+def vad_reset(m, lanes):
+    """Fresh recurrent state for lanes parallel streams."""
+    if m["kind"] == "jit":
+        m["model"].reset_states(lanes)
+        return None
+    if m["kind"] == "energy":
+        return None
+    return {"state": np.zeros((2, lanes, 128), dtype=np.float32), "ctx": np.zeros((lanes, CONTEXT), dtype=np.float32)}
+
+
+def vad_step(m, x, st, sr=16000):
+    """Speech probability for one WINDOW-sample frame of each lane; x is (lanes, WINDOW)."""
+    if m["kind"] == "energy":
+        return np.clip(np.sqrt(np.mean(x * x, axis=1)) / 0.02, 0.0, 1.0), st
+    if m["kind"] == "jit":
+        import torch
+        with torch.inference_mode():
+            p = m["model"](torch.from_numpy(x), sr)
+        return p.numpy().reshape(-1), st
+    xi = np.concatenate([st["ctx"], x], axis=1)
+    out, state = m["sess"].run(None, {"input": xi, "state": st["state"], "sr": np.array(sr, dtype=np.int64)})
+    return np.asarray(out).reshape(-1), {"state": state, "ctx": xi[:, -CONTEXT:]}
+
+
+def stream_probs(m, wav_path, lanes=8, block=64, warm=32):
+    """Per-frame speech probabilities for a 16 kHz wav, without loading it whole.
+
+    The file is split into `lanes` contiguous parts that run as one batch,
+    each with its own state. Every lane starts `warm` frames before its part
+    so the state has settled by its first kept frame. Audio is read `block`
+    frames per lane at a time, so memory is lanes * block * WINDOW samples
+    whatever the file length. Returns (probs float32, n_samples, sr).
+    """
+    w = open_wav(wav_path)
+    sr = w["sr"]
+    if w["ch"] not in [1, 2]:
+        raise RuntimeError("Expected 1 or 2 channels, got " + str(w["ch"]))
+    if sr != 16000:
+        raise RuntimeError("Expected 16000 Hz wav, got " + str(sr))
+    n = w["n"]
+    nf = (n + WINDOW - 1) // WINDOW
+    probs = np.zeros(nf, dtype=np.float32)
+    if nf == 0:
+        return probs, n, sr
+    lanes = max(1, min(lanes, nf))
+    part = (nf + lanes - 1) // lanes
+    st = vad_reset(m, lanes)
+    steps = part + warm
+    # one zero-padded reader per lane, each starting warm frames before its part
+    its = [iter_chunks(w, block * WINDOW, "float32", (b * part - warm) * WINDOW, (b * part - warm + steps) * WINDOW, pad=True) for b in range(lanes)]
+    k = 0
+    while k < steps:
+        x = np.stack([next(it)[1] for it in its])
+        kb = x.shape[1] // WINDOW
+        for j in range(kb):
+            p, st = vad_step(m, x[:, j * WINDOW:(j + 1) * WINDOW], st, sr)
+            for b in range(lanes):
+                f = b * part - warm + k + j
+                if b * part <= f < min((b + 1) * part, nf):
+                    probs[f] = p[b]
+        k += kb
+    return probs, n, sr
+
+
+def prob_track_path(wav_path, model_path, cache_dir, lanes=8, warm=32):
+    """Where the probability track for this audio, VAD model and lane split lives.
+
+    Backends that are not files ("energy") are keyed on their name.
+    """
+    model = file_fingerprint(model_path) if os.path.isfile(model_path) else model_path
+    key = cache_key(file_fingerprint(wav_path), model, WINDOW, lanes, warm, PROB_VERSION)
+    return os.path.join(cache_dir, key + ".npz")
+
+
+def save_prob_track(path, probs, n, sr):
+    ensure_parent_dir(path)
+    tmp = path[:-4] + ".tmp.npz"
+    np.savez(tmp, probs=np.asarray(probs, dtype=np.float32), n=np.int64(n), sr=np.int64(sr))
+    os.replace(tmp, path)
+
+
+def load_prob_track(model_path, wav_path, lanes=8, block=64, cache_dir="", warm=32):
+    """Per-frame speech probabilities, computed once per (audio, VAD model, lanes, warm) and kept on disk.
+
+    Threshold, padding and minimum lengths are applied afterwards by
+    probs_to_timestamps, so changing them never reruns the model. lanes and
+    warm decide where each lane's state starts, which changes the
+    probabilities, so they are part of the key; block only sets the read
+    size and is not. Returns (probs, n_samples, sr).
+    """
+    path = prob_track_path(wav_path, model_path, cache_dir, lanes, warm) if cache_dir else ""
+    if path and os.path.exists(path):
+        d = np.load(path)
+        print("VAD probabilities: cached", path)
+        return d["probs"], int(d["n"]), int(d["sr"])
+    with span("vad", "model", lanes=lanes):
+        m = load_local_vad(model_path)
+        probs, n, sr = stream_probs(m, wav_path, lanes, block, warm)
+    if path:
+        save_prob_track(path, probs, n, sr)
+    return probs, n, sr
+
+
+def probs_to_timestamps(probs, n_samples, sr, threshold=0.5, min_speech_ms=250, min_silence_ms=100, pad_ms=30):
+    """Silero get_speech_timestamps applied to a precomputed probability track.
+
+    Same hysteresis (threshold / threshold - 0.15), minimum speech and
+    silence lengths and padding rules; returns [{"start", "end"}] in samples.
+    """
+    min_speech = sr * min_speech_ms / 1000.0
+    min_silence = sr * min_silence_ms / 1000.0
+    pad = int(sr * pad_ms / 1000)
+    neg = max(threshold - 0.15, 0.01)
+    speeches = []
+    cur = {}
+    triggered = False
+    temp_end = 0
+    for i in range(len(probs)):
+        p = float(probs[i])
+        if p >= threshold and temp_end:
+            temp_end = 0
+        if p >= threshold and not triggered:
+            triggered = True
+            cur = {"start": WINDOW * i}
+            continue
+        if p < neg and triggered:
+            if not temp_end:
+                temp_end = WINDOW * i
+            if WINDOW * i - temp_end < min_silence:
+                continue
+            cur["end"] = temp_end
+            if cur["end"] - cur["start"] > min_speech:
+                speeches.append(cur)
+            cur = {}
+            temp_end = 0
+            triggered = False
+    if cur and n_samples - cur["start"] > min_speech:
+        cur["end"] = n_samples
+        speeches.append(cur)
+    for i, sp in enumerate(speeches):
+        if i == 0:
+            sp["start"] = int(max(0, sp["start"] - pad))
+        if i != len(speeches) - 1:
+            gap = speeches[i + 1]["start"] - sp["end"]
+            if gap < 2 * pad:
+                sp["end"] += int(gap // 2)
+                speeches[i + 1]["start"] = int(max(0, speeches[i + 1]["start"] - gap // 2))
+            else:
+                sp["end"] = int(min(n_samples, sp["end"] + pad))
+                speeches[i + 1]["start"] = int(max(0, speeches[i + 1]["start"] - pad))
+        else:
+            sp["end"] = int(min(n_samples, sp["end"] + pad))
+    return speeches
@@ -0,0 +1,81 @@
+"""
+Run Wav2Lip inference.py with face detection served from the face-track cache.
+
+Usage (cwd must be the Wav2Lip folder, as for inference.py):
+  python pipeline/w2l_cached.py --cache_dir DIR [--track_src VIDEO --track_start FRAME] <inference.py arguments>
+
+inference.face_detect is replaced by a version that reads raw S3FD boxes
+from utils/face_utils.py, running the detector only on frames the track
+does not hold yet, then applies --pads and smoothing exactly as the
+original does. When --face is a cut of a longer video, --track_src and
+--track_start point the lookup at that video's track, so cuts and full
+runs share detections.
+"""
+
+import argparse
+
+import os
+import sys
+
+import numpy as np
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from utils.face_utils import face_boxes, load_track, missing, save_track, track_path
+from utils.metrics import span
+
+
+def detect_rects(inf, images, batch_size):
+    """S3FD boxes per frame, halving the batch on OOM like inference.face_detect."""
+    detector = inf.face_detection.FaceAlignment(inf.face_detection.LandmarksType._2D, flip_input=False, device=inf.device)
+    while True:
+        rects = []
+        try:
+            for i in range(0, len(images), batch_size):
+                rects.extend(detector.get_detections_for_batch(np.array(images[i:i + batch_size])))
+        except RuntimeError:
+            if batch_size == 1:
+                raise RuntimeError("Image too big to run face detection on GPU. Please use the --resize_factor argument")
+            batch_size //= 2
+            print("Recovering from OOM error; New batch size:", batch_size)
+            continue
+        break
+    del detector
+    return rects
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--cache_dir", required=True)
+    p.add_argument("--track_src", default="", help="video whose track to use (default: --face)")
+    p.add_argument("--track_start", type=int, default=0, help="frame of --track_src where --face starts")
+    c, rest = p.parse_known_args()
+    sys.argv = ["inference.py"] + rest
+    sys.path.insert(0, os.getcwd())
+    import inference
+    a = inference.args
+
+    def face_detect(images):
+        h, w = images[0].shape[:2]
+        path = track_path(c.track_src or a.face, a.resize_factor, c.cache_dir)
+        rects = load_track(path, len(images), (h, w), c.track_start)
+        if rects is None:
+            rects = np.full((len(images), 4), -2, dtype=np.int32)
+        miss = missing(rects)
+        if len(miss):
+            with span("face_detect", "model", frames=len(miss)):
+                found = detect_rects(inference, [images[i] for i in miss], a.face_det_batch_size)
+            for i, r in zip(miss, found):
+                rects[i] = [int(v) for v in r[:4]] if r is not None else -1
+            save_track(path, rects, (h, w), c.track_start)
+        print("Face track:", len(images) - len(miss), "of", len(images), "frames cached", path)
+        boxes = face_boxes(rects, a.pads, h, w, a.nosmooth)
+        return [[im[y1:y2, x1:x2], (y1, y2, x1, x2)] for im, (x1, y1, x2, y2) in zip(images, boxes)]
+
+    inference.face_detect = face_detect
+    inference.main()
+
+
+if __name__ == "__main__":
+    main()
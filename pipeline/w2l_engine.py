@@ -0,0 +1,228 @@
+"""
+In-process Wav2Lip: the checkpoint and face detector are loaded once and
+reused for every range and clip handed to the same engine.
+
+Frames come in from ffmpeg and go out to ffmpeg over rawvideo pipes, so
+there is no intermediate AVI and no re-mux. Faces are found in a first
+streaming pass over frames the face track (utils/face_utils.py) does not
+hold yet, then a second pass generates and pastes the mouths batch by
+batch; only one batch of frames is in memory at a time.
+
+The math follows the Wav2Lip repo's inference.py (mel chunking, masking,
+pasting), using its models/audio/face_detection modules from --w2l.
+"""
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+# Ensure project root is on sys.path when running this file directly
+sys.path.insert(0,os.path.abspath(os.path.join(os.path.dirname(__file__),"..")))
+
+from pipeline.splice import half_gap
+from utils.face_utils import face_boxes, load_track, missing, save_track, track_path
+from utils.gpu_utils import lipsync_batches
+from utils.metrics import span
+
+IMG=96
+MEL_STEP=16
+
+def load_engine(w2l,ckpt,device="",bs=0,fbs=0):
+    """Load the Wav2Lip generator from ckpt; bs/fbs 0 means pick per clip from free memory and cores."""
+    w2l=os.path.abspath(w2l)
+    if w2l not in sys.path:
+        sys.path.insert(0,w2l)
+    import cv2
+    import torch
+    import audio
+    import face_detection
+    from models import Wav2Lip
+    if not device:
+        device="cuda" if torch.cuda.is_available() else "cpu"
+    with span("w2l_load","model",ckpt=ckpt):
+        cp=torch.load(ckpt,map_location=torch.device(device))
+        sd=cp.get("state_dict",cp)
+        md=Wav2Lip()
+        md.load_state_dict({k.replace("module.",""):v for k,v in sd.items()})
+        md=md.to(device).eval()
+    print("Wav2Lip loaded on",device)
+    return {"torch":torch,"cv2":cv2,"audio":audio,"fd":face_detection,"md":md,"device":device,"bs":bs,"fbs":fbs,"det":None,"tuned":{}}
+
+def batches(eng,w,h):
+    """[generator, detector] batch sizes for w x h frames, picked once per frame size.
+
+    The list is shared with detect/generate, which halve an entry on OOM so
+    later ranges of the same size start from the size that fit.
+    """
+    k=(w,h)
+    if k not in eng["tuned"]:
+        bs,fbs=lipsync_batches(eng["device"],w,h)
+        eng["tuned"][k]=[eng["bs"] or bs,eng["fbs"] or fbs]
+        print("Wav2Lip batch",eng["tuned"][k][0],"face batch",eng["tuned"][k][1],"for",w,"x",h)
+    return eng["tuned"][k]
+
+def detector(eng):
+    if eng["det"] is None:
+        fd=eng["fd"]
+        with span("s3fd_load","model"):
+            eng["det"]=fd.FaceAlignment(fd.LandmarksType._2D,flip_input=False,device=eng["device"])
+    return eng["det"]
+
+def read_frames(path,w,h,f0,n,times,chunk,rf=1):
+    """Yield (offset, frames) for frames [f0, f0+n) of path in chunks, BGR and resized like inference.py.
+
+    times are path's frame times (splice.open_source), so frame indices
+    match the splicer's on variable frame rate sources too.
+    """
+    cv2=None
+    if rf>1:
+        import cv2
+    # seek half a frame early, as splice.cut_frames does, so frame f0 is never dropped
+    cmd=["ffmpeg","-v","error","-ss","{0:.6f}".format(max(0.0,times[f0]-half_gap(times,f0,-1))),"-i",path,"-map","0:v:0","-frames:v",str(n),"-f","rawvideo","-pix_fmt","bgr24","-"]
+    pr=subprocess.Popen(cmd,stdout=subprocess.PIPE)
+    fb=w*h*3
+    k=0
+    try:
+        while k<n:
+            buf=pr.stdout.read(fb*min(chunk,n-k))
+            m=len(buf)//fb
+            if m==0:
+                break
+            fr=np.frombuffer(buf[:m*fb],dtype=np.uint8).reshape(m,h,w,3)
+            if rf>1:
+                fr=np.stack([cv2.resize(x,(w//rf,h//rf)) for x in fr])
+            yield k,fr
+            k+=m
+    finally:
+        pr.stdout.close()
+        pr.wait()
+    if k<n:
+        raise RuntimeError("ffmpeg returned "+str(k)+" of "+str(n)+" frames from "+path)
+
+def open_writer(out,w,h,fps,enc,vf=""):
+    """ffmpeg encoding BGR rawvideo from stdin into out (.ts outputs are Annex B)."""
+    cmd=["ffmpeg","-y","-v","error","-f","rawvideo","-pix_fmt","bgr24","-s",str(w)+"x"+str(h),"-r","{0:.6f}".format(fps),"-i","-"]
+    if vf:
+        cmd+=["-vf",vf]
+    cmd+=enc
+    if out.endswith(".ts"):
+        cmd+=["-bsf:v","h264_mp4toannexb","-f","mpegts"]
+    return subprocess.Popen(cmd+[out],stdin=subprocess.PIPE)
+
+def close_writer(pr):
+    pr.stdin.close()
+    if pr.wait()!=0:
+        raise RuntimeError("ffmpeg encode failed")
+
+def mel_chunks(eng,wav,fps,n):
+    """n mel windows of wav, one per frame, as inference.py cuts them (last window repeated if short)."""
+    mel=eng["audio"].melspectrogram(wav)
+    if np.isnan(mel.reshape(-1)).sum()>0:
+        raise ValueError("Mel contains nan! Using a TTS voice? Add a small epsilon noise to the wav file and try again")
+    if mel.shape[1]<MEL_STEP:
+        mel=np.pad(mel,((0,0),(0,MEL_STEP-mel.shape[1])),mode="edge")
+    mult=80.0/fps
+    out=[]
+    i=0
+    while len(out)<n:
+        s=int(i*mult)
+        if s+MEL_STEP>mel.shape[1]:
+            out.append(mel[:,mel.shape[1]-MEL_STEP:])
+            break
+        out.append(mel[:,s:s+MEL_STEP])
+        i+=1
+    while len(out)<n:
+        out.append(out[-1])
+    return np.asarray(out)
+
+def detect(eng,rows,images,bt):
+    """Fill -2 rows of rows for images with S3FD boxes, halving the batch on OOM."""
+    det=detector(eng)
+    ix=missing(rows)
+    while True:
+        fbs=bt[1]
+        try:
+            for i in range(0,len(ix),fbs):
+                b=ix[i:i+fbs]
+                for j,r in zip(b,det.get_detections_for_batch(np.asarray([images[k] for k in b]))):
+                    rows[j]=[int(v) for v in r[:4]] if r is not None else -1
+        except RuntimeError:
+            if fbs==1:
+                raise RuntimeError("Image too big to run face detection. Please use the --rf argument")
+            bt[1]=fbs//2
+            print("Recovering from OOM error; New face batch size:",bt[1])
+            ix=missing(rows)
+            continue
+        return rows
+
+def generate(eng,faces,mels,bt):
+    """Wav2Lip mouths for (n, 96, 96, 3) faces and their mel windows, with OOM backoff."""
+    torch=eng["torch"]
+    while True:
+        bs=bt[0]
+        out=[]
+        try:
+            for i in range(0,len(faces),bs):
+                img=faces[i:i+bs]
+                mk=img.copy()
+                mk[:,IMG//2:]=0
+                x=np.concatenate((mk,img),axis=3)/255.
+                m=mels[i:i+bs][...,None]
+                xt=torch.FloatTensor(np.transpose(x,(0,3,1,2))).to(eng["device"])
+                mt=torch.FloatTensor(np.transpose(m,(0,3,1,2))).to(eng["device"])
+                with torch.no_grad():
+                    p=eng["md"](mt,xt)
+                out.append(p.cpu().numpy().transpose(0,2,3,1)*255.)
+            return np.concatenate(out)
+        except RuntimeError:
+            if bs==1:
+                raise
+            bt[0]=bs//2
+            print("Recovering from OOM error; New batch size:",bt[0])
+
+def lip_range(eng,vid,wav,f0,f1,fps,times,size,out,enc,pads,rf=1,nosmooth=False,face_cache="",sar=""):
+    """Lip-sync frames [f0, f1) of vid to wav (float32 at 16 kHz, already cut to the range) into out.
+
+    Frames are indices into times, vid's frame times (splice.open_source).
+    size is vid's (w, h); out is written at that size with enc, with sar (a
+    setsar filter) applied since raw frames carry no aspect ratio. The face
+    track of vid is read from and extended in face_cache when given.
+    """
+    cv2=eng["cv2"]
+    W,H=size
+    n=f1-f0
+    w,h=(W//rf,H//rf) if rf>1 else (W,H)
+    bt=batches(eng,w,h)
+    tp=track_path(vid,rf,face_cache) if face_cache else ""
+    rows=load_track(tp,n,(h,w),f0)
+    if rows is None:
+        rows=np.full((n,4),-2,dtype=np.int32)
+    todo=len(missing(rows))
+    if todo:
+        with span("face_detect","model",frames=todo):
+            for k,fr in read_frames(vid,W,H,f0,n,times,max(bt[1],32),rf):
+                sub=rows[k:k+len(fr)]
+                if len(missing(sub)):
+                    rows[k:k+len(fr)]=detect(eng,sub,fr,bt)
+        if tp:
+            save_track(tp,rows,(h,w),f0)
+    print("Face track:",n-todo,"of",n,"frames cached")
+    boxes=face_boxes(rows,[int(p) for p in pads],h,w,nosmooth)
+    mels=mel_chunks(eng,wav,fps,n)
+    vf=",".join(x for x in ["scale="+str(W)+":"+str(H) if rf>1 else "",sar] if x)
+    wr=open_writer(out,w,h,fps,enc,vf)
+    try:
+        with span("w2l_generate","model",frames=n):
+            for k,fr in read_frames(vid,W,H,f0,n,times,bt[0],rf):
+                fr=fr.copy()
+                bx=boxes[k:k+len(fr)]
+                faces=np.asarray([cv2.resize(x[y1:y2,x1:x2],(IMG,IMG)) for x,(x1,y1,x2,y2) in zip(fr,bx)])
+                pred=generate(eng,faces,mels[k:k+len(fr)],bt)
+                for x,p,(x1,y1,x2,y2) in zip(fr,pred,bx):
+                    x[y1:y2,x1:x2]=cv2.resize(p.astype(np.uint8),(int(x2-x1),int(y2-y1)))
+                wr.stdin.write(fr.tobytes())
+    finally:
+        close_writer(wr)
+    return n
@@ -0,0 +1,80 @@
+import json
+import os
+import sys
+
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+from pipeline.alignment import transcribe_segments, write_wav_i16
+
+STUB = os.path.join(ROOT, "bench", "stub_whisper_server.py")
+SR = 16000
+
+
+def make_clip(d, durs, gap=0.25):
+    """clip.wav with one noise burst per duration, segments.json pointing at them, and a model file."""
+    segs = []
+    t = 0.0
+    for i, du in enumerate(durs):
+        segs.append({"id": i, "scene": 0, "start": round(t, 3), "end": round(t + du, 3)})
+        t += du + gap
+    rng = np.random.default_rng(0)
+    a = (rng.standard_normal(int(t * SR)) * 1000).astype(np.int16)
+    write_wav_i16(os.path.join(d, "clip.wav"), a, SR)
+    f = open(os.path.join(d, "segments.json"), "w", encoding="utf-8")
+    json.dump(segs, f)
+    f.close()
+    open(os.path.join(d, "model.bin"), "wb").close()
+    return segs
+
+
+def run_pool(d, workers):
+    return transcribe_segments("clip.wav", "segments.json", "asr.json", "auto", "model.bin", "en", "transcribe", True, "", True, "pool", 0.0, workers, 1, STUB)
+
+
+def read_log(p):
+    f = open(p, "r", encoding="utf-8")
+    rows = [line.split() for line in f if line.strip()]
+    f.close()
+    return [(r[0], int(r[1])) for r in rows]
+
+
+def test_pool_dispatches_longest_first_and_keeps_segment_order(tmp_path, monkeypatch):
+    durs = [1.5, 4.0, 0.75, 3.0, 2.25]
+    segs = make_clip(str(tmp_path), durs)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STUB_ASR_LOG", str(tmp_path / "requests.log"))
+    out = run_pool(str(tmp_path), 1)
+    # one server: requests arrive strictly longest first
+    assert [ms for _, ms in read_log(str(tmp_path / "requests.log"))] == sorted([int(d * 1000) for d in durs], reverse=True)
+    assert [r["id"] for r in out] == [s["id"] for s in segs]
+    for r, du in zip(out, durs):
+        assert r["text"].startswith("dur=" + str(int(du * 1000)) + " ")
+    f = open(str(tmp_path / "asr.json"), "r", encoding="utf-8")
+    assert json.load(f) == out
+    f.close()
+
+
+def test_pool_spreads_over_servers(tmp_path, monkeypatch):
+    durs = [1.0, 2.0, 3.0, 4.0, 5.0, 6.0]
+    make_clip(str(tmp_path), durs)
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STUB_ASR_LOG", str(tmp_path / "requests.log"))
+    monkeypatch.setenv("STUB_ASR_DELAY", "0.2")
+    out = run_pool(str(tmp_path), 2)
+    log = read_log(str(tmp_path / "requests.log"))
+    assert len(set(port for port, _ in log)) == 2
+    # the two longest go out first, one per server
+    assert sorted(ms for _, ms in log[:2]) == [5000, 6000]
+    assert [r["id"] for r in out] == list(range(len(durs)))
+
+
+def test_server_that_exits_on_start_is_retried(tmp_path, monkeypatch):
+    make_clip(str(tmp_path), [1.0, 2.0])
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("STUB_SERVER_FAIL_ONCE", str(tmp_path / "failed"))
+    out = run_pool(str(tmp_path), 1)
+    assert os.path.exists(str(tmp_path / "failed"))
+    assert [r["text"].split()[0] for r in out] == ["dur=1000", "dur=2000"]
@@ -0,0 +1,55 @@
+import json
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+from pipeline import tts_engine
+
+
+def make_manifest(d, texts, gap=0.25):
+    """tr.json with one line per text, each given a slot of a second per 20 characters."""
+    it = []
+    t = 0.0
+    for i, tx in enumerate(texts):
+        du = round(max(len(tx) / 20.0, 0.5), 3)
+        it.append({"id": i, "start": round(t, 3), "end": round(t + du, 3), "hi": tx})
+        t += du + gap
+    f = open(os.path.join(d, "tr.json"), "w", encoding="utf-8")
+    json.dump(it, f)
+    f.close()
+    return it
+
+
+def run_tts(it, workers):
+    """Synthesize it with the stub engine; returns the manifest and the bytes of each wav."""
+    a = tts_engine.build_parser().parse_args(["--inp", "tr.json", "--out", "tts.json", "--ref", "none", "--engine", "stub", "--workers", str(workers), "--threads", "1", "--redo"])
+    out = tts_engine.synthesize(it, a)
+    wavs = []
+    for r in out:
+        f = open(r["wav"], "rb")
+        wavs.append(f.read())
+        f.close()
+    return out, wavs
+
+
+def test_pool_matches_single_worker(tmp_path, monkeypatch):
+    texts = ["short", "a much longer line that takes the most time to say", "", "middle length line", "tiny", "another fairly long line of text"]
+    monkeypatch.chdir(tmp_path)
+    it = make_manifest(str(tmp_path), texts)
+    one, wav1 = run_tts(it, 1)
+    many, wavn = run_tts(it, 3)
+    assert [r["id"] for r in many] == [s["id"] for s in it]
+    assert [r["wav"] for r in many] == [r["wav"] for r in one]
+    assert [r["wav"] for r in one] == [os.path.join(tts_engine.WD, "seg_" + str(i).zfill(4) + ".wav") for i in range(len(texts))]
+    assert many == one
+    assert wavn == wav1
+
+
+def test_pool_with_one_line_per_worker(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    it = make_manifest(str(tmp_path), ["one", "two"])
+    out, wavs = run_tts(it, 4)
+    assert [r["id"] for r in out] == [0, 1]
+    assert all(len(w) > 44 for w in wavs)
@@ -0,0 +1,99 @@
+import os
+import struct
+import numpy as np
+
+
+def open_wav(path):
+    """Memory-map the PCM data of a 16-bit WAV without reading it.
+
+    Parses the RIFF chunks for "fmt " and "data" and maps the data chunk as
+    an (n, channels) int16 array. Nothing is read until it is sliced, so
+    several stages can share one clip.wav with RSS tracking only what they
+    touch. Returns {"path", "sr", "ch", "n", "pcm"}.
+    """
+    if not os.path.exists(path):
+        raise RuntimeError("Missing wav: " + path)
+    size = os.path.getsize(path)
+    f = open(path, "rb")
+    head = f.read(12)
+    if len(head) < 12 or head[0:4] != b"RIFF" or head[8:12] != b"WAVE":
+        f.close()
+        raise RuntimeError("Not a RIFF/WAVE file: " + path)
+    fmt = None
+    data_off = None
+    data_len = 0
+    while True:
+        ck = f.read(8)
+        if len(ck) < 8:
+            break
+        cid, clen = struct.unpack("<4sI", ck)
+        if cid == b"fmt ":
+            fmt = f.read(clen)
+            f.seek(clen & 1, 1)
+        elif cid == b"data":
+            data_off = f.tell()
+            # streamed writers leave 0 or 0xFFFFFFFF here; trust the file size
+            data_len = clen if 0 < clen <= size - data_off else size - data_off
+            break
+        else:
+            f.seek(clen + (clen & 1), 1)
+    f.close()
+    if fmt is None or data_off is None:
+        raise RuntimeError("Missing fmt/data chunk in wav: " + path)
+    tag, ch, sr, _, _, bits = struct.unpack("<HHIIHH", fmt[:16])
+    if tag not in [1, 0xFFFE]:
+        raise RuntimeError("Expected PCM wav, got format tag " + str(tag) + ": " + path)
+    if bits != 16:
+        raise RuntimeError("Expected 16-bit PCM wav, got sampwidth=" + str(bits // 8) + ": " + path)
+    if ch < 1:
+        raise RuntimeError("Bad channel count in wav: " + path)
+    n = data_len // (2 * ch)
+    if n == 0:
+        pcm = np.zeros((0, ch), dtype="<i2")
+    else:
+        pcm = np.memmap(path, dtype="<i2", mode="r", offset=data_off, shape=(n, ch))
+    return {"path": path, "sr": sr, "ch": ch, "n": n, "pcm": pcm}
+
+
+def wav_slice(w, s0, s1, dtype="int16", pad=False):
+    """Mono samples [s0, s1) of an open_wav reader.
+
+    int16 slices of mono files are views of the map; stereo is averaged and
+    float32 (scaled to [-1, 1)) is converted only for the requested range.
+    With pad=True the range may run past either end and is zero-filled.
+    """
+    a = max(int(s0), 0)
+    b = min(int(s1), w["n"])
+    x = w["pcm"][a:b] if b > a else w["pcm"][0:0]
+    if w["ch"] == 1:
+        x = x[:, 0]
+        if dtype == "float32":
+            x = x.astype(np.float32) / 32768.0
+    elif dtype == "float32":
+        x = x.astype(np.float32).mean(axis=1) / 32768.0
+    else:
+        x = x.mean(axis=1).astype(np.int16)
+    if pad and (a != s0 or b != s1):
+        out = np.zeros(max(int(s1) - int(s0), 0), dtype=x.dtype)
+        out[a - int(s0):a - int(s0) + len(x)] = x
+        return out
+    return x
+
+
+def iter_chunks(w, chunk, dtype="float32", start=0, end=None, pad=False):
+    """Yield (offset, samples) over [start, end) in chunks of at most chunk samples.
+
+    Slices are taken lazily with wav_slice. With pad=True the range may run
+    past either end of the file and is zero-filled; otherwise it is clipped
+    to the file.
+    """
+    if end is None:
+        end = w["n"]
+    s = int(start)
+    if not pad:
+        end = min(end, w["n"])
+        s = max(s, 0)
+    while s < end:
+        e = min(s + int(chunk), end)
+        yield s, wav_slice(w, s, e, dtype, pad)
+        s = e
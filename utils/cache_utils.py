@@ -0,0 +1,136 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+from utils.ffmpeg_utils import ensure_parent_dir
+
+
+def cache_key(*parts):
+    """sha256 over the JSON encoding of parts, so any field change is a new key."""
+    s = json.dumps(list(parts), ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(s.encode("utf-8")).hexdigest()
+
+
+def open_cache(path, max_bytes):
+    """Open (or create) a size-bounded LRU key/value store in an SQLite file."""
+    ensure_parent_dir(path)
+    db = sqlite3.connect(path, timeout=60)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("CREATE TABLE IF NOT EXISTS kv (k TEXT PRIMARY KEY, v BLOB NOT NULL, n INTEGER NOT NULL, used REAL NOT NULL)")
+    db.execute("CREATE INDEX IF NOT EXISTS kv_used ON kv(used)")
+    db.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, n INTEGER NOT NULL)")
+    db.commit()
+    total = db.execute("SELECT COALESCE(SUM(n), 0) FROM kv").fetchone()[0]
+    return {"db": db, "path": path, "max_bytes": int(max_bytes), "bytes": int(total), "hits": 0, "misses": 0}
+
+
+def _bump(c, name):
+    c["db"].execute("INSERT INTO stats(name, n) VALUES(?, 1) ON CONFLICT(name) DO UPDATE SET n = n + 1", (name,))
+
+
+def cache_get(c, key):
+    """Return the stored bytes for key or None. Counts the hit or miss; call cache_commit to persist."""
+    db = c["db"]
+    row = db.execute("SELECT v FROM kv WHERE k = ?", (key,)).fetchone()
+    if row is None:
+        c["misses"] += 1
+        _bump(c, "misses")
+        return None
+    c["hits"] += 1
+    _bump(c, "hits")
+    db.execute("UPDATE kv SET used = ? WHERE k = ?", (time.time(), key))
+    return bytes(row[0])
+
+
+def cache_put(c, key, value):
+    """Store bytes under key, then evict least recently used rows over max_bytes.
+
+    The size is kept as a running total; writes persist on cache_commit.
+    """
+    db = c["db"]
+    old = db.execute("SELECT n FROM kv WHERE k = ?", (key,)).fetchone()
+    db.execute("INSERT OR REPLACE INTO kv(k, v, n, used) VALUES(?, ?, ?, ?)", (key, value, len(value), time.time()))
+    total = c["bytes"] + len(value) - (old[0] if old else 0)
+    while total > c["max_bytes"]:
+        rows = db.execute("SELECT k, n FROM kv WHERE k != ? ORDER BY used LIMIT 64", (key,)).fetchall()
+        if not rows:
+            break
+        for k, n in rows:
+            if total <= c["max_bytes"]:
+                break
+            db.execute("DELETE FROM kv WHERE k = ?", (k,))
+            total -= n
+            _bump(c, "evictions")
+    c["bytes"] = total
+
+
+def cache_commit(c):
+    """Commit pending gets/puts and resync the size total with other writers of the file."""
+    db = c["db"]
+    db.commit()
+    c["bytes"] = int(db.execute("SELECT COALESCE(SUM(n), 0) FROM kv").fetchone()[0])
+
+
+def cache_stats(c):
+    """Counters for this session plus lifetime counters stored in the file."""
+    rows = c["db"].execute("SELECT name, n FROM stats").fetchall()
+    d = {"hits": c["hits"], "misses": c["misses"]}
+    for name, n in rows:
+        d["total_" + name] = n
+    row = c["db"].execute("SELECT COUNT(*), COALESCE(SUM(n), 0) FROM kv").fetchone()
+    d["entries"] = row[0]
+    d["bytes"] = row[1]
+    return d
+
+
+def close_cache(c):
+    c["db"].commit()
+    c["db"].close()
+
+
+def file_fingerprint(path, full_limit=64 * 1024 * 1024, edge=1024 * 1024):
+    """Content fingerprint of a file, or None if it does not exist.
+
+    Files up to full_limit are hashed whole. Larger media is fingerprinted from
+    its size, mtime and the first and last edge bytes, which is enough to spot
+    a replaced or re-encoded source without reading gigabytes.
+    """
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    st = os.stat(path)
+    f = open(path, "rb")
+    if st.st_size <= full_limit:
+        while True:
+            b = f.read(1024 * 1024)
+            if not b:
+                break
+            h.update(b)
+    else:
+        h.update(str(st.st_size).encode("ascii"))
+        h.update(str(st.st_mtime_ns).encode("ascii"))
+        h.update(f.read(edge))
+        f.seek(st.st_size - edge)
+        h.update(f.read(edge))
+    f.close()
+    return h.hexdigest()
+
+
+def load_state(path):
+    if not os.path.exists(path):
+        return {}
+    f = open(path, "r", encoding="utf-8")
+    d = json.load(f)
+    f.close()
+    return d
+
+
+def save_state(path, state):
+    ensure_parent_dir(path)
+    tmp = path + ".tmp"
+    f = open(tmp, "w", encoding="utf-8")
+    json.dump(state, f, indent=2, sort_keys=True)
+    f.close()
+    os.replace(tmp, path)
@@ -0,0 +1,94 @@
+import os
+import numpy as np
+
+from utils.cache_utils import cache_key, file_fingerprint
+from utils.ffmpeg_utils import ensure_parent_dir
+
+# Bump when detection or the stored layout changes so tracks are recomputed.
+TRACK_VERSION = 1
+
+
+def track_path(video_path, rf, cache_dir):
+    """Where the raw face track for this video at resize factor rf lives.
+
+    Only what changes the detector's input is in the key. Pads and smoothing
+    are applied on load, so tweaking them reuses the track.
+    """
+    key = cache_key(file_fingerprint(video_path), int(rf), TRACK_VERSION)
+    return os.path.join(cache_dir, key + ".npz")
+
+
+def save_track(path, rects, shape, start=0):
+    """Store detector boxes for frames start.. of the video.
+
+    rects holds (x1, y1, x2, y2) per frame, or None where no face was found.
+    Rows already stored for other frames are kept, so tracks built from
+    separate frame ranges add up to one track; frames never detected are
+    marked -2, frames without a face -1.
+    """
+    old = load_track(path, 0, shape)
+    a = np.full((max(len(old) if old is not None else 0, start + len(rects)), 4), -2, dtype=np.int32)
+    if old is not None:
+        a[:len(old)] = old
+    for i, r in enumerate(rects):
+        a[start + i] = [int(v) for v in r[:4]] if r is not None else -1
+    ensure_parent_dir(path)
+    tmp = path[:-4] + ".tmp.npz"
+    np.savez(tmp, rects=a, shape=np.array(shape[:2], dtype=np.int32))
+    os.replace(tmp, path)
+
+
+def load_track(path, n, shape, start=0):
+    """Stored boxes for frames [start, start + n) with -2 rows where nothing is stored yet.
+
+    n=0 returns the whole track. None if there is no track for this frame size.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    d = np.load(path)
+    if tuple(d["shape"]) != tuple(shape[:2]):
+        return None
+    a = d["rects"]
+    if n <= 0:
+        return a
+    out = np.full((n, 4), -2, dtype=np.int32)
+    got = a[start:start + n]
+    out[:len(got)] = got
+    return out
+
+
+def missing(rects):
+    """Indices of frames with no stored detection."""
+    return np.nonzero(rects[:, 0] == -2)[0]
+
+
+def pad_boxes(rects, pads, h, w):
+    """Wav2Lip's --pads (top, bottom, left, right) applied and clipped to the frame."""
+    pady1, pady2, padx1, padx2 = [int(p) for p in pads]
+    miss = np.nonzero(rects[:, 0] == -1)[0]
+    if len(miss):
+        raise ValueError("Face not detected in frame " + str(int(miss[0])) + ". Ensure the video contains a face in all the frames.")
+    x1 = np.maximum(0, rects[:, 0] - padx1)
+    y1 = np.maximum(0, rects[:, 1] - pady1)
+    x2 = np.minimum(w, rects[:, 2] + padx2)
+    y2 = np.minimum(h, rects[:, 3] + pady2)
+    return np.stack([x1, y1, x2, y2], axis=1)
+
+
+def smooth_boxes(boxes, T=5):
+    """Wav2Lip's get_smoothened_boxes: in-place running mean over the next T boxes."""
+    for i in range(len(boxes)):
+        if i + T > len(boxes):
+            window = boxes[len(boxes) - T:]
+        else:
+            window = boxes[i:i + T]
+        boxes[i] = np.mean(window, axis=0)
+    return boxes
+
+
+def face_boxes(rects, pads, h, w, nosmooth=False):
+    """Padded, optionally smoothed (x1, y1, x2, y2) boxes, as Wav2Lip's face_detect builds them."""
+    boxes = pad_boxes(np.asarray(rects), pads, h, w)
+    if not nosmooth:
+        boxes = smooth_boxes(boxes, T=5)
+    return boxes
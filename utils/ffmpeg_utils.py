@@ -2,6 +2,8 @@ import os
 import shutil
 import subprocess
 
+from utils.metrics import span
+
 def ensure_parent_dir(path):
     folder = os.path.dirname(path)
     if folder and not os.path.exists(folder):
@@ -10,13 +12,15 @@ def require_cmd(name):
     if shutil.which(name) is None:
         raise RuntimeError("Missing required command: " + name)
 def run(cmd):
-    subprocess.run(cmd, check=True)
+    with span(os.path.basename(cmd[0]), "proc"):
+        subprocess.run(cmd, check=True)
 def run_capture(cmd):
-    p = subprocess.run(
-        cmd,
-        check=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-    )
+    with span(os.path.basename(cmd[0]), "proc"):
+        p = subprocess.run(
+            cmd,
+            check=True,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+        )
     return p.stdout, p.stderr
@@ -0,0 +1,91 @@
+import os
+
+
+def cpu_cores():
+    """Cores this process may run on (respects taskset/cgroup affinity)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def split_cores(workers, threads, cores=None):
+    """Split cores between worker processes. 0 means auto for either value.
+
+    Auto picks about 4 threads per worker, which is where whisper.cpp and
+    torch on CPU stop scaling well, and gives each worker an equal share of
+    the cores.
+    """
+    if cores is None:
+        cores = cpu_cores()
+    if workers <= 0:
+        workers = max(1, cores // 4)
+    if threads <= 0:
+        threads = max(1, cores // workers)
+    return workers, threads
+
+
+def mem_available_mb():
+    """RAM this process can still use, in MB: MemAvailable, capped by a cgroup v2 limit if one is set."""
+    mb = 0.0
+    try:
+        f = open("/proc/meminfo", "r")
+        for line in f:
+            if line.startswith("MemAvailable:"):
+                mb = int(line.split()[1]) / 1024.0
+                break
+        f.close()
+    except (OSError, ValueError):
+        pass
+    if mb <= 0:
+        try:
+            mb = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / (1024.0 * 1024.0)
+        except (ValueError, OSError, AttributeError):
+            mb = 1024.0
+    try:
+        f = open("/sys/fs/cgroup/memory.max", "r")
+        lim = f.read().strip()
+        f.close()
+        f = open("/sys/fs/cgroup/memory.current", "r")
+        cur = int(f.read().strip())
+        f.close()
+        if lim != "max":
+            mb = min(mb, (int(lim) - cur) / (1024.0 * 1024.0))
+    except (OSError, ValueError):
+        pass
+    return max(mb, 0.0)
+
+
+def device_free_mb(device):
+    """Free memory on device in MB; system RAM for cpu."""
+    if str(device).startswith("cuda"):
+        import torch
+        free, total = torch.cuda.mem_get_info(torch.device(device))
+        return free / (1024.0 * 1024.0)
+    return mem_available_mb()
+
+
+def fit_batch(per_item_mb, free_mb, cap, frac=0.5):
+    """Largest power of two batch whose items fit in frac of free_mb, between 1 and cap."""
+    n = 1
+    while n * 2 <= cap and n * 2 * per_item_mb <= free_mb * frac:
+        n *= 2
+    return n
+
+
+def lipsync_batches(device, width, height, cores=0):
+    """Wav2Lip (generator, face detector) batch sizes for frames of width x height.
+
+    Per-item costs are rough peaks measured for Wav2Lip at 96x96 and S3FD at
+    full frame size, plus the decoded frame kept for pasting back. On CPU the
+    batch is also capped by core count, since past that larger batches stop
+    helping throughput and only cost memory.
+    """
+    px = width * height
+    gen_mb = 24.0 + px * 3 / (1024.0 * 1024.0)
+    det_mb = px * 600 / (1024.0 * 1024.0)
+    free = device_free_mb(device)
+    if str(device).startswith("cuda"):
+        return fit_batch(gen_mb, free, 256), fit_batch(det_mb, free, 32)
+    cores = cores or cpu_cores()
+    return fit_batch(gen_mb, free, max(8, min(128, 16 * cores))), fit_batch(det_mb, free, max(1, min(8, cores // 4)))
@@ -0,0 +1,173 @@
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# Set by enable(); child processes and spawn workers inherit it, so every
+# process of a run appends its spans to the same JSON lines file.
+ENV = "DUB_TRACE"
+
+LOCAL = threading.local()
+LOCK = threading.Lock()
+IDS = {"n": 0}
+
+
+def trace_path():
+    return os.environ.get(ENV, "")
+
+
+def enable(path, fresh=True):
+    """Record spans to path (JSON lines) from this process and its children."""
+    path = os.path.abspath(path)
+    d = os.path.dirname(path)
+    if d and not os.path.exists(d):
+        os.makedirs(d, exist_ok=True)
+    if fresh and os.path.exists(path):
+        os.remove(path)
+    os.environ[ENV] = path
+    return path
+
+
+def io_bytes():
+    """(read, written) bytes of the whole process from /proc/self/io; zeros where unavailable."""
+    try:
+        f = open("/proc/self/io", "r")
+        d = {}
+        for line in f:
+            k, v = line.split(":", 1)
+            d[k] = int(v)
+        f.close()
+        return d.get("rchar", 0), d.get("wchar", 0)
+    except (OSError, ValueError):
+        return 0, 0
+
+
+def peak_rss_mb():
+    """Peak resident set of this process so far, in MB."""
+    if resource is None:
+        return 0.0
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return round(r / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1)
+
+
+def child_cpu():
+    """CPU seconds used by waited-for child processes (ffmpeg, whisper, ...)."""
+    if resource is None:
+        return 0.0
+    r = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return r.ru_utime + r.ru_stime
+
+
+def stack():
+    if not hasattr(LOCAL, "stack"):
+        LOCAL.stack = []
+    return LOCAL.stack
+
+
+def write_span(path, d):
+    line = json.dumps(d) + "\n"
+    with LOCK:
+        f = open(path, "a", encoding="utf-8")
+        f.write(line)
+        f.close()
+
+
+@contextlib.contextmanager
+def span(name, kind="", **args):
+    """Time a block as a span nested under the enclosing span on this thread.
+
+    kind is stage, seg, proc (one subprocess), model or io. Yields the args
+    dict so the block can attach results. A span records wall and CPU time
+    of its thread, CPU of children it waited for, peak RSS, how many proc
+    spans ran inside it, and proc_read/proc_written: bytes the whole process
+    read and wrote meanwhile, including other threads' spans.
+    Does nothing unless enable() was called in this process or a parent.
+    """
+    path = trace_path()
+    if not path:
+        yield args
+        return
+    st = stack()
+    with LOCK:
+        IDS["n"] += 1
+        sid = str(os.getpid()) + "-" + str(IDS["n"])
+    sp = {"id": sid, "parent": st[-1]["id"] if st else "", "procs": 1 if kind == "proc" else 0}
+    st.append(sp)
+    err = ""
+    t0 = time.time()
+    c0 = time.thread_time()
+    k0 = child_cpu()
+    r0, w0 = io_bytes()
+    try:
+        yield args
+    except BaseException as e:
+        err = type(e).__name__
+        raise
+    finally:
+        r1, w1 = io_bytes()
+        st.pop()
+        if st:
+            st[-1]["procs"] += sp["procs"]
+        d = {"id": sid, "parent": sp["parent"], "name": name, "kind": kind, "pid": os.getpid(), "tid": threading.get_ident(), "depth": len(st),
+             "start": round(t0, 6), "wall": round(time.time() - t0, 6), "cpu": round(time.thread_time() - c0, 6), "child_cpu": round(child_cpu() - k0, 6),
+             "peak_rss_mb": peak_rss_mb(), "proc_read": r1 - r0, "proc_written": w1 - w0, "procs": sp["procs"], "args": args}
+        if err:
+            d["error"] = err
+        write_span(path, d)
+
+
+def load_spans(path):
+    out = []
+    if not os.path.exists(path):
+        return out
+    f = open(path, "r", encoding="utf-8")
+    for line in f:
+        if line.strip():
+            out.append(json.loads(line))
+    f.close()
+    return out
+
+
+def to_chrome(path, out_path):
+    """Write the spans of a JSON lines trace as a Chrome trace (chrome://tracing, Perfetto)."""
+    ev = []
+    for d in load_spans(path):
+        a = dict(d.get("args") or {})
+        for k in ["cpu", "child_cpu", "peak_rss_mb", "proc_read", "proc_written", "procs", "error"]:
+            if k in d:
+                a[k] = d[k]
+        ev.append({"name": d["name"], "cat": d.get("kind", ""), "ph": "X", "ts": int(d["start"] * 1e6), "dur": int(d["wall"] * 1e6), "pid": d["pid"], "tid": d["tid"], "args": a})
+    f = open(out_path, "w", encoding="utf-8")
+    json.dump({"traceEvents": ev, "displayTimeUnit": "ms"}, f)
+    f.close()
+    return out_path
+
+
+def summarize(path, top=20):
+    """Totals per (kind, name), largest wall time first."""
+    agg = {}
+    for d in load_spans(path):
+        k = (d.get("kind", ""), d["name"])
+        a = agg.setdefault(k, {"kind": k[0], "name": k[1], "n": 0, "wall": 0.0, "cpu": 0.0, "child_cpu": 0.0, "procs": 0, "peak_rss_mb": 0.0})
+        a["n"] += 1
+        a["wall"] += d["wall"]
+        a["cpu"] += d["cpu"]
+        a["child_cpu"] += d.get("child_cpu", 0.0)
+        a["procs"] += d.get("procs", 0)
+        a["peak_rss_mb"] = max(a["peak_rss_mb"], d.get("peak_rss_mb", 0.0))
+    rows = sorted(agg.values(), key=lambda x: x["wall"], reverse=True)
+    return rows[:top]
+
+
+def print_summary(path, top=20):
+    print("Trace:", path)
+    for r in summarize(path, top):
+        print("  %-6s %-24s n=%-5d wall=%9.2fs cpu=%9.2fs child_cpu=%9.2fs procs=%-5d rss<=%.0fMB" % (r["kind"], r["name"], r["n"], r["wall"], r["cpu"], r["child_cpu"], r["procs"], r["peak_rss_mb"]))